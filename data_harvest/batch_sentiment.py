@@ -0,0 +1,378 @@
+import random
+import re
+import string
+import time
+import numpy as np
+from vaderSentiment.vaderSentiment import (SentimentIntensityAnalyzer, BOOSTER_DICT, NEGATE, SPECIAL_CASES,
+                                           C_INCR, N_SCALAR)
+
+# largest difference from SentimentIntensityAnalyzer.polarity_scores allowed by the parity check. The batch scorer
+# applies the same rules in the same floating point order, so in practice the scores are identical; the tolerance
+# only leaves room for a difference in the last rounded digit
+TOLERANCE = 1e-3
+# raw tokens kept in the token cache before it is cleared, so a long backfill does not grow it without bound
+TOKEN_CACHE_SIZE = 500000
+# words the VADER rules look for by name
+_RULE_WORDS = ('no', 'least', 'at', 'very', 'but', 'kind', 'of', 'never', 'so', 'this', 'without', 'doubt', 'or',
+               'nor')
+
+
+class BatchSentimentAnalyzer:
+    """
+    VADER sentiment scoring for many texts at once, for backfills and notebooks that score whole data sets.
+
+    Texts are tokenized exactly like SentimentIntensityAnalyzer, then every token of the batch is laid out in one
+    array and the lexicon, booster, negation, capitalisation, idiom, 'least' and 'but' rules are applied with numpy
+    operations on shifted copies of that array, instead of word by word in Python. Lexicon lookups are done once
+    per distinct token and cached across batches.
+
+    polarity_scores_many returns the same dictionaries as polarity_scores of the reference analyser, within
+    TOLERANCE; run this module to check that on a sample of generated tweets.
+    """
+    def __init__(self, analyser=None):
+        self.analyser = analyser or SentimentIntensityAnalyzer()
+        # the reference only replaces single characters, none of them ASCII; scanning for any non ASCII character and
+        # looking it up is much faster than a character class of every emoji
+        self._emoji_pattern = re.compile('[^\x00-\x7f]')
+
+        # properties of each distinct lower case word, indexed by word id
+        self._word_ids = {}
+        self._valence = []
+        self._booster = []
+        self._negation = []
+        # raw whitespace separated token -> (word id, token.isupper())
+        self._tokens = {}
+        self._rule = {word: self._word_id(word) for word in _RULE_WORDS}
+        self._special_cases = [(tuple(self._word_id(w) for w in phrase.split()), value)
+                               for phrase, value in SPECIAL_CASES.items() if ' ' in phrase]
+        self._booster_phrases = [(tuple(self._word_id(w) for w in phrase.split()), value)
+                                 for phrase, value in BOOSTER_DICT.items() if ' ' in phrase]
+        self._freeze()
+
+    def _word_id(self, word):
+        word_id = self._word_ids.get(word)
+        if word_id is None:
+            word_id = self._word_ids[word] = len(self._valence)
+            self._valence.append(self.analyser.lexicon.get(word, np.nan))
+            self._booster.append(BOOSTER_DICT.get(word, 0.0))
+            self._negation.append(word in NEGATE or "n't" in word)
+        return word_id
+
+    def _freeze(self):
+        # array copies of the word properties for the numpy rules
+        self.valence = np.array(self._valence, dtype=np.float64)
+        self.booster = np.array(self._booster, dtype=np.float64)
+        self.negation = np.array(self._negation, dtype=bool)
+
+    def _replace_emojis(self, text):
+        # same output as the character loop in SentimentIntensityAnalyzer.polarity_scores
+        def describe(match):
+            description = self.analyser.emojis.get(match.group())
+            if description is None:
+                return match.group()
+            start = match.start()
+            space = ' ' if start > 0 and text[start - 1] != ' ' else ''
+            return space + description
+        return self._emoji_pattern.sub(describe, text)
+
+    def _token(self, raw):
+        token = self._tokens.get(raw)
+        if token is None:
+            if len(self._tokens) >= TOKEN_CACHE_SIZE:
+                self._tokens.clear()
+            # SentiText._strip_punc_if_word: keep emoticons that would be stripped to two characters or fewer
+            stripped = raw.strip(string.punctuation)
+            word = raw if len(stripped) <= 2 else stripped
+            token = self._tokens[raw] = (self._word_id(word.lower()), word.isupper())
+        return token
+
+    def _tokenize(self, texts):
+        ids, upper, lengths, punctuation = [], [], [], []
+        for text in texts:
+            if not text.isascii():
+                text = self._replace_emojis(text)
+            tokens = [self._token(raw) for raw in text.split()]
+            lengths.append(len(tokens))
+            ids.extend(token[0] for token in tokens)
+            upper.extend(token[1] for token in tokens)
+            punctuation.append((text.count('!'), text.count('?')))
+        if len(self._valence) != len(self.valence):
+            self._freeze()
+        return (np.array(ids, dtype=np.int64), np.array(upper, dtype=bool), np.array(lengths, dtype=np.int64),
+                np.array(punctuation, dtype=np.int64).reshape(-1, 2))
+
+    def polarity_scores(self, text):
+        """
+        Same interface as SentimentIntensityAnalyzer.polarity_scores.
+
+        :param text: the text to score
+        :return: dictionary of neg, neu, pos and compound scores
+        """
+        return self.polarity_scores_many([text])[0]
+
+    def polarity_scores_many(self, texts):
+        """
+        Score a batch of texts.
+
+        :param texts: iterable of strings, e.g. tweet_df['text']
+        :return: list of dictionaries of neg, neu, pos and compound scores, in the order of texts
+        """
+        return [{'neg': round(neg, 3), 'neu': round(neu, 3), 'pos': round(pos, 3), 'compound': round(compound, 4)}
+                for neg, neu, pos, compound in self.score_array(texts).tolist()]
+
+    def score_array(self, texts):
+        """
+        Score a batch of texts without rounding.
+
+        :param texts: iterable of strings
+        :return: float array of shape (len(texts), 4) with the neg, neu, pos and compound columns
+        """
+        texts = list(texts)
+        ids, upper, lengths, punctuation = self._tokenize(texts)
+        sentiments, doc = self._sentiments(ids, upper, lengths)
+        return self._score_valence(sentiments, doc, lengths, punctuation)
+
+    def _sentiments(self, ids, upper, lengths):
+        n_docs = len(lengths)
+        doc = np.repeat(np.arange(n_docs), lengths)
+        starts = np.cumsum(lengths) - lengths
+        pos = np.arange(len(ids)) - starts[doc]
+        doc_length = lengths[doc]
+        rule = self._rule
+
+        def shift(values, k, fill):
+            # values at position i + k of the same text, fill outside it
+            out = np.full_like(values, fill)
+            if k < 0 and len(values) > -k:
+                out[-k:] = values[:k]
+            elif k > 0 and len(values) > k:
+                out[:-k] = values[k:]
+            valid = (pos + k >= 0) & (pos + k < doc_length)
+            return np.where(valid, out, fill)
+
+        def in_lexicon(word):
+            return (word >= 0) & ~np.isnan(self.valence[np.maximum(word, 0)])
+
+        def is_negation(word):
+            return (word >= 0) & self.negation[np.maximum(word, 0)]
+
+        def booster(word):
+            return np.where(word >= 0, self.booster[np.maximum(word, 0)], 0.0)
+
+        def is_any(word, *names):
+            return np.isin(word, [rule[name] for name in names])
+
+        def matches(columns, phrase):
+            found = np.ones(len(ids), dtype=bool)
+            for column, word in zip(columns, phrase):
+                found &= column == word
+            return found
+
+        w = ids
+        w1, w2, w3 = shift(w, -1, -1), shift(w, -2, -1), shift(w, -3, -1)
+        n1, n2 = shift(w, 1, -1), shift(w, 2, -1)
+        upper1, upper2, upper3 = shift(upper, -1, False), shift(upper, -2, False), shift(upper, -3, False)
+
+        # a text is cap differential when some, but not all, of its tokens are upper case
+        upper_count = np.bincount(doc, weights=upper, minlength=n_docs)
+        cap_diff = ((upper_count < lengths) & (upper_count > 0))[doc]
+
+        lexicon = in_lexicon(w)
+        # boosters and the 'kind' of 'kind of' only modify the words after them
+        scored = lexicon & ~(booster(w) != 0) & ~((w == rule['kind']) & (n1 == rule['of']))
+        base = np.where(lexicon, self.valence[w], 0.0)
+        valence = base.copy()
+
+        # 'no' before another lexicon word negates that word instead of counting itself
+        valence[(w == rule['no']) & in_lexicon(n1)] = 0.0
+        no_before = (w1 == rule['no']) | (w2 == rule['no']) | ((w3 == rule['no']) & is_any(w1, 'or', 'nor'))
+        valence = np.where(no_before, base * N_SCALAR, valence)
+        valence = np.where(upper & cap_diff, np.where(valence > 0, valence + C_INCR, valence - C_INCR), valence)
+
+        for distance, (word, word_upper) in enumerate(((w1, upper1), (w2, upper2), (w3, upper3)), 1):
+            applies = (pos >= distance) & ~in_lexicon(word)
+            # scalar_inc_dec: boosters follow the sign of the valence, upper case boosters add the caps increment
+            scalar = booster(word)
+            caps = (scalar != 0) & word_upper & cap_diff
+            scalar = np.where(valence < 0, -scalar, scalar)
+            scalar = np.where(caps, np.where(valence > 0, scalar + C_INCR, scalar - C_INCR), scalar)
+            if distance == 2:
+                scalar = scalar * 0.95
+            elif distance == 3:
+                scalar = scalar * 0.9
+            valence = np.where(applies, valence + scalar, valence)
+
+            # _negation_check
+            if distance == 1:
+                negate = is_negation(w1)
+                keep = np.zeros(len(ids), dtype=bool)
+                boost = keep
+            elif distance == 2:
+                boost = (w2 == rule['never']) & is_any(w1, 'so', 'this')
+                keep = (w2 == rule['without']) & (w1 == rule['doubt'])
+                negate = is_negation(w2)
+            else:
+                boost = ((w3 == rule['never']) & is_any(w2, 'so', 'this')) | is_any(w1, 'so', 'this')
+                keep = (w3 == rule['without']) & ((w2 == rule['doubt']) | (w1 == rule['doubt']))
+                negate = is_negation(w3)
+            valence = np.where(applies & boost, valence * 1.25, valence)
+            valence = np.where(applies & ~boost & ~keep & negate, valence * N_SCALAR, valence)
+
+            if distance == 3:
+                valence = np.where(applies, self._special_idioms(valence, w, w1, w2, w3, n1, n2, matches),
+                                   valence)
+
+        # _least_check
+        least = (w1 == rule['least']) & ~in_lexicon(w1)
+        negate = least & (((pos > 1) & (w2 != rule['at']) & (w2 != rule['very'])) | (pos == 1))
+        valence = np.where(negate, valence * N_SCALAR, valence)
+
+        sentiments = np.where(scored, valence, 0.0)
+        return self._but_check(sentiments, w, doc, pos, starts, lengths), doc
+
+    def _special_idioms(self, valence, w, w1, w2, w3, n1, n2, matches):
+        # the first of these sequences found in SPECIAL_CASES sets the valence
+        special = np.full(len(w), np.nan)
+        for columns in ((w1, w), (w2, w1, w), (w2, w1), (w3, w2, w1), (w3, w2)):
+            for phrase, value in self._special_cases:
+                if len(phrase) == len(columns):
+                    special = np.where(np.isnan(special) & matches(columns, phrase), value, special)
+        valence = np.where(np.isnan(special), valence, special)
+        # the sequences starting at the word override it
+        for columns in ((w, n1), (w, n1, n2)):
+            for phrase, value in self._special_cases:
+                if len(phrase) == len(columns):
+                    valence = np.where(matches(columns, phrase), value, valence)
+        # booster phrases such as 'sort of' before the word
+        for columns in ((w3, w2, w1), (w3, w2), (w2, w1)):
+            for phrase, value in self._booster_phrases:
+                if len(phrase) == len(columns):
+                    valence = np.where(matches(columns, phrase), valence + value, valence)
+        return valence
+
+    def _but_check(self, sentiments, w, doc, pos, starts, lengths):
+        # sentiments before the first 'but' of a text are halved, the ones after it count one and a half times
+        n_docs = len(lengths)
+        but = np.full(n_docs, np.iinfo(np.int64).max)
+        is_but = w == self._rule['but']
+        np.minimum.at(but, doc[is_but], pos[is_but])
+        has_but = but[doc] != np.iinfo(np.int64).max
+        factor = np.where(pos < but[doc], 0.5, np.where(pos > but[doc], 1.5, 1.0))
+        scaled = np.where(has_but, sentiments * factor, sentiments)
+
+        # the reference finds each score with list.index, so when a score repeats, or equals another one once
+        # scaled, the scores are scaled in a different order. Those texts go through the reference rule instead
+        for d in np.flatnonzero(np.bincount(doc[is_but], minlength=n_docs)):
+            section = slice(starts[d], starts[d] + lengths[d])
+            nonzero = np.flatnonzero(sentiments[section])
+            values = set(sentiments[section][nonzero].tolist()) | set(scaled[section][nonzero].tolist())
+            if len(values) < 2 * len(nonzero):
+                words = ['but' if i == self._rule['but'] else '' for i in w[section]]
+                scaled[section] = SentimentIntensityAnalyzer._but_check(words, sentiments[section].tolist())
+        return scaled
+
+    @staticmethod
+    def _score_valence(sentiments, doc, lengths, punctuation):
+        n_docs = len(lengths)
+        total = np.bincount(doc, weights=sentiments, minlength=n_docs)
+
+        # _punctuation_emphasis: up to 4 exclamation marks, and 2 or more question marks
+        exclamations, questions = punctuation[:, 0], punctuation[:, 1]
+        amplifier = np.minimum(exclamations, 4) * 0.292 + np.where(
+            questions > 3, 0.96, np.where(questions > 1, questions * 0.18, 0))
+        total = np.where(total > 0, total + amplifier, np.where(total < 0, total - amplifier, total))
+        compound = np.clip(total / np.sqrt(total * total + 15), -1.0, 1.0)
+
+        # _sift_sentiment_scores
+        pos_sum = np.bincount(doc, weights=np.where(sentiments > 0, sentiments + 1, 0.0), minlength=n_docs)
+        neg_sum = np.bincount(doc, weights=np.where(sentiments < 0, sentiments - 1, 0.0), minlength=n_docs)
+        neu_count = np.bincount(doc, weights=sentiments == 0, minlength=n_docs)
+        pos_sum, neg_sum = (np.where(pos_sum > np.abs(neg_sum), pos_sum + amplifier, pos_sum),
+                            np.where(pos_sum < np.abs(neg_sum), neg_sum - amplifier, neg_sum))
+        count = pos_sum + np.abs(neg_sum) + neu_count
+
+        scores = np.zeros((n_docs, 4))
+        scored = lengths > 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            scores[:, 0] = np.abs(neg_sum / count)
+            scores[:, 1] = np.abs(neu_count / count)
+            scores[:, 2] = np.abs(pos_sum / count)
+        scores[:, 3] = compound
+        scores[~scored] = 0.0
+        return scores
+
+
+def _sample_texts(analyser, count, seed=0):
+    # generated tweets that exercise every rule: lexicon words, boosters, negations, idioms, caps, emojis, 'but',
+    # 'least', 'no' and punctuation
+    rng = random.Random(seed)
+    lexicon = sorted(analyser.lexicon)
+    emojis = sorted(analyser.emojis)
+    rule_words = (list(_RULE_WORDS) + sorted(BOOSTER_DICT) + NEGATE + sorted(SPECIAL_CASES) +
+                  ['the', 'a', 'is', 'was', 'it', 'melbourne', 'housing', 'at least', 'kind of'])
+    texts = []
+    for _ in range(count):
+        words = []
+        for _ in range(rng.randint(0, 25)):
+            choice = rng.random()
+            if choice < 0.35:
+                word = rng.choice(lexicon)
+            elif choice < 0.8:
+                word = rng.choice(rule_words)
+            elif choice < 0.85:
+                word = rng.choice(emojis)
+            else:
+                word = rng.choice(['#auspol', '@user', 'https://t.co/x', 'RT', ':)', ':-(', '2019', 'lol'])
+            if rng.random() < 0.1:
+                word = word.upper()
+            if rng.random() < 0.15:
+                word += rng.choice(['!', '?', '!!', '??', '...', ',', '.', '!?'])
+            words.append(word)
+        texts.append(rng.choice(['', ' ', '  ']).join(words) if words else rng.choice(['', ' ', '!!!']))
+    return texts
+
+
+def check_parity(texts=None, count=20000, tolerance=TOLERANCE):
+    """
+    Compare the batch scorer with SentimentIntensityAnalyzer.polarity_scores.
+
+    :param texts: [optional] texts to compare, by default count generated tweets
+    :param count: number of generated tweets when texts is not given
+    :param tolerance: largest difference allowed in any of the scores
+    :return: the largest difference found
+    """
+    analyser = SentimentIntensityAnalyzer()
+    batch = BatchSentimentAnalyzer(analyser)
+    texts = _sample_texts(analyser, count) if texts is None else list(texts)
+
+    start = time.perf_counter()
+    expected = [analyser.polarity_scores(text) for text in texts]
+    reference_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    actual = batch.polarity_scores_many(texts)
+    batch_seconds = time.perf_counter() - start
+
+    worst, worst_text = 0.0, None
+    for text, e, a in zip(texts, expected, actual):
+        difference = max(abs(e[key] - a[key]) for key in e)
+        if difference > worst:
+            worst, worst_text = difference, text
+    print(f"Scored {len(texts)} texts: reference {reference_seconds:.2f}s, batch {batch_seconds:.2f}s, "
+          f"largest difference {worst}")
+    assert worst <= tolerance, f"batch scores differ by {worst} for {worst_text!r}"
+    return worst
+
+
+if __name__ == '__main__':
+    # test cases: the examples from the vaderSentiment demo, then generated tweets
+    check_parity(["VADER is smart, handsome, and funny.", "VADER is VERY SMART, handsome, and FUNNY!!!",
+                  "VADER is not smart, handsome, nor funny.", "At least it isn't a horrible book.",
+                  "The book was only kind of good.",
+                  "The plot was good, but the characters are uncompelling and the dialog is not great.",
+                  "Today SUX!", "Today only kinda sux! But I'll get by, lol", "Make sure you :) or :D today!",
+                  "Catch utf-8 emoji such as 💘 and 💋 and 😁", "Not bad at all",
+                  "Sentiment analysis has never been this good!", "With VADER, sentiment analysis is the shit!",
+                  "On the other hand, VADER is quite bad ass", "Without a doubt, excellent idea.",
+                  "Roger Dodger is one of the least compelling variations on this theme.",
+                  "good good but good good", "", "   "])
+    check_parity()
@@ -0,0 +1,369 @@
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import re
+import time
+from collections import deque
+import couchdb as DB
+from sa2_data import load_sa2_locator, load_sa2_artifact, SA2_SHAPEFILE, SA2_ARTIFACT
+from bulk_writer import BulkWriter
+from batch_sentiment import BatchSentimentAnalyzer
+from harvester.engine import couchdb_url
+from harvester.enrich import Enricher
+from harvester.sentiment import SentimentCache
+
+# state of each worker process, set up once by _init_worker
+_enricher = None
+_writer = None
+_failed_ids = []
+
+
+# bytes read to work out the format of a dump, a one line JSON array must not be read whole
+SNIFF_SIZE = 4096
+_EXPORT_HEAD = re.compile(rb'\{\s*"(?:total_rows|offset|update_seq|rows)"\s*:')
+_WHITESPACE = re.compile(rb'\s*')
+_STRING_END = re.compile(rb'[^"\\]*(?:\\.[^"\\]*)*"')
+_STRUCTURE = re.compile(rb'["{}\[\]]')
+_SCALAR_END = re.compile(rb'[\s,\]}]')
+
+
+def detect_format(path):
+    """
+    Work out how the tweets are laid out in a dump from its first SNIFF_SIZE bytes.
+
+    :param path: the dump file
+    :return: 'jsonl' for one tweet per line, otherwise the prefix of the tweets: 'item' for a JSON array,
+             'rows.item' for a CouchDB _all_docs export such as twitter-melb-filtered.json
+    """
+    with open(path, 'rb') as f:
+        head = f.read(SNIFF_SIZE).lstrip(b'\xef\xbb\xbf \t\r\n')
+    if head.startswith(b'['):
+        return 'item'
+    if _EXPORT_HEAD.match(head):
+        return 'rows.item'
+    return 'jsonl'
+
+
+class DumpReader:
+    """
+    Stream the items of a JSON array in a dump, found under the keys of an ijson style prefix such as 'item' or
+    'rows.item', as raw bytes along with the byte offset just after each of them. The file is read in blocks and
+    only the item being scanned is kept, and a reader started at an offset it returned carries on with the next
+    item without going through the ones before it.
+    """
+    def __init__(self, f, prefix, block_size=1 << 20):
+        """
+        :param f: the dump opened in binary mode
+        :param prefix: keys leading to the array, followed by 'item'
+        :param block_size: [optional] bytes read at a time
+        """
+        self.f = f
+        self.prefix = prefix
+        self.block_size = block_size
+        self.buf = b''
+        self.pos = 0
+        self.base = f.tell()
+
+    def offset(self):
+        return self.base + self.pos
+
+    def _more(self):
+        # read the next block, dropping what is before the current value; False at the end of the file
+        data = self.f.read(self.block_size)
+        if not data:
+            return False
+        self.buf = self.buf[self.pos:] + data
+        self.base += self.pos
+        self.pos = 0
+        return True
+
+    def _search(self, pattern, rel, match=False, eof_ok=False):
+        # find pattern from rel bytes after the current value, reading more of the file as needed
+        while True:
+            m = (pattern.match if match else pattern.search)(self.buf, self.pos + rel)
+            if m is not None:
+                return m.start() - self.pos, m.end() - self.pos
+            if not self._more():
+                if eof_ok:
+                    return len(self.buf) - self.pos, len(self.buf) - self.pos
+                raise ValueError(f'unexpected end of the dump at byte {self.offset()}')
+
+    def _skip_whitespace(self):
+        while True:
+            self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf) or not self._more():
+                return
+
+    def _expect(self, *tokens):
+        self._skip_whitespace()
+        token = self.buf[self.pos:self.pos + 1]
+        if token not in tokens:
+            raise ValueError(f'expected one of {tokens} at byte {self.offset()} of the dump, found {token!r}')
+        self.pos += 1
+        return token
+
+    def _value_end(self):
+        # length of the JSON value starting at the current position
+        first = self.buf[self.pos:self.pos + 1]
+        if first == b'"':
+            return self._search(_STRING_END, 1, match=True)[1]
+        if first not in (b'{', b'['):
+            return self._search(_SCALAR_END, 0, eof_ok=True)[0]
+        depth = 0
+        rel = 0
+        while True:
+            start, end = self._search(_STRUCTURE, rel)
+            token = self.buf[self.pos + start:self.pos + end]
+            if token == b'"':
+                rel = self._search(_STRING_END, end, match=True)[1]
+                continue
+            rel = end
+            depth += 1 if token in (b'{', b'[') else -1
+            if depth == 0:
+                return rel
+
+    def _read_value(self):
+        self._skip_whitespace()
+        end = self._value_end()
+        value = self.buf[self.pos:self.pos + end]
+        self.pos += end
+        return value
+
+    def _enter(self):
+        # go from the start of the dump to just inside the array of the items
+        *keys, item = self.prefix.split('.')
+        if item != 'item':
+            raise ValueError(f"prefix {self.prefix} does not end with 'item'")
+        for key in keys:
+            self._expect(b'{')
+            while True:
+                self._skip_whitespace()
+                if self.buf[self.pos:self.pos + 1] == b'}':
+                    raise ValueError(f'no {key} key in the dump')
+                name = json.loads(self._read_value())
+                self._expect(b':')
+                if name == key:
+                    break
+                self._read_value()
+                if self._expect(b',', b'}') == b'}':
+                    raise ValueError(f'no {key} key in the dump')
+        self._expect(b'[')
+
+    def items(self, offset=0):
+        """
+        :param offset: [optional] an offset returned before, to carry on after its item
+        :return: generator of (item, offset after it), the item as the bytes of its JSON
+        """
+        if offset:
+            self.f.seek(offset)
+            self.buf, self.pos, self.base = b'', 0, offset
+        else:
+            self._enter()
+            self._skip_whitespace()
+            if self.buf[self.pos:self.pos + 1] == b']':
+                return
+            yield self._read_value(), self.offset()
+        while self._expect(b',', b']') == b',':
+            yield self._read_value(), self.offset()
+
+
+def iter_items(f, dump_format, offset=0):
+    """
+    Stream the tweets of a dump one by one, so memory use does not depend on its size.
+
+    :param f: the dump opened in binary mode
+    :param dump_format: 'jsonl' or a prefix, see detect_format
+    :param offset: [optional] byte offset returned before, to resume after its tweet
+    :return: generator of (tweet as the bytes of its JSON, byte offset after it)
+    """
+    if dump_format != 'jsonl':
+        yield from DumpReader(f, dump_format).items(offset)
+        return
+    f.seek(offset)
+    for line in f:
+        offset += len(line)
+        if line.strip():
+            yield line, offset
+
+
+def _parse_tweet(item):
+    # rows of an _all_docs export are unwrapped to their doc
+    tweet = json.loads(item)
+    if isinstance(tweet.get('doc'), dict):
+        tweet = tweet['doc']
+    tweet.pop('_rev', None)
+    return tweet
+
+
+def _init_worker(couchdb_url, db_name, artifact_dir, full_documents, batch_size):
+    global _enricher, _writer
+    db = DB.Server(couchdb_url)[db_name]
+    analyser = SentimentCache(BatchSentimentAnalyzer())
+    _enricher = Enricher(load_sa2_artifact(artifact_dir), analyser=analyser, full_documents=full_documents)
+    _writer = BulkWriter(db, batch_size=batch_size, verbose=False, on_failed=_failed_ids.extend)
+
+
+def _load_chunk(items, doc_type):
+    # parse, enrich and store one chunk, returning how many tweets were stored, already present, failed and skipped,
+    # and the tweets the database refused
+    stored, conflicts, errors = _writer.stored, _writer.conflicts, _writer.errors
+    del _failed_ids[:]
+    tweets = [_parse_tweet(item) for item in items]
+    # extended mode tweets only have full_text
+    valid = [tweet for tweet in tweets if 'id' in tweet and ('text' in tweet or 'full_text' in tweet)]
+    for doc in _enricher.prepare_tweet_documents(valid, doc_type):
+        _writer.add(doc)
+    _writer.flush()
+    failed_ids = set(_failed_ids)
+    failed = [tweet for tweet in valid if str(tweet['id']) in failed_ids]
+    return (_writer.stored - stored, _writer.conflicts - conflicts, _writer.errors - errors,
+            len(tweets) - len(valid), failed)
+
+
+class Offsets:
+    """
+    Resume point of a load, kept in a small JSON file next to the dump: the byte offset up to which the tweets of
+    the dump are stored, and how many they are. It only moves past a chunk once every chunk before it is stored, so
+    a restarted load seeks straight to what is left, and anything stored twice comes back as a conflict.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.state = {'offset': 0, 'items': 0, 'stored': 0, 'conflicts': 0, 'errors': 0, 'skipped': 0}
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            if 'offset' in state:
+                self.state.update(state)
+            else:
+                print(f"{path} has no byte offset, loading from the start; stored tweets come back as conflicts")
+
+    def advance(self, items, offset, stored, conflicts, errors, skipped):
+        self.state['offset'] = offset
+        self.state['items'] += items
+        self.state['stored'] += stored
+        self.state['conflicts'] += conflicts
+        self.state['errors'] += errors
+        self.state['skipped'] += skipped
+        self.state['updated'] = time.time()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.path)
+
+
+def load_dump(path, couchdb_url, db_name, doc_type='historic', processes=None, chunk_size=1000,
+              sa2_data=SA2_SHAPEFILE, artifact_dir=SA2_ARTIFACT, full_documents=False, offsets_path=None,
+              failed_path=None, dump_format=None, report_interval=10):
+    """
+    Enrich a tweet dump with sentiment, tags and SA2 across a process pool and write it to CouchDB with _bulk_docs.
+    The dump is streamed and at most two chunks per process are in flight, so memory use is constant whatever its
+    size. Progress is printed every report_interval seconds and saved to the offsets file after every chunk, and
+    a load started again with the same offsets file seeks to where it stopped.
+
+    Tweets the database refuses for another reason than a conflict are appended to the failed file before the
+    offsets move past them, a JSON lines dump that can be loaded again once the cause is fixed. A chunk redone after
+    an interruption may list them twice.
+
+    :param path: the dump file
+    :param couchdb_url: CouchDB address with login
+    :param db_name: database to write to
+    :param doc_type: type field of the stored documents
+    :param processes: worker processes, every core by default
+    :param chunk_size: tweets per chunk, also the _bulk_docs batch size
+    :param sa2_data: the SA2 shapefile or geojson
+    :param artifact_dir: the precompiled SA2 artifact, rebuilt first if needed
+    :param full_documents: store full tweets instead of the projected fields
+    :param offsets_path: [optional] resume file, by default <path>.offsets.json
+    :param failed_path: [optional] refused tweets, by default <path>.failed.jsonl
+    :param dump_format: [optional] 'jsonl' or a prefix such as 'rows.item', detected from the file by default
+    :param report_interval: seconds between progress lines
+    :return: the final offsets state
+    """
+    processes = processes or os.cpu_count()
+    dump_format = dump_format or detect_format(path)
+    offsets = Offsets(offsets_path or path + '.offsets.json')
+    failed_path = failed_path or path + '.failed.jsonl'
+    resume = offsets.state['offset']
+    # build the SA2 artifact once here, the workers only load it
+    load_sa2_locator(sa2_data, artifact_dir)
+
+    size = os.path.getsize(path)
+    print(f"Loading {path} ({size / 1e6:.0f} MB, format {dump_format}) into {db_name} with {processes} processes"
+          + (f", resuming after {offsets.state['items']} tweets" if resume else ''))
+    started = last_report = time.monotonic()
+    done = 0
+    pool = multiprocessing.Pool(processes, initializer=_init_worker,
+                                initargs=(couchdb_url, db_name, artifact_dir, full_documents, chunk_size))
+    pending = deque()
+
+    def collect():
+        nonlocal done, last_report
+        count, end, result = pending.popleft()
+        stored, conflicts, errors, skipped, failed = result.get()
+        if failed:
+            with open(failed_path, 'a') as failed_file:
+                failed_file.writelines(json.dumps(tweet) + '\n' for tweet in failed)
+                failed_file.flush()
+                os.fsync(failed_file.fileno())
+        offsets.advance(count, end, stored, conflicts, errors, skipped)
+        done += count
+        now = time.monotonic()
+        if now - last_report >= report_interval:
+            last_report = now
+            state = offsets.state
+            print(f"{state['items']} tweets done ({end / size:.0%} of the file, {done / (now - started):.0f}/s): "
+                  f"{state['stored']} stored, {state['conflicts']} already present, {state['errors']} errors, "
+                  f"{state['skipped']} skipped")
+
+    def submit(chunk, end):
+        pending.append((len(chunk), end, pool.apply_async(_load_chunk, (chunk, doc_type))))
+
+    try:
+        with open(path, 'rb') as f:
+            chunk = []
+            end = resume
+            for item, end in iter_items(f, dump_format, resume):
+                chunk.append(item)
+                if len(chunk) == chunk_size:
+                    submit(chunk, end)
+                    chunk = []
+                    while len(pending) >= 2 * processes:
+                        collect()
+            if chunk:
+                submit(chunk, end)
+            while pending:
+                collect()
+    except BaseException:
+        pool.terminate()
+        print(f"Load stopped after {offsets.state['items']} tweets, run it again to resume from there")
+        raise
+    pool.close()
+    pool.join()
+    elapsed = time.monotonic() - started
+    state = offsets.state
+    print(f"Loaded {done} tweets in {elapsed:.0f}s ({done / max(elapsed, 1e-9):.0f}/s): {state['stored']} stored, "
+          f"{state['conflicts']} already present, {state['errors']} errors, {state['skipped']} skipped"
+          + (f", refused tweets saved to {failed_path}" if state['errors'] else ''))
+    return state
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bulk load a historic tweet dump into CouchDB')
+    parser.add_argument('dump', help='JSON array, JSON lines or CouchDB _all_docs export of tweets')
+    parser.add_argument('--couchdb', default='INFO', help='module holding the CouchDB address and login')
+    parser.add_argument('--database', default='twitter_historic', help='database the tweets are stored in')
+    parser.add_argument('--type', default='historic', help='type field of the stored documents')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes, default every core')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='tweets per chunk and _bulk_docs request')
+    parser.add_argument('--offsets', default=None, help='resume file, default <dump>.offsets.json')
+    parser.add_argument('--failed', default=None, help='refused tweets, default <dump>.failed.jsonl')
+    parser.add_argument('--format', default=None, help="'jsonl' or a prefix such as 'rows.item'")
+    parser.add_argument('--full-documents', action='store_true',
+                        help='store the full tweet instead of the projected fields')
+    args = parser.parse_args()
+
+    load_dump(args.dump, couchdb_url(importlib.import_module(args.couchdb)), args.database, doc_type=args.type,
+              processes=args.processes, chunk_size=args.chunk_size, full_documents=args.full_documents,
+              offsets_path=args.offsets, failed_path=args.failed, dump_format=args.format)
@@ -0,0 +1,164 @@
+import threading
+import time
+import couchdb as DB
+from metrics import Metrics
+
+
+class BulkWriter:
+    """
+    Buffer tweet documents and write them to CouchDB in _bulk_docs batches instead of one request per tweet.
+    A batch is flushed when it reaches batch_size documents or when its oldest document has waited max_latency
+    seconds, whichever comes first. Documents that already exist are counted as conflicts without failing the rest
+    of the batch.
+
+    Each _bulk_docs request is timed as the stage of metrics, and the stored, conflicting and failed documents are
+    counted as <stage>_documents, <stage>_conflicts and <stage>_errors. With verbose off the per batch line is not
+    printed.
+
+    With a spool, a batch whose request fails is appended to the spool instead, and while the spool still holds
+    documents new batches go straight to it, so a stalled or unreachable database never blocks the harvester. A
+    SpoolReplayer writes them to the database once it is back.
+
+    A batch that can be neither written nor spooled stays in memory for the next flush. Once max_buffer documents
+    are waiting, add refuses new ones with a BufferError (counted as <stage>_refused) until a flush gets through, so
+    memory stays bounded while the database is down and the spool is full.
+
+    on_written, if given, is called with the _ids of every batch's documents that are now safe: stored, already in
+    the database or spooled. on_failed, if given, is called with the _ids of the documents the database refused for
+    another reason than a conflict.
+    """
+    def __init__(self, db, batch_size=100, max_latency=2.0, metrics=None, stage='store', verbose=True, spool=None,
+                 max_buffer=None, on_written=None, on_failed=None):
+        self.db = db
+        self.spool = spool
+        self.metrics = metrics or Metrics()
+        self.stage = stage
+        self.verbose = verbose
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.max_buffer = max_buffer or 10 * batch_size
+        self.on_written = on_written
+        self.on_failed = on_failed
+        self.stored = 0
+        self.conflicts = 0
+        self.errors = 0
+        self.spooled = 0
+        self.refused = 0
+        self._buffer = []
+        self._oldest = None
+        self._lock = threading.Lock()
+        # only one batch is in flight at a time so documents are written in the order they were added
+        self._flush_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_on_latency, daemon=True)
+        self._flusher.start()
+
+    def add(self, doc):
+        """
+        Queue a document for writing, flushing the batch if it is full.
+
+        :param doc: the tweet document, with its _id set
+        :return: None, raises BufferError if max_buffer documents are already waiting for a failed write
+        """
+        with self._lock:
+            if len(self._buffer) >= self.max_buffer:
+                self.refused += 1
+                self.metrics.count(f'{self.stage}_refused')
+                raise BufferError(f"{len(self._buffer)} documents are waiting for a failed write, document refused")
+            if not self._buffer:
+                self._oldest = time.monotonic()
+            self._buffer.append(doc)
+            full = len(self._buffer) >= self.batch_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Write everything buffered so far in one _bulk_docs request. If the request itself fails the documents are
+        spooled, or put back in the buffer and the error is raised if there is no spool or it is full.
+
+        :return: None
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch, self._buffer = self._buffer, []
+                self._oldest = None
+            if not batch:
+                return
+            # the database is behind, keep writing to the spool until the replayer has caught up
+            if self.spool is not None and self.spool.pending() and self._spool(batch):
+                return
+            try:
+                with self.metrics.time(self.stage):
+                    results = self.db.update(batch)
+            except Exception as e:
+                if self.spool is not None and self._spool(batch):
+                    print(f"Bulk write failed, spooled {len(batch)} documents: {e}")
+                    return
+                with self._lock:
+                    self._buffer[:0] = batch
+                    self._oldest = time.monotonic()
+                raise
+            self._report(results)
+
+    def _spool(self, batch):
+        if not self.spool.append(batch):
+            return False
+        self.spooled += len(batch)
+        self.metrics.count(f'{self.stage}_spooled', len(batch))
+        if self.on_written is not None:
+            self.on_written([doc['_id'] for doc in batch])
+        return True
+
+    def _report(self, results):
+        stored = conflicts = errors = 0
+        written = []
+        failed = []
+        for success, doc_id, rev_or_exc in results:
+            if success:
+                stored += 1
+                written.append(doc_id)
+            elif isinstance(rev_or_exc, DB.http.ResourceConflict):
+                conflicts += 1
+                written.append(doc_id)
+            else:
+                errors += 1
+                failed.append(doc_id)
+                print(f"Failed to store document {doc_id}: {rev_or_exc}")
+        self.stored += stored
+        self.conflicts += conflicts
+        self.errors += errors
+        if self.on_written is not None:
+            self.on_written(written)
+        if failed and self.on_failed is not None:
+            self.on_failed(failed)
+        self.metrics.count(f'{self.stage}_documents', stored)
+        self.metrics.count(f'{self.stage}_conflicts', conflicts)
+        self.metrics.count(f'{self.stage}_errors', errors)
+        if self.verbose:
+            print(f"Bulk stored {stored} documents, {conflicts} already present in database")
+
+    def _flush_on_latency(self):
+        while True:
+            with self._lock:
+                oldest = self._oldest
+            wait = self.max_latency if oldest is None else oldest + self.max_latency - time.monotonic()
+            if self._closed.wait(max(wait, 0)):
+                return
+            with self._lock:
+                due = self._oldest is not None and time.monotonic() - self._oldest >= self.max_latency
+            if due:
+                try:
+                    self.flush()
+                except Exception as e:
+                    print(f"Bulk write failed, retrying with the next flush: {e}")
+
+    def close(self):
+        """
+        Stop the latency flusher and write any remaining documents.
+
+        :return: None
+        """
+        self._closed.set()
+        self._flusher.join()
+        self.flush()
@@ -0,0 +1,8 @@
+from harvester.engine import Harvester, couchdb_url
+from harvester.enrich import Enricher
+from harvester.checkpoint import Checkpoint
+from harvester.sources import StreamSource, SearchSource, PremiumSearchSource, SOURCES
+from harvester.credentials import CredentialPool
+from harvester.projection import Projection, TWEET_FIELDS
+from harvester.sentiment import SentimentCache
+from harvester.tagging import KeywordTagger, TAGS
@@ -0,0 +1,41 @@
+import argparse
+import importlib
+from harvester import Harvester, SOURCES, couchdb_url
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Harvest Melbourne tweets into CouchDB')
+    parser.add_argument('source', choices=sorted(SOURCES), help='the Twitter API to harvest from')
+    parser.add_argument('--credentials', default='INFO',
+                        help='comma separated modules holding Twitter API keys, e.g. INFO_2,INFO_3,INFO_4')
+    parser.add_argument('--couchdb', default='INFO', help='module holding the CouchDB address and login')
+    parser.add_argument('--database', default='twitter_new', help='database the tweets are stored in')
+    parser.add_argument('--raw-database', default=None,
+                        help='also archive the full tweets in this database, stored tweets are projected')
+    parser.add_argument('--full-documents', action='store_true',
+                        help='store the full tweet instead of the projected fields')
+    parser.add_argument('--workers', type=int, default=4, help='enrichment and storage worker threads')
+    parser.add_argument('--interval', type=float, default=None,
+                        help='search sources only: repeat the search every INTERVAL seconds instead of once')
+    parser.add_argument('--sentiment-cache', default='sentiment_cache.npz',
+                        help='file the sentiment scores are memoized in between runs')
+    parser.add_argument('--verbose', action='store_true', help='print every tweet and bulk write')
+    parser.add_argument('--metrics-port', type=int, default=9108,
+                        help='serve metrics on http://127.0.0.1:PORT/metrics, 0 to turn the endpoint off')
+    parser.add_argument('--report-interval', type=float, default=60, help='seconds between metrics summaries')
+    parser.add_argument('--spool-dir', default='spool',
+                        help='journal batches here while CouchDB is unreachable, replayed once it is back')
+    args = parser.parse_args()
+
+    credentials = [importlib.import_module(name) for name in args.credentials.split(',')]
+    if args.source == 'stream':
+        source = SOURCES[args.source](credentials)
+    else:
+        source = SOURCES[args.source](credentials, interval=args.interval)
+    harvester = Harvester(couchdb_url(importlib.import_module(args.couchdb)), db_name=args.database,
+                          seen_ids_path=f'seen_ids_{args.source}.npz', workers=args.workers,
+                          full_documents=args.full_documents, raw_db_name=args.raw_database,
+                          sentiment_cache_path=args.sentiment_cache, verbose=args.verbose,
+                          metrics_port=args.metrics_port or None, report_interval=args.report_interval,
+                          spool_dir=args.spool_dir)
+    harvester.run(source)
@@ -0,0 +1,47 @@
+import couchdb as DB
+
+
+class Checkpoint:
+    """
+    The cursor of one source, persisted as a _local document in the tweet database. _local documents are not
+    replicated and do not show up in _all_docs or views, so they never mix with the tweets.
+
+    While the database is unreachable the cursor is only kept in memory and saved with the next update that gets
+    through, so a source keeps running on the spool. A restart in between resumes from the last saved cursor, which
+    is behind, never ahead of, what was stored.
+    """
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+        doc_id = '_local/harvester-' + name
+        try:
+            self.doc = db[doc_id]
+        except DB.http.ResourceNotFound:
+            self.doc = {'_id': doc_id}
+
+    def get(self, key, default=None):
+        return self.doc.get(key, default)
+
+    def update(self, **cursor):
+        """
+        Store new cursor values. A value of None removes the key.
+
+        :param cursor: the cursor values, e.g. since_id=..., max_id=...
+        :return: True if the cursor was saved, False if it is only kept in memory until the next update
+        """
+        for key, value in cursor.items():
+            if value is None:
+                self.doc.pop(key, None)
+            else:
+                self.doc[key] = value
+        try:
+            try:
+                self.db.save(self.doc)
+            except DB.http.ResourceConflict:
+                # an earlier save went through but its response was lost, carry on from the stored revision
+                self.doc['_rev'] = self.db[self.doc['_id']]['_rev']
+                self.db.save(self.doc)
+        except Exception as e:
+            print(f"Failed to save checkpoint {self.name}, keeping it in memory until the next update: {e}")
+            return False
+        return True
@@ -0,0 +1,90 @@
+import threading
+import time
+import tweepy
+
+
+class _Key:
+    def __init__(self, credentials):
+        self.credentials = credentials
+        self.name = getattr(credentials, '__name__', 'credentials')
+        auth = tweepy.OAuthHandler(credentials.API_KEY, credentials.KEY_SECRET)
+        auth.set_access_token(credentials.ACCESS_TOKEN, credentials.TOKEN_SECRET)
+        # the pool decides when to wait, so a key never sleeps through its own rate limit
+        self.api = tweepy.API(auth, wait_on_rate_limit=False)
+        # unknown until the first response, so every key gets tried
+        self.remaining = None
+        self.reset = 0.0
+
+    def available(self, now):
+        return self.remaining is None or self.remaining > 0 or now >= self.reset
+
+    def update(self, response):
+        if response is None:
+            return
+        remaining = response.headers.get('x-rate-limit-remaining')
+        reset = response.headers.get('x-rate-limit-reset')
+        if remaining is not None:
+            self.remaining = int(remaining)
+        if reset is not None:
+            self.reset = float(reset)
+
+
+class CredentialPool:
+    """
+    Spreads API requests over several sets of Twitter credentials (e.g. INFO_2, INFO_3, INFO_4). Each key's
+    remaining requests and window reset time are read from the x-rate-limit headers of its responses, every request
+    goes to the key with the most budget left, and the pool only sleeps when every key is exhausted. With n keys a
+    search sweep gets about n times the requests per rate limit window.
+    """
+    def __init__(self, credentials):
+        if not isinstance(credentials, (list, tuple)):
+            credentials = [credentials]
+        self.keys = [_Key(c) for c in credentials]
+        # name of the key that served the last request
+        self.last_key = None
+        self.requests = 0
+        self.rate_limited = 0
+        self._lock = threading.Lock()
+
+    def _acquire(self, key_name=None):
+        keys = [key for key in self.keys if key_name is None or key.name == key_name] or self.keys
+        while True:
+            now = time.time()
+            with self._lock:
+                available = [key for key in keys if key.available(now)]
+                if available:
+                    # keys with an unknown budget first, then the one with the most requests left
+                    return max(available, key=lambda k: float('inf') if k.remaining is None or now >= k.reset
+                               else k.remaining)
+                wait = min(key.reset for key in keys) - now
+            print(f"All {len(keys)} keys are rate limited, sleeping {wait:.0f}s")
+            time.sleep(max(wait, 0) + 1)
+
+    def call(self, request, key_name=None):
+        """
+        Run a request with the key that has the most budget left, retrying on another key if it is rate limited.
+
+        :param request: callable taking (api, credentials), e.g.
+                        lambda api, credentials: api.search_tweets(q='', count=100)
+        :param key_name: [optional] only use this key, for follow-up requests that must come from the same app
+        :return: whatever the request returns
+        """
+        while True:
+            key = self._acquire(key_name)
+            try:
+                result = request(key.api, key.credentials)
+            except tweepy.TooManyRequests as e:
+                with self._lock:
+                    self.rate_limited += 1
+                    key.update(e.response)
+                    key.remaining = 0
+                    if key.reset <= time.time():
+                        # no reset header, back off for a standard 15 minute window
+                        key.reset = time.time() + 15 * 60
+                print(f"Key {key.name} is rate limited until {time.ctime(key.reset)}")
+                continue
+            with self._lock:
+                self.requests += 1
+                key.update(key.api.last_response)
+            self.last_key = key.name
+            return result
@@ -0,0 +1,187 @@
+import os
+import signal
+import threading
+import couchdb as DB
+from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
+from sa2_data import load_sa2_locator, SA2_SHAPEFILE, SA2_ARTIFACT
+from bulk_writer import BulkWriter
+from seen_ids import SeenIds
+from pipeline import Pipeline
+from metrics import Metrics
+from spool import Spool, SpoolReplayer
+from harvester.checkpoint import Checkpoint
+from harvester.enrich import Enricher
+from harvester.sentiment import SentimentCache
+
+
+def couchdb_url(info):
+    # CouchDB address and login from a key file such as INFO.py
+    return f'http://{info.USERNAME}:{info.PASSWORD}@{info.IP_ADDR}:{info.PORT}/'
+
+
+def _terminate(signum, frame):
+    # raised in the main thread wherever the source is, e.g. waiting on Twitter, which stops it; Harvester.run then
+    # drains the pipeline, and a second SIGTERM does not cut that short
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    print(f"Received signal {signum}, stopping the source and draining the pipeline")
+    raise SystemExit(128 + signum)
+
+
+class Harvester:
+    """
+    The harvesting engine shared by every source. Sources submit raw tweets, which are checked against the known
+    ids, queued, enriched with sentiment and SA2 by the worker pool and written to CouchDB in bulk.
+
+    Stored tweets only keep the fields of the projection (the default Projection if none is given), or the full
+    tweet with full_documents. If raw_db_name is given, the full tweets are archived in that database as well.
+    Sentiment scores are memoized by tweet text in sentiment_cache_path, which is shared by every run pointing at it.
+
+    Every stage is counted and timed in metrics: fetch (by the search sources), text, sentiment, tags, sa2, store
+    and the whole process step, plus received, duplicate, processed and error counts. A summary is printed every
+    report_interval seconds and, if metrics_port is set, served at http://127.0.0.1:<metrics_port>/metrics.
+    Tweets and batches are only printed one by one with verbose.
+
+    CouchDB requests time out after request_timeout seconds. When a bulk write fails, or while earlier failed
+    writes are still waiting, batches are journaled to a spool under spool_dir (one per database) and a background
+    replayer writes them to CouchDB once it is reachable again.
+    """
+    def __init__(self, couchdb_url, db_name='twitter_new', seen_ids_path='seen_ids.npz', workers=4,
+                 max_queue=1000, sa2_data=SA2_SHAPEFILE, artifact_dir=SA2_ARTIFACT, projection=None,
+                 raw_db_name=None, sentiment_cache_path='sentiment_cache.npz', verbose=False, metrics_port=None,
+                 report_interval=60, spool_dir='spool', request_timeout=30, full_documents=False):
+        print("Connecting to server...")
+        # without a timeout a stalled node blocks the writers forever instead of failing over to the spool
+        self.server = DB.Server(couchdb_url, session=DB.http.Session(timeout=request_timeout))
+        self.db = self.server[db_name]
+        print("Connected to server")
+
+        self.verbose = verbose
+        self.metrics = Metrics()
+        self.replayers = []
+        # ids already in the database, duplicates are dropped before enrichment; an id is recorded once its tweet
+        # is written, so a tweet that failed on the way is not skipped when it is fetched again
+        self.seen_ids = SeenIds(seen_ids_path).open(self.db)
+        self.writer = self._writer(self.db, 'store', spool_dir, verbose, on_written=self.seen_ids.add_many)
+        self.raw_writer = self._writer(self.server[raw_db_name], 'raw_store', spool_dir,
+                                       verbose) if raw_db_name else None
+        # retweets repeat the same text, so scores are looked up by text before running VADER
+        self.sentiment_cache = SentimentCache(SentimentIntensityAnalyzer(), path=sentiment_cache_path)
+        # load suburb data
+        self.enricher = Enricher(load_sa2_locator(sa2_data, artifact_dir), analyser=self.sentiment_cache,
+                                 projection=projection, metrics=self.metrics, full_documents=full_documents)
+        self.pipeline = Pipeline(self._process, workers=workers, max_queue=max_queue)
+        self.metrics.gauge('queue_backlog', self.pipeline.backlog)
+        if metrics_port is not None:
+            self.metrics.serve(metrics_port)
+        if report_interval:
+            self.metrics.start_reporting(report_interval)
+        print("Harvester setup complete")
+
+    def _writer(self, db, stage, spool_dir, verbose, on_written=None):
+        spool = None
+        if spool_dir is not None:
+            spool = Spool(os.path.join(spool_dir, db.name))
+            self.replayers.append(SpoolReplayer(spool, db, metrics=self.metrics, stage=f'{stage}_replay'))
+            self.metrics.gauge(f'{stage}_spool_bytes', spool.size)
+        return BulkWriter(db, metrics=self.metrics, stage=stage, verbose=verbose, spool=spool, on_written=on_written)
+
+    def submit(self, data, doc_type):
+        """
+        Hand a raw tweet to the pipeline.
+
+        :param data: tweet in JSON format
+        :param doc_type: the source of the tweet, stored as the document type
+        :return: True if the tweet was queued, False if it is already known or was rejected by the queue
+        """
+        if self.verbose:
+            print(f"Tweet id: {data['id']}, date created: {data['created_at']}")
+        self.metrics.count('received')
+        if self.seen_ids.seen(data['id']):
+            self.metrics.count('duplicates')
+            return False
+        if not self.pipeline.submit((data, doc_type)):
+            self.metrics.count('rejected')
+            return False
+        return True
+
+    def _process(self, item):
+        data, doc_type = item
+        try:
+            with self.metrics.time('process'):
+                tweet_info = self.enricher.prepare_tweet_document(data, doc_type)
+                self.writer.add(tweet_info)
+                if self.raw_writer is not None:
+                    self.raw_writer.add({'_id': tweet_info['_id'], 'tweet': data})
+        except Exception:
+            self.metrics.count('errors')
+            raise
+        self.metrics.count('processed')
+
+    def checkpoint(self, name):
+        return Checkpoint(self.db, name)
+
+    def commit(self, checkpoint, **cursor):
+        """
+        Advance a source's cursor once everything submitted before it is stored, so a restart never skips tweets.
+
+        :param checkpoint: the source's Checkpoint
+        :param cursor: the new cursor values
+        :return: None
+        """
+        self.pipeline.join()
+        self.writer.flush()
+        checkpoint.update(**cursor)
+
+    def run(self, source):
+        """
+        Run a source until it finishes or is interrupted, by Ctrl+C or a SIGTERM such as docker stop, then drain the
+        pipeline.
+
+        :param source: a StreamSource, SearchSource or PremiumSearchSource
+        :return: None
+        """
+        # signal handlers can only be installed from the main thread
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, _terminate)
+        try:
+            source.run(self)
+        finally:
+            self.close()
+
+    def close(self):
+        # finish every queued tweet, then write out the last partial batch
+        self.pipeline.close()
+        self.writer.close()
+        if self.raw_writer is not None:
+            self.raw_writer.close()
+        for replayer in self.replayers:
+            replayer.close()
+        self.seen_ids.save()
+        self.sentiment_cache.save()
+        self.metrics.close()
+        self.report()
+
+    def stats(self):
+        """
+        :return: dictionary of the pipeline, storage and cache counters
+        """
+        return {'processed': self.pipeline.processed, 'errors': self.pipeline.errors,
+                'rejected': self.pipeline.rejected, 'duplicates': self.seen_ids.skipped,
+                'stored': self.writer.stored, 'conflicts': self.writer.conflicts,
+                'write_errors': self.writer.errors, 'refused': self.writer.refused, 'spooled': self.writer.spooled,
+                'spool_bytes': self.writer.spool.size() if self.writer.spool is not None else 0,
+                'sentiment_cache': self.sentiment_cache.stats(),
+                'sa2_locator': self.enricher.sa2_locator.cache_info()}
+
+    def report(self):
+        stats = self.stats()
+        sentiment = stats['sentiment_cache']
+        print(f"Harvester processed {stats['processed']} tweets ({stats['errors']} errors, "
+              f"{stats['rejected']} rejected, {stats['duplicates']} duplicates), stored {stats['stored']} "
+              f"({stats['conflicts']} conflicts, {stats['write_errors']} errors, {stats['refused']} refused), "
+              f"spooled {stats['spooled']} ({stats['spool_bytes']} bytes left to replay)")
+        print(f"Sentiment cache: {sentiment['hits']} hits, {sentiment['misses']} misses, "
+              f"hit rate {sentiment['hit_rate']:.1%}, {sentiment['entries']} entries, "
+              f"saved {sentiment['saved_seconds']:.1f}s of scoring")
+        print(f"SA2 locator: {stats['sa2_locator']}")
+        print(self.metrics.summary())
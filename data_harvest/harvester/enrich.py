@@ -0,0 +1,95 @@
+from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
+from sa2_data import get_tweet_coordinates, get_sa2_main16, get_sa2_main16_batch
+from harvester.projection import Projection
+from harvester.tagging import KeywordTagger
+from metrics import Metrics
+
+
+class Enricher:
+    """
+    Turns a raw tweet into the document stored in CouchDB, with keys {_id, type, tweet, sentiment, tags, sa2}. Every
+    source shares it, so stream and search documents are enriched the same way. The tweet is reduced to the
+    fields of the projection, the default Projection if none is given; pass full_documents=True to store the full
+    tweet. Text extraction, sentiment and the SA2 lookup are timed as the text, sentiment and sa2 stages of metrics.
+    tags lists the topics and election issues the text mentions, see KeywordTagger.
+    """
+    def __init__(self, sa2_locator, analyser=None, projection=None, metrics=None, tagger=None, full_documents=False):
+        self.sa2_locator = sa2_locator
+        self.analyser = analyser or SentimentIntensityAnalyzer()
+        # None keeps the full tweet
+        self.projection = None if full_documents else projection or Projection()
+        self.tagger = tagger or KeywordTagger()
+        self.metrics = metrics or Metrics()
+
+    @staticmethod
+    def get_tweet_text(data):
+        """
+        Extract the full text of a tweet, falling back to the (possibly truncated) text field.
+
+        :param data: tweet in JSON format
+        :return: the tweet text
+        """
+        try:
+            if 'extended_tweet' in data:
+                return data['extended_tweet']['full_text']
+            if 'full_text' in data:
+                return data['full_text']
+            if 'extended_tweet' in data.get('retweeted_status', {}):
+                return data['retweeted_status']['extended_tweet']['full_text']
+            return data['text']
+        except (KeyError, TypeError):
+            print("Warning: Tweet KeyError - using default tweet text")
+            return data['text']
+
+    def prepare_tweet_document(self, data, doc_type):
+        """
+        :param data: tweet in JSON format
+        :param doc_type: the source of the tweet, e.g. 'stream' or 'search'
+        :return: the document to store
+        """
+        with self.metrics.time('text'):
+            text = self.get_tweet_text(data)
+        tweet_info = dict()
+        tweet_info['_id'] = str(data['id'])
+        tweet_info['type'] = doc_type
+        tweet_info['tweet'] = data if self.projection is None else self.projection.project(data)
+        with self.metrics.time('sentiment'):
+            tweet_info['sentiment'] = self.analyser.polarity_scores(text)
+        with self.metrics.time('tags'):
+            tweet_info['tags'] = self.tagger.tag(text)
+        coords = get_tweet_coordinates(data)
+        if coords is not None:
+            with self.metrics.time('sa2'):
+                tweet_info['sa2'] = get_sa2_main16(coords, self.sa2_locator)
+        return tweet_info
+
+    def prepare_tweet_documents(self, tweets, doc_type):
+        """
+        Batch version of prepare_tweet_document for backfills. Sentiment is scored with the analyser's
+        polarity_scores_many when it has one, and the SA2 codes come from one vectorized lookup.
+
+        :param tweets: list of tweets in JSON format
+        :param doc_type: the source of the tweets, e.g. 'historic'
+        :return: list of the documents to store, in the order of tweets
+        """
+        with self.metrics.time('text'):
+            texts = [self.get_tweet_text(data) for data in tweets]
+        with self.metrics.time('sentiment'):
+            if hasattr(self.analyser, 'polarity_scores_many'):
+                sentiments = self.analyser.polarity_scores_many(texts)
+            else:
+                sentiments = [self.analyser.polarity_scores(text) for text in texts]
+        with self.metrics.time('sa2'):
+            sa2_codes = get_sa2_main16_batch(tweets, self.sa2_locator)
+        docs = []
+        for data, text, sentiment, sa2 in zip(tweets, texts, sentiments, sa2_codes):
+            tweet_info = dict()
+            tweet_info['_id'] = str(data['id'])
+            tweet_info['type'] = doc_type
+            tweet_info['tweet'] = data if self.projection is None else self.projection.project(data)
+            tweet_info['sentiment'] = sentiment
+            tweet_info['tags'] = self.tagger.tag(text)
+            if data.get('coordinates'):
+                tweet_info['sa2'] = sa2
+            docs.append(tweet_info)
+        return docs
@@ -0,0 +1,45 @@
+# fields of the raw tweet kept in stored documents: what the CouchDB views, the Flask API and the enrichment read
+TWEET_FIELDS = [
+    'id',
+    'id_str',
+    'created_at',
+    'text',
+    'full_text',
+    'extended_tweet.full_text',
+    'retweeted_status.extended_tweet.full_text',
+    'coordinates',
+    'place',
+    'user.id',
+    'user.id_str',
+    'lang',
+]
+
+
+class Projection:
+    """
+    Declarative projection of a tweet onto a list of dotted field paths, e.g. 'user.id' keeps only the id of the
+    user object. Missing fields are left out, and nesting is kept so views still read doc.tweet.text and
+    doc.tweet.coordinates.coordinates.
+    """
+    def __init__(self, fields=None):
+        self.fields = fields or TWEET_FIELDS
+        self._paths = [field.split('.') for field in self.fields]
+
+    def project(self, data):
+        """
+        :param data: tweet in JSON format
+        :return: a new dictionary with only the projected fields
+        """
+        projected = {}
+        for path in self._paths:
+            value = data
+            for key in path:
+                if not isinstance(value, dict) or key not in value:
+                    break
+                value = value[key]
+            else:
+                node = projected
+                for key in path[:-1]:
+                    node = node.setdefault(key, {})
+                node[path[-1]] = value
+        return projected
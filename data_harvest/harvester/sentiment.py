@@ -0,0 +1,141 @@
+import hashlib
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+SCORE_KEYS = ('neg', 'neu', 'pos', 'compound')
+# approximate memory of one entry: the 16 byte digest, the score tuple with its floats and the OrderedDict link
+_ENTRY_BYTES = (sys.getsizeof(b'\0' * 16) + sys.getsizeof((0.0,) * 4) + 4 * sys.getsizeof(0.0) + 100)
+
+
+def text_key(text):
+    # VADER splits on whitespace, so collapsing whitespace does not change the scores
+    normalized = ' '.join(text.split())
+    return hashlib.blake2b(normalized.encode('utf-8'), digest_size=16).digest()
+
+
+class SentimentCache:
+    """
+    Memoizes polarity_scores in front of the VADER analyser, keyed on a hash of the whitespace normalized text.
+    Retweets and quote chains send the same text many times, and only the first copy is scored.
+
+    The cache is an LRU bounded by max_bytes of estimated memory. If path is given it is loaded at startup and
+    saved by save, so re-harvesting and backfills reuse earlier scores. stats reports the hit rate and the CPU time
+    the hits saved, estimated from the mean time of a miss.
+    """
+    def __init__(self, analyser, max_bytes=64 * 1024 * 1024, path=None):
+        self.analyser = analyser
+        self.max_entries = max(max_bytes // _ENTRY_BYTES, 1)
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.scoring_seconds = 0.0
+        self._scores = OrderedDict()
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def polarity_scores(self, text):
+        """
+        Same interface as SentimentIntensityAnalyzer.polarity_scores.
+
+        :param text: the tweet text
+        :return: dictionary of neg, neu, pos and compound scores
+        """
+        key = text_key(text)
+        with self._lock:
+            scores = self._scores.get(key)
+            if scores is not None:
+                self._scores.move_to_end(key)
+                self.hits += 1
+                return dict(zip(SCORE_KEYS, scores))
+
+        start = time.perf_counter()
+        sentiment = self.analyser.polarity_scores(text)
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.misses += 1
+            self.scoring_seconds += elapsed
+            self._store(key, tuple(sentiment[k] for k in SCORE_KEYS))
+        return sentiment
+
+    def polarity_scores_many(self, texts):
+        """
+        Score a batch of texts, e.g. for a backfill. Only the distinct texts missing from the cache are scored, in one
+        call to the analyser's polarity_scores_many when it has one (see batch_sentiment.BatchSentimentAnalyzer).
+
+        :param texts: list of tweet texts
+        :return: list of dictionaries of neg, neu, pos and compound scores, in the order of texts
+        """
+        keys = [text_key(text) for text in texts]
+        results = [None] * len(texts)
+        missing = {}
+        with self._lock:
+            for i, key in enumerate(keys):
+                scores = self._scores.get(key)
+                if scores is not None:
+                    self._scores.move_to_end(key)
+                    self.hits += 1
+                    results[i] = dict(zip(SCORE_KEYS, scores))
+                elif key in missing:
+                    # a repeat within the batch is scored once
+                    self.hits += 1
+                else:
+                    missing[key] = texts[i]
+
+        start = time.perf_counter()
+        if hasattr(self.analyser, 'polarity_scores_many'):
+            scored = self.analyser.polarity_scores_many(list(missing.values()))
+        else:
+            scored = [self.analyser.polarity_scores(text) for text in missing.values()]
+        elapsed = time.perf_counter() - start
+        scored = dict(zip(missing, scored))
+        with self._lock:
+            self.misses += len(scored)
+            self.scoring_seconds += elapsed
+            for key, sentiment in scored.items():
+                self._store(key, tuple(sentiment[k] for k in SCORE_KEYS))
+        for i, key in enumerate(keys):
+            if results[i] is None:
+                results[i] = dict(scored[key])
+        return results
+
+    def _store(self, key, scores):
+        self._scores[key] = scores
+        if len(self._scores) > self.max_entries:
+            self._scores.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            mean_miss = self.scoring_seconds / self.misses if self.misses else 0.0
+            return {'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'entries': len(self._scores), 'max_entries': self.max_entries,
+                    'saved_seconds': self.hits * mean_miss}
+
+    def load(self):
+        with np.load(self.path) as saved:
+            keys, scores = saved['keys'], saved['scores']
+        with self._lock:
+            # the saved file is in LRU order, so the most recent entries survive a smaller max_bytes
+            for key, row in zip(keys[-self.max_entries:], scores[-self.max_entries:]):
+                self._store(key.tobytes(), tuple(row.tolist()))
+
+    def save(self):
+        """
+        Persist the cache to path, least recently used entries first.
+
+        :return: None
+        """
+        if self.path is None:
+            return
+        with self._lock:
+            keys = np.frombuffer(b''.join(self._scores.keys()), dtype=np.uint8).reshape(-1, 16)
+            scores = np.array(list(self._scores.values()), dtype=np.float64).reshape(-1, len(SCORE_KEYS))
+        tmp_path = self.path + '.tmp.npz'
+        np.savez(tmp_path, keys=keys, scores=scores)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,139 @@
+import time
+from datetime import datetime, timedelta
+import tweepy
+from harvester.credentials import CredentialPool
+
+# coordinates for Melbourne based on a bounding box for the Greater Melbourne region
+MELBOURNE_BOUNDING_BOX = [144.33363404800002, -38.50298801599996, 145.8784120140001, -37.17509899299995]
+MELBOURNE_GEOCODE = '-37.840935,144.946457,100mi'
+
+
+class _HarvestStream(tweepy.Stream):
+    def __init__(self, harvester, credentials):
+        super(_HarvestStream, self).__init__(credentials.API_KEY, credentials.KEY_SECRET,
+                                             credentials.ACCESS_TOKEN, credentials.TOKEN_SECRET)
+        self.harvester = harvester
+
+    def on_status(self, status):  # get the tweets from tweeter
+        # only queue the status, the pipeline workers enrich and store it off the stream thread
+        self.harvester.submit(status._json, 'stream')
+
+
+class StreamSource:
+    """
+    Twitter filter Stream API using geolocation filtering for Melbourne. A live stream has nothing to resume, so
+    it keeps no checkpoint. Twitter allows one filter stream per account, so only the first credentials are used.
+    """
+    name = 'stream'
+
+    def __init__(self, credentials, locations=None):
+        if isinstance(credentials, (list, tuple)):
+            credentials = credentials[0]
+        self.credentials = credentials
+        self.locations = locations or MELBOURNE_BOUNDING_BOX
+
+    def run(self, harvester):
+        print("Filtering tweets...")
+        _HarvestStream(harvester, self.credentials).filter(locations=self.locations)
+
+
+class SearchSource:
+    """
+    Twitter standard (7 day) search around Melbourne. Results are paged from newest to oldest with max_id. The
+    checkpoint holds since_id, the newest tweet of the last finished sweep, so a new sweep stops where the previous
+    one started, and max_id, the lower bound of an unfinished sweep, so an interrupted sweep carries on from there.
+    credentials can be one key file or a list of them, pages are spread over the keys by a CredentialPool.
+    """
+    name = '7day'
+
+    def __init__(self, credentials, query='', geocode=MELBOURNE_GEOCODE, count=100, interval=None):
+        self.pool = CredentialPool(credentials)
+        self.query = query
+        self.geocode = geocode
+        self.count = count
+        self.interval = interval
+
+    def run(self, harvester):
+        checkpoint = harvester.checkpoint(self.name)
+        harvester.metrics.gauge('rate_limited', lambda: self.pool.rate_limited)
+        while True:
+            self.sweep(harvester, checkpoint)
+            if self.interval is None:
+                return
+            time.sleep(self.interval)
+
+    def sweep(self, harvester, checkpoint):
+        print("Searching tweets...")
+        since_id = checkpoint.get('since_id')
+        max_id = checkpoint.get('max_id')
+        newest_id = checkpoint.get('newest_id')
+        while True:
+            with harvester.metrics.time('fetch'):
+                page = self.pool.call(lambda api, credentials: api.search_tweets(
+                    q=self.query, geocode=self.geocode, count=self.count, since_id=since_id, max_id=max_id))
+            if len(page) == 0:
+                break
+            for status in page:
+                harvester.submit(status._json, 'search')
+            newest_id = max(newest_id or 0, page[0].id)
+            max_id = page[-1].id - 1
+            harvester.commit(checkpoint, since_id=since_id, max_id=max_id, newest_id=newest_id)
+        # sweep finished, the next one only needs tweets newer than everything seen so far
+        harvester.commit(checkpoint, since_id=newest_id or since_id, max_id=None, newest_id=None)
+
+
+class PremiumSearchSource:
+    """
+    Twitter premium 30 day search for tweets placed in Melbourne. Premium search has no since_id, so the cursor is
+    a date window instead: from_date/to_date pin the window of the current sweep, next is the page token inside
+    it, and a finished sweep moves from_date up to its to_date. Each key file's own Label_30 dev environment is
+    used when its key serves a request. A next token only works for the app that issued it, so the pages after
+    the first one of a sweep stay on that key; sweeps themselves are spread over the pool.
+    """
+    name = '30day'
+    date_format = '%Y%m%d%H%M'
+
+    def __init__(self, credentials, query='place:melbourne', label='30days', max_results=100, interval=None):
+        self.pool = CredentialPool(credentials)
+        self.query = query
+        self.label = label
+        self.max_results = max_results
+        self.interval = interval
+
+    def run(self, harvester):
+        checkpoint = harvester.checkpoint(self.name)
+        harvester.metrics.gauge('rate_limited', lambda: self.pool.rate_limited)
+        while True:
+            self.sweep(harvester, checkpoint)
+            if self.interval is None:
+                return
+            time.sleep(self.interval)
+
+    def sweep(self, harvester, checkpoint):
+        print("Searching tweets...")
+        now = datetime.utcnow()
+        from_date = checkpoint.get('from_date') or (now - timedelta(days=30)).strftime(self.date_format)
+        # premium search does not accept a toDate in the future
+        to_date = checkpoint.get('to_date') or (now - timedelta(minutes=1)).strftime(self.date_format)
+        next_token = checkpoint.get('next')
+        key_name = checkpoint.get('key') if next_token else None
+        while True:
+            with harvester.metrics.time('fetch'):
+                result = self.pool.call(lambda api, credentials: api.search_30_day(
+                    getattr(credentials, 'Label_30', self.label), self.query, fromDate=from_date, toDate=to_date,
+                    maxResults=self.max_results, next=next_token, return_cursors=True), key_name=key_name)
+            key_name = self.pool.last_key
+            # the last page has no next token, tweepy then returns the statuses alone instead of a tuple
+            if isinstance(result, tuple):
+                statuses, next_token = result
+            else:
+                statuses, next_token = result, None
+            for status in statuses:
+                harvester.submit(status._json, 'search')
+            harvester.commit(checkpoint, from_date=from_date, to_date=to_date, next=next_token, key=key_name)
+            if not next_token:
+                break
+        harvester.commit(checkpoint, from_date=to_date, to_date=None, next=None, key=None)
+
+
+SOURCES = {source.name: source for source in (StreamSource, SearchSource, PremiumSearchSource)}
@@ -0,0 +1,91 @@
+from collections import deque
+
+# keywords of the election scenario, the same as KEYWORDS in views/preprocess.py. The tags are matched on the full
+# text of extended tweets, while the keyword views test the truncated tweet.text, so the tagged views can count a
+# few more tweets whose keyword is past the cut
+ELECTION_KEYWORDS = ['scott morrison', 'scomo', 'prime minister', 'scummo', 'scumo', 'scotty from marketing',
+                     '#auspol', '#ausvotes', '#ausvotes2022', '#ausvotes22', '#scottyfrommarketing',
+                     '#ScottyFromPhotoOps', '#ScottyTheGaslighter', '#ScottyThePathologicalLiar', '@ScottMorrisonMP']
+# election issues, the same as election_issues in the data analysis notebook
+ELECTION_ISSUES = {'childcare': ['childcare'],
+                   'housing': ['house', 'housing'],
+                   'taxes': ['tax'],
+                   'aged care': ['aged care'],
+                   'health': ['health', 'medicare'],
+                   'economy': ['economy']}
+TAGS = dict(ELECTION_ISSUES, election=ELECTION_KEYWORDS)
+
+
+class KeywordTagger:
+    """
+    Tags a text with every tag one of whose keywords it contains, in a single pass over the text with an
+    Aho-Corasick automaton built from all the keywords. Matching is case insensitive and on substrings, like the
+    /keyword/i regexes of the views and the notebook's filter_tweet, so '#ausvotes' also matches '#ausvotes2022'.
+
+    The harvester stores the result as the tags field of each document, so views emit on doc.tags instead of
+    running every regex over every tweet on each view build.
+    """
+    def __init__(self, tags=None):
+        self.tags = TAGS if tags is None else tags
+        # state 0 is the root; each state has its transitions, failure link and the tags ending at it
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [frozenset()]
+        for tag, keywords in self.tags.items():
+            for keyword in keywords:
+                self._add(keyword.lower(), tag)
+        self._link()
+
+    def _add(self, keyword, tag):
+        state = 0
+        for char in keyword:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(frozenset())
+            state = next_state
+        self._output[state] = self._output[state] | {tag}
+
+    def _link(self):
+        # breadth first, so the failure state of every state is linked before its children
+        pending = deque(self._goto[0].values())
+        while pending:
+            state = pending.popleft()
+            for char, child in self._goto[state].items():
+                pending.append(child)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                self._output[child] = self._output[child] | self._output[self._fail[child]]
+
+    def tag(self, text):
+        """
+        :param text: the tweet text, the full text of extended tweets
+        :return: sorted list of the tags whose keywords appear in the text
+        """
+        goto, fail, output = self._goto, self._fail, self._output
+        found = set()
+        state = 0
+        for char in text.lower():
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                found |= output[state]
+        return sorted(found)
+
+
+if __name__ == '__main__':
+    # test cases: the tagger agrees with plain substring search
+    tagger = KeywordTagger()
+    texts = ['Housing and the ECONOMY #AusVotes2022', 'Aged care is a health issue, says the Prime Minister',
+             'nothing to see here', 'taxi', 'ScoMo', 'the house of representatives', '', 'eeelection ushers']
+    for text in texts:
+        expected = sorted(tag for tag, keywords in TAGS.items() if any(k.lower() in text.lower() for k in keywords))
+        assert tagger.tag(text) == expected, (text, tagger.tag(text), expected)
+        print(f"{text!r}: {tagger.tag(text)}")
+    print('test cases pass.')
@@ -0,0 +1,187 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# upper bounds in seconds of the latency histogram buckets, from a cached lookup to a slow API page
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0)
+
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets, cumulative like a Prometheus histogram. Not thread safe on its own, Metrics
+    guards it with its lock.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # one count per bucket plus the overflow bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q):
+        """
+        :param q: quantile between 0 and 1
+        :return: upper bound of the bucket holding the quantile, inf if it is past the last bucket, 0 if empty
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Metrics:
+    """
+    Counters and per stage latency histograms for a harvester. Stages are timed with the time context manager, e.g.
+
+        with metrics.time('sentiment'):
+            analyser.polarity_scores(text)
+
+    The current values can be read with snapshot, printed every interval seconds by start_reporting, and scraped in
+    the Prometheus text format from the endpoint started by serve.
+    """
+    def __init__(self, prefix='harvester'):
+        self.prefix = prefix
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+        # callables read at snapshot time, for values owned by other objects such as the queue length
+        self.gauges = {}
+        self._lock = threading.Lock()
+        self._server = None
+        self._reporting = threading.Event()
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def gauge(self, name, read):
+        """
+        :param name: name of the gauge
+        :param read: callable returning its current value
+        :return: None
+        """
+        self.gauges[name] = read
+
+    def snapshot(self):
+        """
+        :return: dictionary of uptime, counters, gauges and, for each stage, its count, mean, p50, p99 and total time
+        """
+        gauges = {name: read() for name, read in self.gauges.items()}
+        with self._lock:
+            stages = {stage: {'count': h.count, 'mean': h.sum / h.count if h.count else 0.0,
+                              'p50': h.quantile(0.5), 'p99': h.quantile(0.99), 'seconds': h.sum}
+                      for stage, h in self.histograms.items()}
+            return {'uptime': time.time() - self.started, 'counters': dict(self.counters), 'gauges': gauges,
+                    'stages': stages}
+
+    def summary(self):
+        snapshot = self.snapshot()
+        uptime = max(snapshot['uptime'], 1e-9)
+        parts = [f"{name} {value} ({value / uptime:.1f}/s)" for name, value in sorted(snapshot['counters'].items())]
+        parts += [f"{name} {value}" for name, value in sorted(snapshot['gauges'].items())]
+        parts += [f"{stage} mean {s['mean'] * 1000:.2f}ms p99<={s['p99'] * 1000:.1f}ms"
+                  for stage, s in sorted(snapshot['stages'].items())]
+        return f"Metrics after {uptime:.0f}s: " + ', '.join(parts)
+
+    def render(self):
+        """
+        :return: the metrics in the Prometheus text exposition format
+        """
+        snapshot = self.snapshot()
+        lines = [f'{self.prefix}_uptime_seconds {snapshot["uptime"]:.3f}']
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append(f'# TYPE {self.prefix}_{name}_total counter')
+            lines.append(f'{self.prefix}_{name}_total {value}')
+        for name, value in sorted(snapshot['gauges'].items()):
+            lines.append(f'# TYPE {self.prefix}_{name} gauge')
+            lines.append(f'{self.prefix}_{name} {value}')
+        name = f'{self.prefix}_stage_seconds'
+        lines.append(f'# TYPE {name} histogram')
+        with self._lock:
+            for stage, histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {histogram.sum:.6f}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host='127.0.0.1'):
+        """
+        Serve the metrics at http://host:port/metrics from a background thread.
+
+        :param port: port to listen on
+        :param host: address to bind, local only by default
+        :return: None
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # scrapes are frequent, keep them out of the harvester log
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='metrics-server', daemon=True).start()
+        print(f"Serving metrics at http://{host}:{port}/metrics")
+
+    def start_reporting(self, interval):
+        """
+        Print a summary line every interval seconds until close.
+
+        :param interval: seconds between summaries
+        :return: None
+        """
+        def report():
+            while not self._reporting.wait(interval):
+                print(self.summary())
+        threading.Thread(target=report, name='metrics-reporter', daemon=True).start()
+
+    def close(self):
+        self._reporting.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
@@ -0,0 +1,89 @@
+import queue
+import threading
+
+# put on the queue once per worker to tell it to stop after draining everything before it
+_STOP = object()
+
+
+class Pipeline:
+    """
+    A bounded queue in front of a pool of worker threads. The stream thread only submits raw statuses, and the
+    workers run the enrichment and storage handler, so a slow database or a burst of tweets does not back up the
+    Twitter socket.
+
+    Backpressure: submit blocks while the queue is full. With put_timeout set it gives up after that many seconds
+    and rejects the item instead, and the caller can see it was not accepted. Every accepted item is handled before
+    close returns.
+    """
+    def __init__(self, handler, workers=4, max_queue=1000, put_timeout=None):
+        self.handler = handler
+        self.put_timeout = put_timeout
+        self.processed = 0
+        self.errors = 0
+        self.rejected = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._closed = False
+        self._workers = [threading.Thread(target=self._work, name=f'pipeline-worker-{i}', daemon=True)
+                         for i in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, item):
+        """
+        Queue an item for the workers.
+
+        :param item: the item passed to the handler
+        :return: True if the item was accepted, False if the queue stayed full for put_timeout seconds
+        """
+        if self._closed:
+            raise RuntimeError('The pipeline has been closed.')
+        try:
+            self._queue.put(item, timeout=self.put_timeout)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            print(f"Pipeline queue full for {self.put_timeout}s, item rejected")
+            return False
+        return True
+
+    def backlog(self):
+        return self._queue.qsize()
+
+    def join(self):
+        """
+        Wait until every item submitted so far has been handled.
+
+        :return: None
+        """
+        self._queue.join()
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                self._queue.task_done()
+                return
+            try:
+                self.handler(item)
+                with self._lock:
+                    self.processed += 1
+            except Exception as e:
+                with self._lock:
+                    self.errors += 1
+                print(f"Pipeline handler failed: {e}")
+            finally:
+                self._queue.task_done()
+
+    def close(self):
+        """
+        Stop accepting items, wait for the workers to drain the queue and then stop them.
+
+        :return: None
+        """
+        self._closed = True
+        for _ in self._workers:
+            # blocks while the queue is full, the stop markers go behind every accepted item
+            self._queue.put(_STOP)
+        for worker in self._workers:
+            worker.join()
@@ -0,0 +1,187 @@
+import argparse
+import importlib
+import multiprocessing
+import os
+import time
+from collections import deque
+import couchdb as DB
+from sa2_data import load_sa2_locator, load_sa2_artifact, SA2_SHAPEFILE, SA2_ARTIFACT, SA2_COLUMNS
+from batch_sentiment import BatchSentimentAnalyzer
+from harvester.checkpoint import Checkpoint
+from harvester.engine import couchdb_url
+from harvester.enrich import Enricher
+from harvester.sentiment import SentimentCache
+
+# fields recomputed from doc.tweet
+ENRICHED_FIELDS = ('sentiment', 'tags', 'sa2')
+
+# state of each worker process, set up once by _init_worker
+_enricher = None
+_db = None
+
+
+def _init_worker(couchdb_url, db_name, artifact_dir):
+    global _enricher, _db
+    _db = DB.Server(couchdb_url)[db_name]
+    # the stored tweet is already projected, it is only read here
+    _enricher = Enricher(load_sa2_artifact(artifact_dir), analyser=SentimentCache(BatchSentimentAnalyzer()),
+                         full_documents=True)
+
+
+def reenrich_documents(enricher, docs):
+    """
+    Recompute the enriched fields of stored documents.
+
+    :param enricher: the Enricher to recompute them with
+    :param docs: documents as stored by the harvester, with _id, _rev and tweet
+    :return: the documents whose enriched fields changed, updated in place and ready to save with their _rev
+    """
+    fresh = enricher.prepare_tweet_documents([doc['tweet'] for doc in docs], None)
+    changed = []
+    for doc, new in zip(docs, fresh):
+        if all(doc.get(field) == new.get(field) for field in ENRICHED_FIELDS):
+            continue
+        for field in ENRICHED_FIELDS:
+            if field in new:
+                doc[field] = new[field]
+            else:
+                doc.pop(field, None)
+        changed.append(doc)
+    return changed
+
+
+def _reenrich_chunk(docs):
+    # returns how many documents were unchanged, updated, in conflict (edited meanwhile), failed and skipped
+    valid = [doc for doc in docs if isinstance(doc.get('tweet'), dict) and 'id' in doc['tweet']]
+    changed = reenrich_documents(_enricher, valid)
+    updated = conflicts = errors = 0
+    if changed:
+        for success, doc_id, rev_or_exc in _db.update(changed):
+            if success:
+                updated += 1
+            elif isinstance(rev_or_exc, DB.http.ResourceConflict):
+                conflicts += 1
+            else:
+                errors += 1
+                print(f"Failed to update document {doc_id}: {rev_or_exc}")
+    return len(valid) - len(changed), updated, conflicts, errors, len(docs) - len(valid)
+
+
+def iter_pages(db, page_size, start_after=None):
+    """
+    Page through every tweet document with _all_docs and include_docs, in _id order.
+
+    :param db: the database
+    :param page_size: documents per request
+    :param start_after: [optional] _id of the last document already done
+    :return: generator of (documents, _id of the last row of the page); design documents are left out
+    """
+    while True:
+        if start_after is None:
+            rows = list(db.view('_all_docs', include_docs=True, limit=page_size))
+        else:
+            # start just after the last _id, skip=1 would skip a live document if the last one was deleted
+            rows = list(db.view('_all_docs', include_docs=True, limit=page_size, startkey=start_after + '\u0000'))
+        if not rows:
+            return
+        start_after = rows[-1].id
+        docs = [dict(row.doc) for row in rows if not row.id.startswith('_design/') and row.doc is not None]
+        yield docs, start_after
+
+
+def reenrich(couchdb_url, db_name, name, processes=None, page_size=1000, sa2_data=SA2_SHAPEFILE,
+             artifact_dir=SA2_ARTIFACT, sa2_edition=2016, report_interval=10, restart=False):
+    """
+    Recompute sentiment, tags and SA2 of every document in a database across a process pool, for when the SA2
+    boundaries, the keyword list or the sentiment model change. Only documents whose values changed are written
+    back, with _bulk_docs and their current _rev; a document edited while the job ran comes back as a conflict and
+    is left as it is. The _id of the last page done is checkpointed in _local/harvester-reenrich-<name> after every
+    page, once every page before it is written, so the job can be stopped at any time and run again to carry on.
+
+    :param couchdb_url: CouchDB address with login
+    :param db_name: the database to re-enrich, e.g. twitter_historic
+    :param name: name of this run, a new name starts from the first document
+    :param processes: worker processes, every core by default
+    :param page_size: documents per _all_docs page and _bulk_docs request
+    :param sa2_data: the SA2 shapefile or geojson, None to use artifact_dir as it is without ever rebuilding it
+    :param artifact_dir: the precompiled SA2 artifact, rebuilt first from sa2_data if needed
+    :param sa2_edition: the ABS edition of sa2_data, 2016 or 2021, which sets the columns read from it
+    :param report_interval: seconds between progress lines
+    :param restart: start again from the first document
+    :return: the checkpoint counters
+    """
+    processes = processes or os.cpu_count()
+    db = DB.Server(couchdb_url)[db_name]
+    checkpoint = Checkpoint(db, 'reenrich-' + name)
+    counters = ('unchanged', 'updated', 'conflicts', 'errors', 'skipped')
+    if restart:
+        checkpoint.update(last_id=None, **{counter: None for counter in counters})
+    totals = {counter: checkpoint.get(counter, 0) for counter in counters}
+    start_after = checkpoint.get('last_id')
+    # build the SA2 artifact once here, the workers only load it
+    if sa2_data is not None:
+        load_sa2_locator(sa2_data, artifact_dir, *SA2_COLUMNS[sa2_edition])
+    elif not os.path.exists(os.path.join(artifact_dir, 'meta.json')):
+        raise ValueError(f"SA2 artifact {artifact_dir} does not exist, pass the SA2 data to build it from")
+
+    print(f"Re-enriching {db_name} with {processes} processes"
+          + (f", resuming after document {start_after}" if start_after else ''))
+    started = last_report = time.monotonic()
+    done = 0
+    pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(couchdb_url, db_name, artifact_dir))
+    pending = deque()
+
+    def collect():
+        nonlocal done, last_report
+        last_id, result = pending.popleft()
+        for counter, value in zip(counters, result.get()):
+            totals[counter] += value
+            done += value
+        checkpoint.update(last_id=last_id, **totals)
+        now = time.monotonic()
+        if now - last_report >= report_interval:
+            last_report = now
+            print(f"{sum(totals.values())} documents done, up to {last_id} ({done / (now - started):.0f}/s): "
+                  + ', '.join(f"{totals[counter]} {counter}" for counter in counters))
+
+    try:
+        for docs, last_id in iter_pages(db, page_size, start_after):
+            pending.append((last_id, pool.apply_async(_reenrich_chunk, (docs,))))
+            while len(pending) >= 2 * processes:
+                collect()
+        while pending:
+            collect()
+    except BaseException:
+        pool.terminate()
+        print(f"Re-enrichment stopped after document {checkpoint.get('last_id')}, run it again to resume")
+        raise
+    pool.close()
+    pool.join()
+    elapsed = time.monotonic() - started
+    print(f"Re-enriched {done} documents in {elapsed:.0f}s: " + ', '.join(f"{totals[c]} {c}" for c in counters))
+    return totals
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Recompute sentiment, tags and SA2 of stored tweets')
+    parser.add_argument('--couchdb', default='INFO', help='module holding the CouchDB address and login')
+    parser.add_argument('--database', default='twitter_historic', help='the database to re-enrich')
+    parser.add_argument('--name', required=True, help='name of the run, e.g. sa2-2021; reuse it to resume')
+    parser.add_argument('--restart', action='store_true', help='start the named run again from the beginning')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes, default every core')
+    parser.add_argument('--page-size', type=int, default=1000, help='documents per page and _bulk_docs request')
+    parser.add_argument('--sa2-data', default=None,
+                        help=f'SA2 shapefile or geojson to build --artifact from, default {SA2_SHAPEFILE} for the '
+                             f'default artifact; without it another --artifact is used as it is')
+    parser.add_argument('--sa2-edition', type=int, choices=sorted(SA2_COLUMNS), default=2016,
+                        help='ABS edition of --sa2-data, which sets the columns read')
+    parser.add_argument('--artifact', default=SA2_ARTIFACT, help='precompiled SA2 artifact directory')
+    args = parser.parse_args()
+    if args.sa2_data is None and args.artifact == SA2_ARTIFACT:
+        args.sa2_data = SA2_SHAPEFILE
+    elif args.sa2_data is None and not os.path.exists(os.path.join(args.artifact, 'meta.json')):
+        # building a new artifact from the default 2016 shapefile would silently keep the old boundaries
+        parser.error('--sa2-data is required to build a new --artifact')
+    reenrich(couchdb_url(importlib.import_module(args.couchdb)), args.database, args.name, processes=args.processes,
+             page_size=args.page_size, sa2_data=args.sa2_data, artifact_dir=args.artifact,
+             sa2_edition=args.sa2_edition, restart=args.restart)
@@ -1,30 +1,231 @@
 from shapely.geometry import Point
-import geopandas as gpd
+from shapely import STRtree
+import shapely
+import numpy as np
+import hashlib
+import json
+import os
+import argparse
+import threading
+from collections import OrderedDict
+
+SA2_SHAPEFILE = "../data/1270055001_sa2_2016_aust_shape.zip"
+# directory holding the precompiled Greater Melbourne boundaries, see build_sa2_artifact
+SA2_ARTIFACT = "../data/sa2_2016_melbourne"
+SA2_ARTIFACT_VERSION = 1
+# (greater capital city name, SA2 code) columns of each ABS edition of the SA2 boundaries
+SA2_COLUMNS = {2016: ('GCC_NAME16', 'SA2_MAIN16'), 2021: ('GCC_NAME21', 'SA2_CODE21')}
+
 
 # load Statistical Area 2 (SA2) data for the greater melbourne region from the specified shapefile
-def load_sa2_data():
+def load_sa2_data(sa2_data=SA2_SHAPEFILE, gcc_column='GCC_NAME16', code_column='SA2_MAIN16'):
+    # geopandas is only needed to read the national shapefile, importing it lazily keeps artifact loads fast
+    import geopandas as gpd
+
     # read the shape file
-    sa2_data = "../data/1270055001_sa2_2016_aust_shape.zip"
     sa2_df = gpd.read_file(sa2_data)
     # filter to only include melbourne
-    sa2_df = sa2_df[sa2_df['GCC_NAME16'] == 'Greater Melbourne']
-    return sa2_df[['SA2_MAIN16', 'geometry']]
+    sa2_df = sa2_df[sa2_df[gcc_column] == 'Greater Melbourne']
+    return sa2_df[[code_column, 'geometry']]
+
+
+class SA2Locator:
+    """
+    Point-in-polygon lookup for SA2 regions backed by an STRtree spatial index.
+    Build it once at startup and reuse it for every tweet: each lookup only tests the few polygons whose bounding
+    box contains the point, instead of every Greater Melbourne SA2.
+
+    In front of the index sits a grid of cell_size degree cells, each classified once the first time a point falls
+    in it. A cell that lies wholly inside one SA2 resolves straight from the grid, a cell that touches no SA2
+    resolves to None, and only points in boundary cells need an exact test. Exact results are kept in an LRU cache
+    keyed on the coordinates, because the same venues and devices tweet from the same coordinates over and over.
+    Use cache_info to tune cell_size and cache_size.
+    """
+    # grid cell states besides the index of the SA2 covering the cell
+    _BOUNDARY = -1
+    _OUTSIDE = -2
+    _UNKNOWN = -3
+
+    def __init__(self, codes, geometries, cell_size=0.01, cache_size=65536):
+        self.codes = np.asarray(codes, dtype=object)
+        self.geometries = np.asarray(geometries, dtype=object)
+        # prepared geometries make the repeated predicate tests much cheaper
+        shapely.prepare(self.geometries)
+        self.tree = STRtree(self.geometries)
+
+        self.cell_size = cell_size
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.grid_hits = 0
+        self.cache_hits = 0
+        self.misses = 0
+        self._build_grid()
+
+    @classmethod
+    def from_data_frame(cls, sa2_main16_df, code_column='SA2_MAIN16', **kwargs):
+        return cls(sa2_main16_df[code_column].to_numpy(), sa2_main16_df['geometry'].to_numpy(), **kwargs)
+
+    def _build_grid(self):
+        self.grid = None
+        if not self.cell_size or len(self.codes) == 0:
+            return
+        self.min_x, self.min_y, self.max_x, self.max_y = shapely.total_bounds(self.geometries)
+        self.nx = max(int(np.ceil((self.max_x - self.min_x) / self.cell_size)), 1)
+        self.ny = max(int(np.ceil((self.max_y - self.min_y) / self.cell_size)), 1)
+        # cells are classified the first time a point falls in them, so startup stays cheap for detailed boundaries
+        self.grid = np.full(self.nx * self.ny, self._UNKNOWN, dtype=np.int32)
+
+    def _classify_cells(self, cell_ids):
+        ix, iy = np.divmod(cell_ids, self.ny)
+        x0 = self.min_x + ix * self.cell_size
+        y0 = self.min_y + iy * self.cell_size
+        cells = shapely.box(x0, y0, x0 + self.cell_size, y0 + self.cell_size)
+
+        # a cell resolves from the grid only if one SA2 covers it and no other SA2 touches it
+        cell_idx, _ = self.tree.query(cells, predicate='intersects')
+        touching = np.bincount(cell_idx, minlength=len(cells))
+        covered_idx, covering_geom = self.tree.query(cells, predicate='covered_by')
+        single = touching[covered_idx] == 1
+
+        states = np.full(len(cells), self._BOUNDARY, dtype=np.int32)
+        states[touching == 0] = self._OUTSIDE
+        states[covered_idx[single]] = covering_geom[single]
+        self.grid[cell_ids] = states
+
+    def _grid_states(self, longitudes, latitudes):
+        # points outside the grid extent (or without coordinates) cannot be in any SA2
+        inside = ((longitudes >= self.min_x) & (longitudes <= self.max_x) &
+                  (latitudes >= self.min_y) & (latitudes <= self.max_y))
+        # points on the max edge of the extent belong to the last cell
+        ix = np.minimum(((longitudes[inside] - self.min_x) // self.cell_size).astype(int), self.nx - 1)
+        iy = np.minimum(((latitudes[inside] - self.min_y) // self.cell_size).astype(int), self.ny - 1)
+        cell_ids = ix * self.ny + iy
+
+        cell_states = self.grid[cell_ids]
+        unknown = cell_states == self._UNKNOWN
+        if unknown.any():
+            self._classify_cells(np.unique(cell_ids[unknown]))
+            cell_states = self.grid[cell_ids]
+
+        states = np.full(len(longitudes), self._OUTSIDE, dtype=np.int32)
+        states[inside] = cell_states
+        return states
+
+    def _locate_exact(self, longitude, latitude):
+        point = Point(longitude, latitude)
+        # contains implies intersects, so the intersects predicate covers the contains-or-intersects rule
+        candidates = self.tree.query(point, predicate='intersects')
+        if candidates.size == 0:
+            return None
+        return self.codes[candidates.min()]
+
+    def locate(self, longitude, latitude):
+        """
+        Find the SA2 main code for a point. A point on a shared boundary belongs to the first SA2 (in data frame
+        order) that contains or intersects it, which matches the original row-by-row scan.
+
+        :param longitude: longitude of the point
+        :param latitude: latitude of the point
+        :return: the SA2_MAIN16 code or None if the point is outside Greater Melbourne
+        """
+        if self.grid is not None:
+            state = self._grid_states(np.array([longitude], dtype=float), np.array([latitude], dtype=float))[0]
+            if state != self._BOUNDARY:
+                with self._lock:
+                    self.grid_hits += 1
+                return None if state == self._OUTSIDE else self.codes[state]
+
+        key = (longitude, latitude)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+                return self._cache[key]
+
+        sa2 = self._locate_exact(longitude, latitude)
+        with self._lock:
+            self.misses += 1
+            if self.cache_size:
+                self._cache[key] = sa2
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return sa2
+
+    def locate_many(self, longitudes, latitudes):
+        """
+        Vectorized version of locate: points in cells wholly inside one SA2 resolve from the grid, and the rest are
+        matched against the index in a single spatial join, which is what backfills and notebook runs over many
+        historic tweets should use.
+
+        :param longitudes: array-like of longitudes, NaN for tweets without coordinates
+        :param latitudes: array-like of latitudes, NaN for tweets without coordinates
+        :return: numpy object array of SA2_MAIN16 codes, None where a point has no SA2
+        """
+        longitudes = np.asarray(longitudes, dtype=float)
+        latitudes = np.asarray(latitudes, dtype=float)
+        sa2_codes = np.full(len(longitudes), None, dtype=object)
+        # points with missing coordinates are skipped
+        exact = ~(np.isnan(longitudes) | np.isnan(latitudes))
+
+        if self.grid is not None:
+            states = self._grid_states(longitudes, latitudes)
+            resolved = exact & (states != self._BOUNDARY)
+            covered = resolved & (states >= 0)
+            sa2_codes[covered] = self.codes[states[covered]]
+            exact &= ~resolved
+            with self._lock:
+                self.grid_hits += int(resolved.sum())
+
+        exact_idx = np.flatnonzero(exact)
+        points = shapely.points(longitudes[exact_idx], latitudes[exact_idx])
+        point_idx, geom_idx = self.tree.query(points, predicate='intersects')
+
+        # keep the first SA2 in data frame order for points on shared boundaries
+        first_match = np.full(len(points), len(self.codes))
+        np.minimum.at(first_match, point_idx, geom_idx)
+        matched = first_match < len(self.codes)
+        sa2_codes[exact_idx[matched]] = self.codes[first_match[matched]]
+        with self._lock:
+            self.misses += len(exact_idx)
+        return sa2_codes
+
+    def cache_info(self):
+        """
+        Counters for tuning the grid cell size and the LRU cache size.
+
+        :return: dictionary of grid hits, cache hits, misses (exact lookups), hit rate and the current settings
+        """
+        with self._lock:
+            lookups = self.grid_hits + self.cache_hits + self.misses
+            return {'grid_hits': self.grid_hits, 'cache_hits': self.cache_hits, 'misses': self.misses,
+                    'hit_rate': (self.grid_hits + self.cache_hits) / lookups if lookups else 0.0,
+                    'cache_entries': len(self._cache), 'cache_size': self.cache_size, 'cell_size': self.cell_size}
 
 
-# return the SA2 main code for 2016 boundaries
-def get_sa2_main16(coordinates, sa2_main16_df):
+# return the SA2 code of the boundaries the locator was built from (SA2_MAIN16 for 2016)
+def get_sa2_main16(coordinates, sa2_locator):
     if coordinates is None:
         return None
 
-    point = Point([coordinates['longitude'], coordinates['latitude']])
-    # check if point falls in the sa2 geometry
-    row_filter = sa2_main16_df.apply(lambda row: row['geometry'].contains(point) or row['geometry'].intersects(point),
-                                     axis=1)
-    filtered_rows = sa2_main16_df[row_filter]
-    if (filtered_rows.size == 0):
-        return None
+    return sa2_locator.locate(coordinates['longitude'], coordinates['latitude'])
+
 
-    return filtered_rows['SA2_MAIN16'].iloc[0]
+def get_sa2_main16_batch(tweet_docs, sa2_locator):
+    """
+    Given a list of tweet docs return the SA2 main code for each of them in one vectorized pass
+    :param tweet_docs: list of tweets in JSON format
+    :param sa2_locator: SA2Locator built from load_sa2_data
+    :return: numpy object array of SA2 codes, None for tweets without coordinates or outside Greater Melbourne
+    """
+    longitudes = np.full(len(tweet_docs), np.nan)
+    latitudes = np.full(len(tweet_docs), np.nan)
+    for i, tweet_doc in enumerate(tweet_docs):
+        coords = get_tweet_coordinates(tweet_doc)
+        if coords is not None:
+            longitudes[i] = coords['longitude']
+            latitudes[i] = coords['latitude']
+    return sa2_locator.locate_many(longitudes, latitudes)
 
 
 def get_tweet_coordinates(tweet_doc):
@@ -33,6 +234,147 @@ def get_tweet_coordinates(tweet_doc):
     :param tweet: tweet in JSON format
     :return: dictionary of latitude, longitude
     """
-    hasCoordinates = tweet_doc['coordinates']
+    # tweets in some dumps have no coordinates key at all
+    hasCoordinates = tweet_doc.get('coordinates')
     if hasCoordinates:
         return {"longitude": hasCoordinates['coordinates'][0], "latitude": hasCoordinates['coordinates'][1]}
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def build_sa2_artifact(sa2_data=SA2_SHAPEFILE, artifact_dir=SA2_ARTIFACT, gcc_column='GCC_NAME16',
+                       code_column='SA2_MAIN16'):
+    """
+    Precompile the Greater Melbourne SA2 boundaries into a compact directory that load_sa2_locator can memory-map:
+    codes.npy holds the SA2 codes, wkb.npy the concatenated WKB geometries and offsets.npy where each one starts.
+    meta.json records the checksum of the source file. On a rebuild it is removed before the arrays are swapped in
+    and written again last, so a half written artifact is never picked up, and load_sa2_artifact refuses arrays that
+    do not match it.
+
+    :param sa2_data: the shapefile or geojson the boundaries are read from
+    :param artifact_dir: the directory to write the artifact to
+    :param gcc_column: the column of the greater capital city name, see SA2_COLUMNS for each edition
+    :param code_column: the column of the SA2 code
+    :return: the artifact metadata
+    """
+    sa2_df = load_sa2_data(sa2_data, gcc_column, code_column)
+    codes = sa2_df[code_column].to_numpy().astype(str)
+    wkb = [b'' if geometry is None else shapely.to_wkb(geometry) for geometry in sa2_df['geometry']]
+    offsets = np.zeros(len(wkb) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(geometry) for geometry in wkb])
+    blob = np.frombuffer(b''.join(wkb), dtype=np.uint8)
+
+    os.makedirs(artifact_dir, exist_ok=True)
+    arrays = (('codes', codes), ('wkb', blob), ('offsets', offsets))
+    for name, array in arrays:
+        with open(os.path.join(artifact_dir, name + '.npy.tmp'), 'wb') as f:
+            np.save(f, array)
+    # the old arrays can still be loaded until meta.json is gone, and the new ones only once it is back
+    meta_path = os.path.join(artifact_dir, 'meta.json')
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    for name, _ in arrays:
+        path = os.path.join(artifact_dir, name + '.npy')
+        os.replace(path + '.tmp', path)
+
+    stat = os.stat(sa2_data)
+    meta = {'version': SA2_ARTIFACT_VERSION, 'source': os.path.basename(sa2_data),
+            'source_sha256': _file_sha256(sa2_data), 'source_size': stat.st_size, 'source_mtime': stat.st_mtime,
+            'gcc_column': gcc_column, 'code_column': code_column, 'count': len(codes)}
+    _write_meta(artifact_dir, meta)
+    return meta
+
+
+def _write_meta(artifact_dir, meta):
+    tmp_path = os.path.join(artifact_dir, 'meta.json.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, os.path.join(artifact_dir, 'meta.json'))
+
+
+def _artifact_is_current(meta, sa2_data, artifact_dir, gcc_column='GCC_NAME16', code_column='SA2_MAIN16'):
+    if meta.get('version') != SA2_ARTIFACT_VERSION:
+        return False
+    # artifacts from before the columns were recorded were all built from the 2016 columns
+    if (meta.get('gcc_column', 'GCC_NAME16'), meta.get('code_column', 'SA2_MAIN16')) != (gcc_column, code_column):
+        return False
+    if sa2_data is None or not os.path.exists(sa2_data):
+        # harvester images can ship the artifact without the national shapefile
+        return True
+    stat = os.stat(sa2_data)
+    if stat.st_size == meta['source_size'] and stat.st_mtime == meta['source_mtime']:
+        return True
+    # the file was touched, only rebuild if its content really changed
+    if _file_sha256(sa2_data) != meta['source_sha256']:
+        return False
+    # remember the new size and mtime, so the next start does not hash the file again
+    meta.update(source_size=stat.st_size, source_mtime=stat.st_mtime)
+    try:
+        _write_meta(artifact_dir, meta)
+    except OSError as e:
+        print(f"Could not update the SA2 artifact metadata in {artifact_dir}: {e}")
+    return True
+
+
+def load_sa2_artifact(artifact_dir=SA2_ARTIFACT, **kwargs):
+    """
+    Memory-map a precompiled artifact written by build_sa2_artifact and build an SA2Locator from it without
+    touching geopandas.
+
+    :param artifact_dir: the artifact directory
+    :param kwargs: cell_size and cache_size for the SA2Locator
+    :return: SA2Locator, raises ValueError if the artifact is being rebuilt
+    """
+    meta_path = os.path.join(artifact_dir, 'meta.json')
+    if not os.path.exists(meta_path):
+        raise ValueError(f"SA2 artifact {artifact_dir} has no meta.json, it is missing or being rebuilt")
+    with open(meta_path) as f:
+        meta = json.load(f)
+    codes = np.load(os.path.join(artifact_dir, 'codes.npy'), mmap_mode='r')
+    blob = np.load(os.path.join(artifact_dir, 'wkb.npy'), mmap_mode='r')
+    offsets = np.load(os.path.join(artifact_dir, 'offsets.npy'), mmap_mode='r')
+    if len(codes) != meta['count'] or len(offsets) != len(codes) + 1 or offsets[-1] != len(blob):
+        raise ValueError(f"SA2 artifact {artifact_dir} does not match its meta.json, it was rebuilt while loading")
+    wkb = [blob[offsets[i]:offsets[i + 1]].tobytes() or None for i in range(len(codes))]
+    return SA2Locator(codes.tolist(), shapely.from_wkb(wkb), **kwargs)
+
+
+def load_sa2_locator(sa2_data=SA2_SHAPEFILE, artifact_dir=SA2_ARTIFACT, gcc_column='GCC_NAME16',
+                     code_column='SA2_MAIN16', **kwargs):
+    """
+    Load the SA2 locator from the precompiled artifact, (re)building the artifact first when it is missing or was
+    built from a different source file or columns.
+
+    :param sa2_data: the shapefile or geojson the boundaries are read from
+    :param artifact_dir: the artifact directory
+    :param gcc_column: the column of the greater capital city name, see SA2_COLUMNS for each edition
+    :param code_column: the column of the SA2 code
+    :param kwargs: cell_size and cache_size for the SA2Locator
+    :return: SA2Locator
+    """
+    meta_path = os.path.join(artifact_dir, 'meta.json')
+    meta = None
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+    if meta is None or not _artifact_is_current(meta, sa2_data, artifact_dir, gcc_column, code_column):
+        print(f"Building SA2 artifact {artifact_dir} from {sa2_data}")
+        build_sa2_artifact(sa2_data, artifact_dir, gcc_column, code_column)
+    return load_sa2_artifact(artifact_dir, **kwargs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precompile the Greater Melbourne SA2 boundaries')
+    parser.add_argument('--source', default=SA2_SHAPEFILE, help='SA2 shapefile or geojson')
+    parser.add_argument('--output', default=SA2_ARTIFACT, help='artifact directory to write')
+    parser.add_argument('--edition', type=int, choices=sorted(SA2_COLUMNS), default=2016,
+                        help='ABS edition of the boundaries, which sets the columns read')
+    args = parser.parse_args()
+    meta = build_sa2_artifact(args.source, args.output, *SA2_COLUMNS[args.edition])
+    print(f"Wrote {meta['count']} SA2 regions to {args.output} (source sha256 {meta['source_sha256']})")
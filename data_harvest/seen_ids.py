@@ -0,0 +1,167 @@
+import os
+import threading
+import numpy as np
+
+
+class SeenIds:
+    """
+    Membership filter for tweet ids that are already in the database, so duplicates from overlapping harvesters
+    are dropped before any sentiment scoring, geocoding or network round trip.
+
+    An id is only added once its tweet is written (or spooled), so a tweet that failed on the way is fetched and
+    processed again by the next sweep or run.
+
+    Ids are kept exactly, as a sorted int64 array plus a small set of recently added ids that is merged into the
+    array every merge_every additions, which costs about 8 bytes per tweet. The filter is warmed from the
+    database's _all_docs ids on the first run and saved to path together with the database update sequence it
+    covers. Later runs load the file and only catch up on the _changes feed since that sequence.
+    """
+    def __init__(self, path='seen_ids.npz', merge_every=10000):
+        self.path = path
+        self.merge_every = merge_every
+        self.since = None
+        self.skipped = 0
+        self._ids = np.empty(0, dtype=np.int64)
+        self._recent = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._ids) + len(self._recent)
+
+    def open(self, db):
+        """
+        Load the saved ids, or warm them from the database if there is no saved file, then catch up on documents
+        written by other harvesters since.
+
+        :param db: the couchdb.Database the tweets are stored in
+        :return: self
+        """
+        if os.path.exists(self.path):
+            self.load()
+            self.catch_up(db)
+        else:
+            self.warm(db)
+        print(f"Loaded {len(self)} known tweet ids")
+        return self
+
+    def load(self):
+        with np.load(self.path) as saved:
+            self._ids = saved['ids']
+            self.since = str(saved['since'])
+
+    def save(self):
+        """
+        Persist the ids and the update sequence they cover.
+
+        :return: None
+        """
+        with self._lock:
+            self._merge()
+            ids = self._ids
+        tmp_path = self.path + '.tmp.npz'
+        np.savez(tmp_path, ids=ids, since=np.array(self.since))
+        os.replace(tmp_path, self.path)
+
+    def warm(self, db, page_size=10000):
+        """
+        Read every document id from _all_docs, page by page.
+
+        :param db: the couchdb.Database the tweets are stored in
+        :param page_size: number of ids fetched per request
+        :return: None
+        """
+        # take the sequence first so documents written during the warm up are picked up by the next catch up
+        self.since = str(db.info()['update_seq'])
+        pages = []
+        start_key = None
+        while True:
+            if start_key is None:
+                rows = db.view('_all_docs', limit=page_size)
+            else:
+                # start just after the last id rather than skipping it, which would skip a live document if the
+                # last one was deleted in between
+                rows = db.view('_all_docs', limit=page_size, startkey=start_key + '\u0000')
+            rows = list(rows)
+            pages.append(_tweet_ids(row.id for row in rows))
+            if len(rows) < page_size:
+                break
+            start_key = rows[-1].id
+        with self._lock:
+            self._ids = np.union1d(self._ids, np.concatenate(pages))
+
+    def catch_up(self, db, page_size=10000):
+        """
+        Add the ids of documents changed since the saved update sequence.
+
+        :param db: the couchdb.Database the tweets are stored in
+        :param page_size: number of changes fetched per request
+        :return: None
+        """
+        pages = []
+        while True:
+            changes = db.changes(since=self.since, limit=page_size)
+            pages.append(_tweet_ids(change['id'] for change in changes['results'] if not change.get('deleted')))
+            self.since = str(changes['last_seq'])
+            if len(changes['results']) < page_size:
+                break
+        with self._lock:
+            self._ids = np.union1d(self._ids, np.concatenate(pages))
+
+    def _contains(self, tweet_id):
+        index = np.searchsorted(self._ids, tweet_id)
+        return tweet_id in self._recent or (index < len(self._ids) and self._ids[index] == tweet_id)
+
+    def seen(self, tweet_id):
+        """
+        Check a tweet id without recording it, counting it as skipped if it is known.
+
+        :param tweet_id: the tweet id, as an int or a string
+        :return: True if the id was already seen and the tweet should be skipped
+        """
+        tweet_id = int(tweet_id)
+        with self._lock:
+            if self._contains(tweet_id):
+                self.skipped += 1
+                return True
+            return False
+
+    def add(self, tweet_id):
+        """
+        Record a tweet id.
+
+        :param tweet_id: the tweet id, as an int or a string
+        :return: True if the id is new, False if it was already seen and the tweet should be skipped
+        """
+        tweet_id = int(tweet_id)
+        with self._lock:
+            if self._contains(tweet_id):
+                self.skipped += 1
+                return False
+            self._recent.add(tweet_id)
+            if len(self._recent) >= self.merge_every:
+                self._merge()
+            return True
+
+    def add_many(self, doc_ids):
+        """
+        Record the ids of written tweet documents.
+
+        :param doc_ids: document _ids, those that are not tweet ids are ignored
+        :return: None
+        """
+        with self._lock:
+            for tweet_id in _tweet_ids(doc_ids).tolist():
+                self._recent.add(tweet_id)
+            if len(self._recent) >= self.merge_every:
+                self._merge()
+
+    def _merge(self):
+        if self._recent:
+            recent = np.fromiter(self._recent, dtype=np.int64, count=len(self._recent))
+            self._ids = np.union1d(self._ids, recent)
+            self._recent = set()
+
+
+def _tweet_ids(doc_ids):
+    # design and checkpoint documents are not tweets
+    return np.array([int(doc_id) for doc_id in doc_ids if doc_id.isdigit()], dtype=np.int64)
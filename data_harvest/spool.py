@@ -0,0 +1,233 @@
+import json
+import os
+import threading
+import couchdb as DB
+from metrics import Metrics
+
+
+class Spool:
+    """
+    Append-only local journal of tweet documents that could not be written to CouchDB. Documents are appended as
+    JSON lines to the current segment file, which is rotated once it reaches segment_bytes. Only sealed segments are
+    replayed, each with an offset file recording how far it has been written to the database, and a segment is
+    deleted once it is fully replayed. Disk use is bounded by max_bytes: append refuses a batch that does not fit,
+    and the caller keeps it in memory instead.
+
+    Segments left behind by a previous run are sealed when the spool is opened, so nothing is lost across restarts.
+    """
+    def __init__(self, directory, segment_bytes=16 * 1024 * 1024, max_bytes=1024 * 1024 * 1024):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._current = None
+        self._file = None
+        existing = self.segments()
+        self._next = int(existing[-1].split('-')[1].split('.')[0]) + 1 if existing else 1
+        self._bytes = sum(os.path.getsize(os.path.join(directory, name)) for name in existing)
+
+    def segments(self):
+        """
+        :return: names of the sealed segments, oldest first
+        """
+        with self._lock:
+            current = self._current
+        names = sorted(name for name in os.listdir(self.directory)
+                       if name.startswith('segment-') and name.endswith('.jsonl'))
+        return [name for name in names if name != current]
+
+    def pending(self):
+        with self._lock:
+            return self._bytes > 0
+
+    def size(self):
+        with self._lock:
+            return self._bytes
+
+    def append(self, docs):
+        """
+        Write documents to the journal and sync it to disk.
+
+        :param docs: list of tweet documents, each with its _id
+        :return: True if the documents are on disk, False if they would take the spool over max_bytes
+        """
+        data = ''.join(json.dumps(doc, separators=(',', ':')) + '\n' for doc in docs).encode('utf-8')
+        with self._lock:
+            if self._bytes + len(data) > self.max_bytes:
+                return False
+            if self._file is None:
+                self._current = f'segment-{self._next:08d}.jsonl'
+                self._next += 1
+                self._file = open(os.path.join(self.directory, self._current), 'ab')
+            self._file.write(data)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._bytes += len(data)
+            if self._file.tell() >= self.segment_bytes:
+                self._seal()
+        return True
+
+    def rotate(self):
+        """
+        Seal the current segment so it can be replayed.
+
+        :return: None
+        """
+        with self._lock:
+            self._seal()
+
+    def _seal(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._current = None
+
+    def read(self, segment, batch_size):
+        """
+        Read a sealed segment from its replay offset in batches. A line cut short by a crash while it was appended
+        ends the segment.
+
+        :param segment: name of the segment
+        :param batch_size: documents per batch
+        :return: generator of (documents, offset after them)
+        """
+        offset = self._offset(segment)
+        batch = []
+        with open(os.path.join(self.directory, segment), 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                try:
+                    batch.append(json.loads(line))
+                except ValueError:
+                    print(f"Spool segment {segment} ends in a partial line at offset {offset}, skipped")
+                    break
+                offset += len(line)
+                if len(batch) >= batch_size:
+                    yield batch, offset
+                    batch = []
+        if batch:
+            yield batch, offset
+
+    def _offset_path(self, segment):
+        return os.path.join(self.directory, segment + '.offset')
+
+    def _offset(self, segment):
+        try:
+            with open(self._offset_path(segment)) as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return 0
+
+    def commit(self, segment, offset):
+        """
+        Record that a segment is replayed up to offset.
+
+        :return: None
+        """
+        tmp_path = self._offset_path(segment) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(str(offset))
+        os.replace(tmp_path, self._offset_path(segment))
+
+    def remove(self, segment):
+        size = os.path.getsize(os.path.join(self.directory, segment))
+        os.remove(os.path.join(self.directory, segment))
+        if os.path.exists(self._offset_path(segment)):
+            os.remove(self._offset_path(segment))
+        with self._lock:
+            self._bytes -= size
+
+    def close(self):
+        with self._lock:
+            self._seal()
+
+
+class SpoolReplayer:
+    """
+    Background thread draining a Spool into CouchDB with _bulk_docs every interval seconds. A segment's offset is
+    only moved forward after its batch is written, and a document that is already in the database comes back as a
+    conflict because spooled documents have no _rev. A replay interrupted between the write and the offset update
+    is therefore harmless: every tweet _id is stored exactly once.
+
+    A document the database refuses on its own (an error other than a conflict) is appended to the spool again
+    before the offset moves past it, and replayed with a later segment; a segment is only deleted once each of its
+    documents is stored, already in the database or spooled again.
+    """
+    def __init__(self, spool, db, interval=5.0, batch_size=500, metrics=None, stage='spool'):
+        self.spool = spool
+        self.db = db
+        self.interval = interval
+        self.batch_size = batch_size
+        self.metrics = metrics or Metrics()
+        self.stage = stage
+        self.replayed = 0
+        self.conflicts = 0
+        self.respooled = 0
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='spool-replayer', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._closed.wait(self.interval):
+            self.drain()
+
+    def drain(self):
+        """
+        Replay every spooled document, stopping at the first failed request.
+
+        :return: True if the spool is empty
+        """
+        if not self.spool.pending():
+            return True
+        self.spool.rotate()
+        for segment in self.spool.segments():
+            try:
+                for batch, offset in self.spool.read(segment, self.batch_size):
+                    with self.metrics.time(self.stage):
+                        results = self.db.update(batch)
+                    failed = self._report(batch, results)
+                    if failed and not self.spool.append(failed):
+                        # the offset stays before the batch, which is replayed again once there is room
+                        print(f"Spool full, {len(failed)} refused documents of {segment} are retried "
+                              f"in {self.interval}s")
+                        return False
+                    self.spool.commit(segment, offset)
+            except Exception as e:
+                print(f"Spool replay into {self.db.name} failed, retrying in {self.interval}s: {e}")
+                return False
+            self.spool.remove(segment)
+        print(f"Spool replayed: {self.replayed} documents replayed, {self.conflicts} already in database, "
+              f"{self.respooled} refused and spooled again")
+        return not self.spool.pending()
+
+    def _report(self, batch, results):
+        # the documents refused by the database for another reason than a conflict, to be spooled again
+        replayed = conflicts = 0
+        failed = []
+        for doc, (success, doc_id, rev_or_exc) in zip(batch, results):
+            if success:
+                replayed += 1
+            elif isinstance(rev_or_exc, DB.http.ResourceConflict):
+                conflicts += 1
+            else:
+                print(f"Failed to replay document {doc_id}, spooled again: {rev_or_exc}")
+                failed.append(doc)
+        self.replayed += replayed
+        self.conflicts += conflicts
+        self.respooled += len(failed)
+        self.metrics.count(f'{self.stage}_replayed', replayed)
+        self.metrics.count(f'{self.stage}_conflicts', conflicts)
+        self.metrics.count(f'{self.stage}_respooled', len(failed))
+        return failed
+
+    def close(self):
+        """
+        Stop the replayer after one last attempt to drain the spool. Anything left is replayed by the next run.
+
+        :return: None
+        """
+        self._closed.set()
+        self._thread.join()
+        self.drain()
+        self.spool.close()
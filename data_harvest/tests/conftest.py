@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the harvester modules are imported from data_harvest, as when the scripts are run from there
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,50 @@
+import pytest
+from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
+from batch_sentiment import BatchSentimentAnalyzer, TOLERANCE, _sample_texts
+
+CASES = {
+    'plain': ["VADER is smart, handsome, and funny.", "The book was good.", "I hate waiting in queues", "", "   "],
+    'negation': ["VADER is not smart, handsome, nor funny.", "Not bad at all", "I don't like it",
+                 "It isn't good, it never was", "Without a doubt, excellent idea.", "nothing was ever uglier"],
+    'boosters': ["The book was only kind of good.", "It was extremely good", "The service was barely acceptable",
+                 "Today only kinda sux! But I'll get by, lol", "absolutely incredibly awful"],
+    'caps': ["VADER is VERY SMART, handsome, and FUNNY!!!", "Today SUX!", "This is GREAT but the rest is bad",
+             "ALL CAPS ONLY HAPPY"],
+    'but': ["The plot was good, but the characters are uncompelling and the dialog is not great.",
+            "good good but good good", "It was terrible but I loved it", "But it was fine"],
+    'least': ["Roger Dodger is one of the least compelling variations on this theme.",
+              "At least it isn't a horrible book.", "least happy day", "at least it was cheap, at least"],
+    'idioms': ["With VADER, sentiment analysis is the shit!", "On the other hand, VADER is quite bad ass",
+               "That was the bomb", "He is a kiss of death", "cut the mustard yeah", "hand to mouth again"],
+    'emoji': ["Make sure you :) or :D today!", "Catch utf-8 emoji such as 💘 and 💋 and 😁", "😡😡 terrible",
+              "great 👍", "Sentiment analysis has never been this good! 🎉"],
+}
+
+
+@pytest.fixture(scope='module')
+def analysers():
+    analyser = SentimentIntensityAnalyzer()
+    return analyser, BatchSentimentAnalyzer(analyser)
+
+
+def assert_parity(analysers, texts):
+    analyser, batch = analysers
+    for text, actual in zip(texts, batch.polarity_scores_many(texts)):
+        expected = analyser.polarity_scores(text)
+        for key in ('neg', 'neu', 'pos', 'compound'):
+            assert actual[key] == pytest.approx(expected[key], abs=TOLERANCE), (text, key)
+
+
+@pytest.mark.parametrize('rule', sorted(CASES))
+def test_rules_match_vader(analysers, rule):
+    assert_parity(analysers, CASES[rule])
+
+
+def test_single_text_matches_batch(analysers):
+    _, batch = analysers
+    texts = [text for texts in CASES.values() for text in texts]
+    assert [batch.polarity_scores(text) for text in texts] == batch.polarity_scores_many(texts)
+
+
+def test_generated_tweets_match_vader(analysers):
+    assert_parity(analysers, _sample_texts(analysers[0], 2000))
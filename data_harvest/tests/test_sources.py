@@ -0,0 +1,75 @@
+import json
+from contextlib import contextmanager
+from tweepy.parsers import ModelParser
+from harvester.sources import PremiumSearchSource
+
+
+def search_page(ids, next_token=None):
+    # a 30 day search response parsed by tweepy as search_30_day(..., return_cursors=True) does
+    payload = {'results': [{'id': i, 'id_str': str(i), 'text': 'tweet'} for i in ids]}
+    if next_token is not None:
+        payload['next'] = next_token
+    return ModelParser().parse(json.dumps(payload), payload_type='status', payload_list=True, return_cursors=True)
+
+
+class FakePool:
+    def __init__(self, pages):
+        self.pages = pages
+        self.calls = []
+        self.last_key = 'INFO_2'
+
+    def call(self, request, key_name=None):
+        self.calls.append(key_name)
+        return self.pages.pop(0)
+
+
+class FakeMetrics:
+    @contextmanager
+    def time(self, stage):
+        yield
+
+
+class FakeHarvester:
+    def __init__(self):
+        self.metrics = FakeMetrics()
+        self.submitted = []
+        self.commits = []
+
+    def submit(self, data, doc_type):
+        self.submitted.append(data['id'])
+
+    def commit(self, checkpoint, **cursor):
+        self.commits.append(cursor)
+        checkpoint.update(cursor)
+
+
+def sweep(pages, checkpoint=None):
+    source = PremiumSearchSource([])
+    source.pool = FakePool(pages)
+    harvester = FakeHarvester()
+    checkpoint = checkpoint if checkpoint is not None else {}
+    source.sweep(harvester, checkpoint)
+    return harvester, checkpoint
+
+
+def test_last_page_without_next_ends_the_sweep():
+    harvester, checkpoint = sweep([search_page([1, 2, 3], 'token-1'), search_page([4, 5])])
+    assert harvester.submitted == [1, 2, 3, 4, 5]
+    assert harvester.commits[0]['next'] == 'token-1'
+    assert harvester.commits[1]['next'] is None
+    # a finished sweep moves the window up and forgets the page token
+    assert checkpoint['next'] is None and checkpoint['to_date'] is None
+    assert checkpoint['from_date'] == harvester.commits[0]['to_date']
+
+
+def test_single_page_sweep():
+    harvester, checkpoint = sweep([search_page([7])])
+    assert harvester.submitted == [7]
+    assert checkpoint['next'] is None
+
+
+def test_resumed_sweep_finishes_on_the_last_page():
+    checkpoint = {'from_date': '202205010000', 'to_date': '202205210000', 'next': 'token-9', 'key': 'INFO_3'}
+    harvester, checkpoint = sweep([search_page([8, 9])], checkpoint)
+    assert harvester.submitted == [8, 9]
+    assert checkpoint['from_date'] == '202205210000' and checkpoint['next'] is None
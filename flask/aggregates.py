@@ -0,0 +1,260 @@
+import argparse
+import json
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+import requests
+
+# the store is derived from the _changes feeds, a file of another version is emptied and counted again from scratch
+SCHEMA_VERSION = 2
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS stats (db TEXT, kind TEXT, grp TEXT, sum REAL, count INTEGER, min REAL, max REAL, '
+    'sumsqr REAL, PRIMARY KEY (db, kind, grp))',
+    # what each counted document added, one row per document, to take it out again when it changes
+    'CREATE TABLE IF NOT EXISTS counted (db TEXT, id TEXT, value REAL, groups TEXT, PRIMARY KEY (db, id)) '
+    'WITHOUT ROWID',
+    'CREATE TABLE IF NOT EXISTS checkpoints (db TEXT PRIMARY KEY, since TEXT, caught_up INTEGER NOT NULL DEFAULT 0)',
+]
+# tables of earlier versions
+OLD_TABLES = ['stats', 'contributions', 'counted', 'checkpoints']
+# tags of the election issues, as set by the harvester (data_harvest/harvester/tagging.py)
+ISSUES = ['childcare', 'housing', 'taxes', 'aged care', 'health', 'economy']
+
+
+def document_groups(doc):
+    """
+    The groups a tweet document counts towards: 'sa2' for election tweets located in an SA2, 'day' for election
+    tweets by the day they were posted, and 'issue' for each election issue the tweet is tagged with.
+
+    :param doc: a document stored by the harvester
+    :return: list of (kind, group) pairs, empty if the document has no sentiment or tags
+    """
+    if not isinstance(doc.get('sentiment'), dict) or 'tags' not in doc:
+        return []
+    groups = [('issue', tag) for tag in doc['tags'] if tag in ISSUES]
+    if 'election' in doc['tags']:
+        if doc.get('sa2'):
+            groups.append(('sa2', str(doc['sa2'])))
+        created_at = doc.get('tweet', {}).get('created_at')
+        if created_at:
+            day = datetime.strftime(datetime.strptime(created_at, '%a %b %d %H:%M:%S +0000 %Y'), '%Y-%m-%d')
+            groups.append(('day', day))
+    return groups
+
+
+def _group_key(kind, grp):
+    return json.dumps([kind, grp], separators=(',', ':'))
+
+
+class SentimentAggregates:
+    """
+    Running sum, count, min, max and sumsqr of the compound sentiment per SA2, per day and per election issue, the
+    same as a _stats view, kept in a local SQLite file and updated from the _changes feed of each tweet database.
+    Reading the aggregates is one query over the groups, whatever the size of the databases. Like the _stats views,
+    a compound of exactly 0 is not counted.
+
+    Besides the statistics of each group, only the value and groups of each counted document are kept, so an
+    updated or deleted document is taken out again before its new version is counted. The last sequence of each
+    database is saved in the same transaction as its changes, so a restarted follower carries on exactly where it
+    stopped, together with whether the follower has caught up with the database once (see ready). A document that
+    cannot be counted, e.g. with a malformed created_at, is logged and left out rather than failing its batch.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        # readers (the API) are not blocked by the follower writing
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self._create()
+        self.lock = threading.Lock()
+        self.skipped = 0
+
+    def _create(self):
+        # in one write transaction, so processes opening the file together do not both rebuild it
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+            if version != SCHEMA_VERSION:
+                if version:
+                    print(f"Aggregates in {self.path} are of version {version}, counting them again")
+                for table in OLD_TABLES:
+                    self.conn.execute(f'DROP TABLE IF EXISTS {table}')
+                for statement in SCHEMA:
+                    self.conn.execute(statement)
+                self.conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+            self.conn.commit()
+        except BaseException:
+            self.conn.rollback()
+            raise
+
+    def since(self, db):
+        """
+        :param db: the name of the database
+        :return: the last sequence of its _changes feed already counted, '0' if none
+        """
+        row = self.conn.execute('SELECT since FROM checkpoints WHERE db = ?', (db,)).fetchone()
+        return row[0] if row else '0'
+
+    def ready(self, db):
+        """
+        :param db: the name of the database
+        :return: True once the follower has caught up with the _changes feed of the database
+        """
+        row = self.conn.execute('SELECT caught_up FROM checkpoints WHERE db = ?', (db,)).fetchone()
+        return bool(row and row[0])
+
+    def _retract(self, db, doc_id):
+        row = self.conn.execute('SELECT value, groups FROM counted WHERE db = ? AND id = ?', (db, doc_id)).fetchone()
+        if row is None:
+            return
+        value, groups = row
+        self.conn.execute('DELETE FROM counted WHERE db = ? AND id = ?', (db, doc_id))
+        for kind, grp in json.loads(groups):
+            self.conn.execute('UPDATE stats SET sum = sum - ?, count = count - 1, sumsqr = sumsqr - ? '
+                              'WHERE db = ? AND kind = ? AND grp = ?', (value, value * value, db, kind, grp))
+            bounds = self.conn.execute('SELECT min, max FROM stats WHERE db = ? AND kind = ? AND grp = ?',
+                                       (db, kind, grp)).fetchone()
+            if bounds and value in bounds:
+                # min and max cannot be taken back, they are looked up again from the documents left in the group;
+                # this scans the counted documents, but only when the document was the lowest or highest of a group
+                low, high = self.conn.execute('SELECT MIN(value), MAX(value) FROM counted WHERE db = ? AND '
+                                              'instr(groups, ?) > 0', (db, _group_key(kind, grp))).fetchone()
+                self.conn.execute('UPDATE stats SET min = ?, max = ? WHERE db = ? AND kind = ? AND grp = ?',
+                                  (low, high, db, kind, grp))
+        self.conn.execute('DELETE FROM stats WHERE db = ? AND count <= 0', (db,))
+
+    @staticmethod
+    def _contribution(doc):
+        # the compound sentiment of a document and the groups it counts towards, None if it is not counted; the
+        # _stats views skip a compound of 0 (if (doc.sentiment.compound)), so it is skipped here as well
+        value = doc['sentiment'].get('compound') if isinstance(doc.get('sentiment'), dict) else None
+        if value is None or float(value) == 0:
+            return None, []
+        return float(value), document_groups(doc)
+
+    def apply(self, db, changes, last_seq, caught_up=False):
+        """
+        Count a batch of the _changes feed of a database, in one transaction with its checkpoint.
+
+        :param db: the name of the database
+        :param changes: the results of the feed, read with include_docs=true
+        :param last_seq: the last_seq of the feed, saved as the checkpoint
+        :param caught_up: [optional] whether nothing is left in the feed after this batch
+        :return: None
+        """
+        with self.lock, self.conn:
+            for change in changes:
+                if change['id'].startswith('_design/'):
+                    continue
+                doc = change.get('doc')
+                value, groups = None, []
+                if not change.get('deleted') and doc:
+                    try:
+                        value, groups = self._contribution(doc)
+                    except (ValueError, TypeError, AttributeError, KeyError) as e:
+                        self.skipped += 1
+                        print(f"Skipped document {change['id']} of {db}, it cannot be counted: {e!r}")
+                # the previous version is taken out even if the new one is not counted
+                self._retract(db, change['id'])
+                if value is None or not groups:
+                    continue
+                self.conn.execute('INSERT INTO counted VALUES (?, ?, ?, ?)', (db, change['id'], value,
+                                  json.dumps([[kind, grp] for kind, grp in groups], separators=(',', ':'))))
+                for kind, grp in groups:
+                    self.conn.execute('INSERT INTO stats VALUES (?, ?, ?, ?, 1, ?, ?, ?) '
+                                      'ON CONFLICT (db, kind, grp) DO UPDATE SET sum = sum + excluded.sum, '
+                                      'count = count + 1, min = MIN(min, excluded.min), max = MAX(max, excluded.max), '
+                                      'sumsqr = sumsqr + excluded.sumsqr',
+                                      (db, kind, grp, value, value, value, value * value))
+            # once caught up, a database stays ready while the follower keeps up with its new tweets
+            self.conn.execute('INSERT INTO checkpoints VALUES (?, ?, ?) ON CONFLICT (db) DO UPDATE SET '
+                              'since = excluded.since, caught_up = MAX(caught_up, excluded.caught_up)',
+                              (db, str(last_seq), int(caught_up)))
+
+    def stats(self, db, kind):
+        """
+        :param db: the name of the database
+        :param kind: 'sa2', 'day' or 'issue'
+        :return: list of {group: {'sum', 'count', 'min', 'max', 'sumsqr'}} ordered by group, like the rows of a
+                 grouped _stats view
+        """
+        rows = self.conn.execute('SELECT grp, sum, count, min, max, sumsqr FROM stats WHERE db = ? AND kind = ? '
+                                 'ORDER BY grp', (db, kind)).fetchall()
+        return [{grp: {'sum': total, 'count': count, 'min': low, 'max': high, 'sumsqr': sumsqr}}
+                for grp, total, count, low, high, sumsqr in rows]
+
+    def close(self):
+        self.conn.close()
+
+
+def follow(couchdb_url, db, aggregates, batch_size=1000, poll_timeout=60, stop=None):
+    """
+    Follow the _changes feed of a database into the aggregates until stop is set, long polling once it is caught up.
+
+    :param couchdb_url: CouchDB address with login
+    :param db: the name of the database
+    :param aggregates: the SentimentAggregates to update
+    :param batch_size: changes per request and transaction
+    :param poll_timeout: seconds a long poll waits for new changes
+    :param stop: [optional] threading.Event to stop following
+    :return: None
+    """
+    session = requests.Session()
+    since = aggregates.since(db)
+    ready = aggregates.ready(db)
+    print(f"Following {db} from sequence {since[:20]}")
+    while stop is None or not stop.is_set():
+        try:
+            resp = session.get(couchdb_url + db + '/_changes', timeout=poll_timeout + 30,
+                               params={'since': since, 'include_docs': 'true', 'limit': batch_size,
+                                       'feed': 'longpoll', 'timeout': poll_timeout * 1000})
+            resp.raise_for_status()
+            feed = resp.json()
+        except (requests.RequestException, ValueError) as e:
+            print(f"Failed to read the changes of {db}, retrying: {e}")
+            time.sleep(5)
+            continue
+        # pending is the number of changes left after this batch, older CouchDB versions leave it out
+        caught_up = feed.get('pending', 0) == 0 and len(feed['results']) < batch_size
+        try:
+            aggregates.apply(db, feed['results'], feed['last_seq'], caught_up)
+        except sqlite3.Error as e:
+            # e.g. the database is locked, the batch was rolled back and is read again
+            print(f"Failed to count the changes of {db}, retrying: {e}")
+            time.sleep(5)
+            continue
+        since = feed['last_seq']
+        if feed['results']:
+            print(f"Counted {len(feed['results'])} changes of {db}")
+        if caught_up and not ready:
+            ready = True
+            print(f"Caught up with {db}")
+
+
+def follow_all(couchdb_url, databases, path, batch_size=1000):
+    """
+    Follow several databases into one aggregates file, one thread each, until interrupted.
+    """
+    aggregates = SentimentAggregates(path)
+    stop = threading.Event()
+    threads = [threading.Thread(target=follow, args=(couchdb_url, db, aggregates, batch_size), kwargs={'stop': stop},
+                                daemon=True) for db in databases]
+    for thread in threads:
+        thread.start()
+    try:
+        while any(thread.is_alive() for thread in threads):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        stop.set()
+    aggregates.close()
+
+
+if __name__ == '__main__':
+    import config
+    parser = argparse.ArgumentParser(description='Keep the sentiment aggregates of the API up to date')
+    parser.add_argument('--path', default=config.AGGREGATES_PATH, help='the SQLite file of the aggregates')
+    parser.add_argument('--batch-size', type=int, default=1000, help='changes per request and transaction')
+    args = parser.parse_args()
+    url = f'http://{config.COUCHDB_USER}:{config.COUCHDB_PASSWORD}@{config.COUCHDB_IP}:{config.COUCHDB_PORT}/'
+    follow_all(url, [config.COUCHDB_HISTORIC_DB, config.COUCHDB_NEW_DB], args.path, args.batch_size)
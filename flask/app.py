@@ -1,9 +1,14 @@
+import asyncio
+import os
 from copy import deepcopy
 
 from flask import Flask, send_from_directory
 from flask_restful import Resource, Api, abort
 import couchdb as db
-from couchback_temp import CouchInterface
+from couchback_temp import CouchInterface, ViewCache
+from async_couchback import AsyncCouchInterface, EventLoopThread
+from aggregates import SentimentAggregates
+from response_cache import ResponseCache
 
 # for data preprocessing
 import pandas as pd
@@ -23,11 +28,94 @@ analytics = {
 }
 
 
-def create_couch_interface():
-    # initialize a CouchInterface object to retrive data from couchdb
-    ci = CouchInterface(address=app.config["COUCHDB_IP"], port=str(app.config["COUCHDB_PORT"]), \
-    username=app.config["COUCHDB_USER"], password=app.config["COUCHDB_PASSWORD"])
-    return ci
+# the CouchInterface of this process and the pid it was created in
+couch_interface = None
+couch_interface_pid = None
+# the view cache of this process, shared by both couchDB clients so that both see the views dropped by update_seqs
+view_cache = None
+view_cache_pid = None
+# the serialized GeoJSON responses, which only change with the AURIN data
+response_cache = ResponseCache(check_interval=app.config["RESPONSE_CACHE_CHECK_INTERVAL"], \
+max_age=app.config["RESPONSE_CACHE_MAX_AGE"])
+
+
+def get_view_cache():
+    global view_cache, view_cache_pid
+    if view_cache is None or view_cache_pid != os.getpid():
+        view_cache = ViewCache(max_bytes=app.config["VIEW_CACHE_MAX_BYTES"], ttl=app.config["VIEW_CACHE_TTL"], \
+        static_databases=app.config["VIEW_CACHE_STATIC_DBS"])
+        view_cache_pid = os.getpid()
+    return view_cache
+
+
+def get_couch_interface():
+    # one CouchInterface per worker process, shared by all its requests so its pooled connections are reused;
+    # created lazily so that gunicorn workers forked from the master do not share sockets
+    global couch_interface, couch_interface_pid
+    if couch_interface is None or couch_interface_pid != os.getpid():
+        couch_interface = CouchInterface(address=app.config["COUCHDB_IP"], port=str(app.config["COUCHDB_PORT"]), \
+        username=app.config["COUCHDB_USER"], password=app.config["COUCHDB_PASSWORD"], \
+        pool_size=app.config["COUCHDB_POOL_SIZE"], timeout=app.config["COUCHDB_TIMEOUT"], \
+        retries=app.config["COUCHDB_RETRIES"], cache=get_view_cache())
+        couch_interface_pid = os.getpid()
+    return couch_interface
+
+
+# the event loop thread and AsyncCouchInterface of this process and the pid they were created in
+event_loop = None
+async_couch_interface = None
+async_couch_interface_pid = None
+
+
+def get_async_couch_interface():
+    # one asyncio client per worker process, on an event loop shared by all its request threads, so the view reads of
+    # every request are multiplexed over one connection pool
+    global event_loop, async_couch_interface, async_couch_interface_pid
+    if async_couch_interface is None or async_couch_interface_pid != os.getpid():
+        event_loop = EventLoopThread()
+        async_couch_interface = AsyncCouchInterface(address=app.config["COUCHDB_IP"], \
+        port=str(app.config["COUCHDB_PORT"]), username=app.config["COUCHDB_USER"], \
+        password=app.config["COUCHDB_PASSWORD"], pool_size=app.config["COUCHDB_ASYNC_POOL_SIZE"], \
+        timeout=app.config["COUCHDB_TIMEOUT"], cache=get_view_cache())
+        async_couch_interface_pid = os.getpid()
+    return async_couch_interface
+
+
+class AsyncResource(Resource):
+    # async variant of a resource: its fetch coroutine awaits all the views the request needs together, on the event
+    # loop of this process, while the request thread only waits for it; the rest of the request, building the
+    # response, is the same as the synchronous resource and stays off the loop
+    def fetch(self, *args):
+        aci = get_async_couch_interface()
+        return event_loop.run(self.fetch_async(aci, *args), timeout=app.config["COUCHDB_TIMEOUT"])
+
+    async def fetch_async(self, aci, *args):
+        raise NotImplementedError
+
+
+# the SentimentAggregates of this process and the pid it was opened in
+aggregates = None
+aggregates_pid = None
+
+
+def get_aggregates():
+    # sentiment aggregates kept up to date from the _changes feeds by aggregates.py, opened once per worker process
+    global aggregates, aggregates_pid
+    if aggregates is None or aggregates_pid != os.getpid():
+        aggregates = SentimentAggregates(app.config["AGGREGATES_PATH"])
+        aggregates_pid = os.getpid()
+    return aggregates
+
+
+def aggregates_ready(db_name):
+    # the aggregates replace the _stats views of a database only once it has been re-enriched, i.e. it is listed in
+    # AGGREGATES_DBS, and the follower has caught up with it; before that they would only cover part of its tweets
+    return db_name in app.config["AGGREGATES_DBS"] and get_aggregates().ready(db_name)
+
+
+def update_seqs(*db_names):
+    # versions of the databases a cached response is built from
+    return lambda: get_couch_interface().update_seqs(db_names)
 
 
 def abort_if_scenario_doesnt_exist(scenario):
@@ -189,12 +277,19 @@ class Tweets(Resource):
     #   "properties": { "compound": -0.5362, "text": "#auspol tweets",},
     #   "geometry": { "type": "Point", "coordinates": [ 144.95379890000001, -37.7740309 ] } }
     def get(self):
-        # initialize a CouchInterface object to retrieve data from couchdb
-        ci = create_couch_interface()
+        return tweets_to_geojson(self.fetch())
 
-        valid_tweets = ci.non_grouped_results(db_name=app.config["COUCHDB_HISTORIC_DB"], \
+    def fetch(self):
+        # the CouchInterface of this process, to retrieve data from couchdb
+        ci = get_couch_interface()
+        return ci.non_grouped_results(db_name=app.config["COUCHDB_HISTORIC_DB"], \
         design_doc=app.config["DESIGN_DOC"], view_name=app.config["VIEW_FOR_ELECTION_TWEETS"])
-        return tweets_to_geojson(valid_tweets)
+
+
+class AsyncTweets(AsyncResource, Tweets):
+    async def fetch_async(self, aci):
+        return await aci.non_grouped_results(app.config["COUCHDB_HISTORIC_DB"], app.config["DESIGN_DOC"], \
+        app.config["VIEW_FOR_ELECTION_TWEETS"])
 
 
 class Language(Resource):
@@ -202,39 +297,52 @@ class Language(Resource):
     # { "type": "Feature", "properties": { "SA2_MAIN16": "206011105", "SA2_NAME16": "Brunswick", "prop_spk_other_lang": 0.30813904905155842 },
     #   "geometry": { "type": "Polygon", "coordinates": [ [ [ 144.94974, -37.76277 ], [ 144.95003, -37.76105 ] ] ] } }
     def get(self):
-        # initialize a CouchInterface object to retrieve data from couchdb
-        ci = create_couch_interface()
+        # served from the response cache, built again when the language or polygon data changes
+        return response_cache.respond('language', update_seqs(app.config["LSAHBSC"], app.config["AUSTGEO"]), \
+        self.build)
 
+    def build(self):
         # load language info and polygons of sa2's from database
-        sa2_languages = ci.non_grouped_results(db_name=app.config["LSAHBSC"], \
-        design_doc=app.config["DESIGN_DOC_AURIN"], view_name=app.config["VIEW_FOR_AURIN"])
-        sa2_polygons = ci.non_grouped_results(db_name=app.config["AUSTGEO"], \
-        design_doc=app.config["DESIGN_DOC_AURIN"], view_name=app.config["VIEW_FOR_AURIN"])
+        sa2_languages, sa2_polygons = self.fetch()
 
         # join two outputs, and output a geojson string
         return join_languages_and_polygons(sa2_languages, sa2_polygons)
 
+    def fetch(self):
+        # the CouchInterface of this process, to retrieve data from couchdb
+        ci = get_couch_interface()
+        # both views are read at the same time
+        return ci.non_grouped_results_many([
+            (app.config["LSAHBSC"], app.config["DESIGN_DOC_AURIN"], app.config["VIEW_FOR_AURIN"]),
+            (app.config["AUSTGEO"], app.config["DESIGN_DOC_AURIN"], app.config["VIEW_FOR_AURIN"])])
+
+
+class AsyncLanguage(AsyncResource, Language):
+    async def fetch_async(self, aci):
+        return await asyncio.gather(
+            aci.non_grouped_results(app.config["LSAHBSC"], app.config["DESIGN_DOC_AURIN"], \
+            app.config["VIEW_FOR_AURIN"]),
+            aci.non_grouped_results(app.config["AUSTGEO"], app.config["DESIGN_DOC_AURIN"], \
+            app.config["VIEW_FOR_AURIN"]))
+
 
 class Sentiment(Resource):
     # Return a dict (miniature dataframe):
     # {'sa2':sa2s, ‘mean_compound’: list, 'count':counts, ‘prop_spk_other_lang’: list}
     def get(self, scenario_id):
         abort_if_scenario_doesnt_exist(scenario_id)
-        # initialize a CouchInterface object to retrieve data from couchdb
-        ci = create_couch_interface()
-        sa2_languages = ci.non_grouped_results(db_name=app.config["LSAHBSC"], \
-        design_doc=app.config["DESIGN_DOC_AURIN"], view_name=app.config["VIEW_FOR_AURIN"])
+        # the _stats view is only read when the aggregates cannot answer
+        read_stats = scenario_id == "diversity" and not aggregates_ready(app.config["COUCHDB_HISTORIC_DB"])
+        sa2_languages, results = self.fetch(read_stats)
         lang_prop_dict = language_proportion_dict(sa2_languages)
         scenario = deepcopy(analytics[scenario_id])
 
         if (scenario_id == "diversity"):
 
-            # get queried results in a list of dict: e.g.
+            # get aggregated results in a list of dict: e.g.
             # {'214021380': {'sum': -1.1561, 'count': 2, 'min': -0.6808, 'max': -0.4753, 'sumsqr': 0.68939873}}
-            db_name = app.config["COUCHDB_HISTORIC_DB"]
-            design_doc = app.config["DESIGN_DOC"]
-            view_name = app.config["VIEW_FOR_ELECTION"]
-            results = ci.grouped_results(db_name, design_doc, view_name)
+            if not read_stats:
+                results = get_aggregates().stats(app.config["COUCHDB_HISTORIC_DB"], 'sa2')
 
             # convert into a dict of lists (like a dataframe)
             sa2s = []
@@ -253,6 +361,26 @@ class Sentiment(Resource):
 
         return scenario
 
+    def fetch(self, read_stats):
+        # the CouchInterface of this process, to retrieve data from couchdb
+        ci = get_couch_interface()
+        sa2_languages = ci.non_grouped_results(db_name=app.config["LSAHBSC"], \
+        design_doc=app.config["DESIGN_DOC_AURIN"], view_name=app.config["VIEW_FOR_AURIN"])
+        if not read_stats:
+            return sa2_languages, None
+        return sa2_languages, ci.grouped_results(app.config["COUCHDB_HISTORIC_DB"], app.config["DESIGN_DOC"], \
+        app.config["VIEW_FOR_ELECTION"])
+
+
+class AsyncSentiment(AsyncResource, Sentiment):
+    async def fetch_async(self, aci, read_stats):
+        sa2_languages = aci.non_grouped_results(app.config["LSAHBSC"], app.config["DESIGN_DOC_AURIN"], \
+        app.config["VIEW_FOR_AURIN"])
+        if not read_stats:
+            return await sa2_languages, None
+        return await asyncio.gather(sa2_languages, aci.grouped_results(app.config["COUCHDB_HISTORIC_DB"], \
+        app.config["DESIGN_DOC"], app.config["VIEW_FOR_ELECTION"]))
+
 
 def tweets_to_geojson_SE(valid_tweets):
     ## to support the socioeconomic scenario
@@ -334,11 +462,18 @@ class SE_Tweets(Resource):
     #   "geometry": { "type": "Point", "coordinates": [ 144.95380, -37.77403 ] } }
 
     def get(self):
-        ci = create_couch_interface()
-        valid_tweets = ci.non_grouped_results_singlekey(db_name=app.config["COUCHDB_HISTORIC_DB"], \
+        return tweets_to_geojson_SE(self.fetch())
+
+    def fetch(self):
+        ci = get_couch_interface()
+        return ci.non_grouped_results_singlekey(db_name=app.config["COUCHDB_HISTORIC_DB"], \
         design_doc=app.config["DESIGN_DOC"], view_name=app.config["VIEW_FOR_SOCIAL_TWEETS"])
 
-        return tweets_to_geojson_SE(valid_tweets)
+
+class AsyncSE_Tweets(AsyncResource, SE_Tweets):
+    async def fetch_async(self, aci):
+        return await aci.non_grouped_results_singlekey(app.config["COUCHDB_HISTORIC_DB"], app.config["DESIGN_DOC"], \
+        app.config["VIEW_FOR_SOCIAL_TWEETS"])
 
 
 class Seifa(Resource):
@@ -346,33 +481,47 @@ class Seifa(Resource):
     # { "type": "Feature", "properties": { "SA2_MAIN16": "206011105", "SA2_NAME16": "Brunswick", "irsad_score":1106},
     #   "geometry": { "type": "Polygon", "coordinates": [ [ [ 144.94974, -37.76277 ], [ 144.95003, -37.76105 ] ] ] } }
     def get(self):
-        ci = create_couch_interface()
+        # served from the response cache, built again when the seifa or polygon data changes
+        return response_cache.respond('seifa', update_seqs(app.config["SEIFA"], app.config["AUSTGEO"]), self.build)
+
+    def build(self):
         # load language info and polygons of sa2's from database
-        sa2_seifas = ci.non_grouped_results(db_name=app.config["SEIFA"], \
-        design_doc=app.config["DESIGN_DOC_AURIN"], view_name=app.config["VIEW_FOR_AURIN"])
-        sa2_polygons = ci.non_grouped_results(db_name=app.config["AUSTGEO"], \
-        design_doc=app.config["DESIGN_DOC_AURIN"], view_name=app.config["VIEW_FOR_AURIN"])
+        sa2_seifas, sa2_polygons = self.fetch()
 
         # join two outputs, and output a geojson string
         return join_seifa_and_polygons(sa2_seifas, sa2_polygons)
 
+    def fetch(self):
+        ci = get_couch_interface()
+        # both views are read at the same time
+        return ci.non_grouped_results_many([
+            (app.config["SEIFA"], app.config["DESIGN_DOC_AURIN"], app.config["VIEW_FOR_AURIN"]),
+            (app.config["AUSTGEO"], app.config["DESIGN_DOC_AURIN"], app.config["VIEW_FOR_AURIN"])])
+
+
+class AsyncSeifa(AsyncResource, Seifa):
+    async def fetch_async(self, aci):
+        return await asyncio.gather(
+            aci.non_grouped_results(app.config["SEIFA"], app.config["DESIGN_DOC_AURIN"], \
+            app.config["VIEW_FOR_AURIN"]),
+            aci.non_grouped_results(app.config["AUSTGEO"], app.config["DESIGN_DOC_AURIN"], \
+            app.config["VIEW_FOR_AURIN"]))
+
 
 class Issues_Sentiment(Resource):
     # Return a dict (miniature dataframe):
     # { ‘mean_compound’: list, 'count': list, ‘issue’: list of all the issues}
     def get(self, scenario_id):
         abort_if_scenario_doesnt_exist(scenario_id)
-        # initialize a CouchInterface object to retrive data from couchdb
-        ci = create_couch_interface()
         scenario = deepcopy(analytics[scenario_id])
 
         if (scenario_id == "socioeconomic"):
-            # get queried results in a list of dict: e.g.
-            # {'Aged care': { "sum":-33.6484, "count": 190, "min": -0.8442, "max": 0.6597, "sumsqr": 36.8765}}
-            db_name = app.config["COUCHDB_NEW_DB"]
-            design_doc = app.config["DESIGN_DOC"]
-            view_name = app.config["VIEW_FOR_SOCIAL"]
-            results = ci.grouped_results_singlekey(db_name, design_doc, view_name)
+            # get aggregated results in a list of dict: e.g.
+            # {'aged care': { "sum":-33.6484, "count": 190, "min": -0.8442, "max": 0.6597, "sumsqr": 36.8765}}
+            if aggregates_ready(app.config["COUCHDB_NEW_DB"]):
+                results = get_aggregates().stats(app.config["COUCHDB_NEW_DB"], 'issue')
+            else:
+                results = self.fetch()
 
             # convert into a dict of lists (like a dataframe)
             avgs = []
@@ -380,7 +529,8 @@ class Issues_Sentiment(Resource):
             issues = []
             for result in results:
                 issue = list(result.keys())[0]
-                issues.append(issue)
+                # issue tags are lower case, e.g. 'aged care' is shown as 'Aged care'
+                issues.append(issue.capitalize())
                 avgs.append(result[issue]['sum'] / result[issue]['count'])
                 counts.append(result[issue]['count'])
 
@@ -389,21 +539,34 @@ class Issues_Sentiment(Resource):
 
         return scenario
 
+    def fetch(self):
+        return get_couch_interface().grouped_results_singlekey(app.config["COUCHDB_NEW_DB"], \
+        app.config["DESIGN_DOC"], app.config["VIEW_FOR_SOCIAL"])
+
+
+class AsyncIssues_Sentiment(AsyncResource, Issues_Sentiment):
+    async def fetch_async(self, aci):
+        return await aci.grouped_results_singlekey(app.config["COUCHDB_NEW_DB"], app.config["DESIGN_DOC"], \
+        app.config["VIEW_FOR_SOCIAL"])
+
 
 # Resources
+# with COUCHDB_ASYNC, the resources reading couchDB use the asyncio client
+use_async = app.config["COUCHDB_ASYNC"]
 api.add_resource(API, '/api/')
 # general info
 api.add_resource(Analytics, '/api/analytics/')
 # election scenario
 api.add_resource(Diversity, '/api/analytics/diversity/')
-api.add_resource(Tweets, '/api/analytics/diversity/tweets/')
-api.add_resource(Language, '/api/analytics/diversity/language/')
-api.add_resource(Sentiment, '/api/analytics/<string:scenario_id>/sentiment/')
+api.add_resource(AsyncTweets if use_async else Tweets, '/api/analytics/diversity/tweets/')
+api.add_resource(AsyncLanguage if use_async else Language, '/api/analytics/diversity/language/')
+api.add_resource(AsyncSentiment if use_async else Sentiment, '/api/analytics/<string:scenario_id>/sentiment/')
 # socioeconomic scenario
 api.add_resource(Socioeconomic, '/api/analytics/socioeconomic/')
-api.add_resource(SE_Tweets, '/api/analytics/socioeconomic/tweets/')
-api.add_resource(Seifa, '/api/analytics/socioeconomic/seifa/')
-api.add_resource(Issues_Sentiment, '/api/analytics/<string:scenario_id>/election-issues/')
+api.add_resource(AsyncSE_Tweets if use_async else SE_Tweets, '/api/analytics/socioeconomic/tweets/')
+api.add_resource(AsyncSeifa if use_async else Seifa, '/api/analytics/socioeconomic/seifa/')
+api.add_resource(AsyncIssues_Sentiment if use_async else Issues_Sentiment, \
+'/api/analytics/<string:scenario_id>/election-issues/')
 
 # connect to database
 # couchdb_url = f'http://{app.config["COUCHDB_USER"]}:{app.config["COUCHDB_PASSWORD"]}@{app.config["COUCHDB_IP"]}:{app.config["COUCHDB_PORT"]}/'
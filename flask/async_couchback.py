@@ -0,0 +1,175 @@
+import asyncio
+import concurrent.futures
+import json
+import threading
+
+import aiohttp
+
+from couchback_temp import group_view_queries
+
+
+class AsyncCouchInterface:
+    """
+    asyncio version of CouchInterface for the API: views, grouped and non-grouped results and bulk docs over one
+    pooled aiohttp session, so the views a request needs are awaited together instead of one after the other, and
+    a waiting request holds no connection or thread of its own. The session belongs to the event loop the first call
+    runs on; use the interface from that loop only, e.g. through an EventLoopThread.
+    """
+    def __init__(self, address='172.26.131.244', port='5984', username='admin', password='password',
+                 pool_size=100, timeout=30, cache=None):
+        """
+        :param pool_size: [optional] connections kept open to the server
+        :param timeout: [optional] seconds before a request to CouchDB is given up
+        :param cache: [optional] a ViewCache for the rows read by the *_results methods, which can be shared with a
+                      CouchInterface
+        """
+        self.username = username
+        self.password = password
+        self.address = address
+        self.port = port
+        self.url = 'http://' + self.address + ':' + self.port + '/'
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.cache = cache
+        self.session = None
+
+    def _session(self) -> aiohttp.ClientSession:
+        if self.session is None:
+            self.session = aiohttp.ClientSession(auth=aiohttp.BasicAuth(self.username, self.password),
+                                                 connector=aiohttp.TCPConnector(limit=self.pool_size),
+                                                 timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self.session
+
+    async def _view_rows(self, db_name: str, design_doc: str, view_name: str, **params) -> list:
+        # rows of a view, through the cache if there is one; cached rows are shared, so they must not be modified
+        url = self.url + db_name + '/_design/' + design_doc + '/_view/' + view_name
+        params = {name: json.dumps(value) for name, value in params.items()}
+        if self.cache is None:
+            async with self._session().get(url, params=params) as resp:
+                resp.raise_for_status()
+                return (await resp.json(content_type=None))['rows']
+        key = (db_name, design_doc, view_name, tuple(sorted(params.items())))
+        entry = self.cache.get(key)
+        if entry is not None and self.cache.fresh(key, entry):
+            self.cache.count('hits')
+            return entry['rows']
+        headers = {'If-None-Match': entry['etag']} if entry is not None and entry['etag'] else {}
+        try:
+            async with self._session().get(url, params=params, headers=headers) as resp:
+                if resp.status == 304:
+                    self.cache.revalidate(entry)
+                    return entry['rows']
+                resp.raise_for_status()
+                body = await resp.read()
+                etag = resp.headers.get('ETag')
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if entry is None:
+                raise
+            # CouchDB is down or failing, an old answer is better than none
+            self.cache.count('stale')
+            print(f'Failed to read {db_name}/{design_doc}/{view_name} ({type(e).__name__}), serving the cached rows')
+            return entry['rows']
+        self.cache.count('misses')
+        rows = json.loads(body)['rows']
+        self.cache.put(key, etag, rows, len(body))
+        return rows
+
+    async def get_view(self, database: str, design_name: str, view_name: str, **params) -> dict:
+        """
+        :param database: the name of specific database
+        :param design_name: the name of design document
+        :param view_name: the name of view you want
+        :param params: view query parameters as JSON values, e.g. group_level=1
+        :return: a dictionary of view
+        """
+        url = self.url + database + '/_design/' + design_name + '/_view/' + view_name
+        params = {name: json.dumps(value) for name, value in params.items()}
+        async with self._session().get(url, params=params) as resp:
+            return await resp.json(content_type=None)
+
+    async def get_views(self, queries: list) -> list:
+        """
+        Same as CouchInterface.get_views: queries of the same view are sent in one POST to its _view/queries endpoint,
+        the others go through the cache, and all the views are awaited together.
+
+        :param queries: a list of (db_name, design_doc, view_name) or (db_name, design_doc, view_name, params)
+        :return: a list of the rows of each query, in the order of queries
+        """
+        groups = group_view_queries(queries)
+
+        async def read(view, params_list):
+            if len(params_list) == 1:
+                return [await self._view_rows(*view, **params_list[0])]
+            db_name, design_doc, view_name = view
+            url = self.url + db_name + '/_design/' + design_doc + '/_view/' + view_name + '/queries'
+            async with self._session().post(url, json={'queries': params_list}) as resp:
+                resp.raise_for_status()
+                return [result['rows'] for result in (await resp.json(content_type=None))['results']]
+
+        results = [None] * len(queries)
+        groups_rows = await asyncio.gather(*[read(view, [params for _, params in members])
+                                             for view, members in groups.items()])
+        for members, rows in zip(groups.values(), groups_rows):
+            for (i, _), view_rows in zip(members, rows):
+                results[i] = view_rows
+        return results
+
+    async def grouped_results(self, db_name, design_doc, view_name):
+        rows = await self._view_rows(db_name, design_doc, view_name, group=True)
+        return [{item['key'][1]: item['value']} for item in rows]
+
+    async def grouped_results_singlekey(self, db_name, design_doc, view_name):
+        rows = await self._view_rows(db_name, design_doc, view_name, group=True)
+        return [{item['key']: item['value']} for item in rows]
+
+    async def non_grouped_results(self, db_name, design_doc, view_name):
+        rows = await self._view_rows(db_name, design_doc, view_name)
+        return [{item['key'][1]: item['value']} for item in rows]
+
+    async def non_grouped_results_singlekey(self, db_name, design_doc, view_name):
+        rows = await self._view_rows(db_name, design_doc, view_name)
+        return [{item['key']: item['value']} for item in rows]
+
+    async def bulk_docs(self, db_name: str, docs: list) -> list:
+        """
+        :param db_name: the name of specific database
+        :param docs: the documents to save, with _rev to update existing ones
+        :return: the result of each document, {'ok': True, 'id', 'rev'} or {'id', 'error', 'reason'}
+        """
+        async with self._session().post(self.url + db_name + '/_bulk_docs', json={'docs': docs}) as resp:
+            resp.raise_for_status()
+            return await resp.json(content_type=None)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+class EventLoopThread:
+    """
+    An event loop running in a daemon thread, for synchronous code such as Flask-RESTful resources to run coroutines
+    on. Every thread of the process shares its loop, and so the connection pool of an AsyncCouchInterface used on it.
+    """
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='event-loop', daemon=True)
+        self.thread.start()
+
+    def run(self, coro, timeout=None):
+        """
+        :param coro: the coroutine to run on the loop
+        :param timeout: [optional] seconds to wait for it
+        :return: its result, or raises its exception
+        """
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            # do not leave the coroutine holding connections after the request gave up on it
+            future.cancel()
+            raise
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
@@ -12,6 +12,16 @@ COUCHDB_PORT = 5984
 COUCHDB_USER = 'admin'
 # password for couchDB
 COUCHDB_PASSWORD = 'password'
+# connections each worker process keeps open to couchDB
+COUCHDB_POOL_SIZE = 10
+# seconds before a request to couchDB is given up
+COUCHDB_TIMEOUT = 30
+# times a failed request to couchDB is retried
+COUCHDB_RETRIES = 3
+# read couchDB with the asyncio client, all the views of a request awaited together
+COUCHDB_ASYNC = True
+# connections each worker process keeps open to couchDB with the asyncio client
+COUCHDB_ASYNC_POOL_SIZE = 100
 # database for tweets
 COUCHDB_HISTORIC_DB = "twitter_historic"
 COUCHDB_NEW_DB = "twitter_new"
@@ -28,3 +38,21 @@ VIEW_FOR_SOCIAL = "socioeconomic_sentiment_stats"
 VIEW_FOR_ELECTION_TWEETS = "election_tweets"
 VIEW_FOR_SOCIAL_TWEETS = "socioeconomic_tweets"
 VIEW_FOR_AURIN = "default"
+# views read by the API are cached in each worker process, up to this many bytes of responses
+VIEW_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# seconds a cached view is served before it is checked against couchDB again
+VIEW_CACHE_TTL = 60
+# databases of reference data that rarely change, their cached views are only read again when their update
+# sequence moves
+VIEW_CACHE_STATIC_DBS = [LSAHBSC, SEIFA, AUSTGEO]
+# GeoJSON responses of the AURIN data are cached serialized and compressed in each worker process; seconds between
+# checks of the update sequences of their databases
+RESPONSE_CACHE_CHECK_INTERVAL = 30
+# seconds browsers may use a cached response before revalidating it with its ETag
+RESPONSE_CACHE_MAX_AGE = 300
+# SQLite file of the sentiment aggregates, kept up to date by aggregates.py
+AGGREGATES_PATH = "aggregates.sqlite"
+# tweet databases whose sentiment is read from the aggregates instead of the _stats views. The aggregates only count
+# tagged tweets, so add a database once reenrich.py has tagged all of its tweets; it is only read from the aggregates
+# after aggregates.py has also caught up with it
+AGGREGATES_DBS = []
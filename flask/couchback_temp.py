@@ -1,17 +1,223 @@
 import couchdb
 import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pandas as pd
 
 
+def group_view_queries(queries: list) -> dict:
+    """
+    :param queries: a list of (database, design_name, view_name) or (database, design_name, view_name, params)
+    :return: a dictionary of each (database, design_name, view_name) to the list of (index, params) of its queries
+    """
+    groups = {}
+    for i, query in enumerate(queries):
+        params = query[3] if len(query) > 3 else {}
+        groups.setdefault(tuple(query[:3]), []).append((i, params))
+    return groups
+
+
+def read_view_queries(queries: list, read, max_workers: int = 8) -> list:
+    """
+    Group view queries by view and read the views concurrently, so several queries of one view go out in a single
+    request and the call takes about as long as the slowest view. The flask image only ships this directory, so this and
+    group_view_queries are the same helpers as in views/couchback.py.
+
+    :param queries: a list of (database, design_name, view_name) or (database, design_name, view_name, params)
+    :param read: function taking a (database, design_name, view_name) tuple and the list of params of its queries,
+                 returning one result per query
+    :param max_workers: [optional] views read at the same time
+    :return: a list of the results of each query, in the order of queries
+    """
+    groups = group_view_queries(queries)
+    results = [None] * len(queries)
+
+    def read_group(view, members):
+        for (i, _), result in zip(members, read(view, [params for _, params in members])):
+            results[i] = result
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(groups)))) as executor:
+        for future in [executor.submit(read_group, view, members) for view, members in groups.items()]:
+            future.result()
+    return results
+
+
+class ViewCache:
+    """
+    Least recently used cache of view rows, keyed by database, design document, view and query parameters and
+    bounded by the size of the responses. An entry is served without asking CouchDB for ttl seconds and is then
+    revalidated with a conditional GET on its ETag, which costs no transfer if the view did not change. Views of
+    static_databases, reference data that rarely changes, are only dropped when track sees their update sequence move.
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=60, static_databases=()):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.static_databases = set(static_databases)
+        self.entries = OrderedDict()
+        self.size = 0
+        self.seqs = {}
+        self.lock = threading.Lock()
+        self.hits = self.revalidated = self.misses = self.stale = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def fresh(self, key, entry):
+        return key[0] in self.static_databases or time.monotonic() - entry['validated'] < self.ttl
+
+    def put(self, key, etag, rows, size):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old['size']
+            if size > self.max_bytes:
+                return
+            self.entries[key] = {'etag': etag, 'rows': rows, 'size': size, 'validated': time.monotonic()}
+            self.size += size
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted['size']
+
+    def track(self, db_name, update_seq):
+        """
+        Drop the cached views of a database if its update sequence is not the one last tracked.
+
+        :param db_name: the name of the database
+        :param update_seq: its current update sequence
+        :return: None
+        """
+        with self.lock:
+            if self.seqs.get(db_name) == update_seq:
+                return
+            self.seqs[db_name] = update_seq
+            for key in [key for key in self.entries if key[0] == db_name]:
+                self.size -= self.entries.pop(key)['size']
+
+    def count(self, counter):
+        # the counters are shared by every request thread
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def revalidate(self, entry):
+        with self.lock:
+            self.revalidated += 1
+            entry['validated'] = time.monotonic()
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.size, 'hits': self.hits,
+                    'revalidated': self.revalidated, 'misses': self.misses, 'stale': self.stale}
+
+
 class CouchInterface:
-    def __init__(self, address='172.26.131.244', port='5984', username='admin', password='password'):
+    def __init__(self, address='172.26.131.244', port='5984', username='admin', password='password',
+                 pool_size=10, timeout=30, retries=3, cache=None):
+        """
+        Every request of an interface goes through its own keep-alive sessions, so connections to CouchDB are pooled
+        and reused instead of opened for each call. Create one interface and share it rather than one per request.
+
+        :param pool_size: [optional] connections kept open to the server
+        :param timeout: [optional] seconds before a request to CouchDB is given up
+        :param retries: [optional] times a failed connection, or a 5xx response to a GET, is retried with backoff
+        :param cache: [optional] a ViewCache for the rows read by the *_results methods
+        """
         self.username = username
         self.password = password
         self.address = address
         self.port = port
         self.url = 'http://' + self.username + ':' + self.password + '@' + self.address + ':' + self.port + '/'
-        self.server = couchdb.Server(self.url)
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                              max_retries=Retry(total=retries, backoff_factor=0.5, allowed_methods=('GET', 'HEAD'),
+                                                status_forcelist=(500, 502, 503, 504), raise_on_status=False))
+        self.session.mount('http://', adapter)
+        self.server = couchdb.Server(self.url, session=couchdb.http.Session(
+            timeout=timeout, retry_delays=[0.5 * 2 ** i for i in range(retries)]))
+        self.cache = cache
+
+    def _get(self, url: str, **kwargs) -> requests.Response:
+        return self.session.get(url, timeout=self.timeout, **kwargs)
+
+    def _put(self, url: str, **kwargs) -> requests.Response:
+        return self.session.put(url, timeout=self.timeout, **kwargs)
+
+    def _view_rows(self, db_name: str, design_doc: str, view_name: str, **params) -> list:
+        # rows of a view, through the cache if there is one; cached rows are shared, so they must not be modified
+        url = self.url + db_name + '/_design/' + design_doc + '/_view/' + view_name
+        params = {name: json.dumps(value) for name, value in params.items()}
+        if self.cache is None:
+            resp = self._get(url, params=params)
+            resp.raise_for_status()
+            return resp.json()['rows']
+        key = (db_name, design_doc, view_name, tuple(sorted(params.items())))
+        entry = self.cache.get(key)
+        if entry is not None and self.cache.fresh(key, entry):
+            self.cache.count('hits')
+            return entry['rows']
+        headers = {'If-None-Match': entry['etag']} if entry is not None and entry['etag'] else {}
+        try:
+            resp = self._get(url, params=params, headers=headers)
+            if resp.status_code == 304:
+                self.cache.revalidate(entry)
+                return entry['rows']
+            resp.raise_for_status()
+        except requests.RequestException as e:
+            if entry is None:
+                raise
+            # CouchDB is down or failing, an old answer is better than none
+            self.cache.count('stale')
+            print(f'Failed to read {db_name}/{design_doc}/{view_name} ({type(e).__name__}), serving the cached rows')
+            return entry['rows']
+        self.cache.count('misses')
+        rows = resp.json()['rows']
+        self.cache.put(key, resp.headers.get('ETag'), rows, len(resp.content))
+        return rows
+
+    def update_seqs(self, db_names: list) -> list:
+        """
+        :param db_names: the names of the databases
+        :return: the update sequence of each database, tracked by the cache so views of changed ones are read again
+        """
+        seqs = []
+        for db_name in db_names:
+            resp = self._get(self.url + db_name)
+            resp.raise_for_status()
+            seqs.append(resp.json()['update_seq'])
+            if self.cache is not None:
+                self.cache.track(db_name, seqs[-1])
+        return seqs
+
+    def get_views(self, queries: list, max_workers: int = 8) -> list:
+        """
+        Run several view queries at once. Queries of the same view are sent together in one POST to its _view/queries
+        endpoint (CouchDB batches queries per view, not per design document), the others go through the cache, and the
+        views, of one database or several, are read concurrently, so the call takes about as long as the slowest view.
+
+        :param queries: a list of (db_name, design_doc, view_name) or (db_name, design_doc, view_name, params), where
+                        params are view query parameters as JSON values, e.g. {'group': True}
+        :param max_workers: [optional] views read at the same time
+        :return: a list of the rows of each query, in the order of queries
+        """
+        def read(view, params_list):
+            if len(params_list) == 1:
+                return [self._view_rows(*view, **params_list[0])]
+            db_name, design_doc, view_name = view
+            url = self.url + db_name + '/_design/' + design_doc + '/_view/' + view_name + '/queries'
+            resp = self.session.post(url, json={'queries': params_list}, timeout=self.timeout)
+            resp.raise_for_status()
+            return [result['rows'] for result in resp.json()['results']]
+
+        return read_view_queries(queries, read, max_workers)
 
     def _create_design(self, database: str, design_name: str):
         db = self.server[database]
@@ -34,7 +240,7 @@ class CouchInterface:
         :param view_name: the name of view you want
         :return:
         """
-        resp = requests.get(self.url + database + '/_design/' + design_name + '/_view/' + view_name)
+        resp = self._get(self.url + database + '/_design/' + design_name + '/_view/' + view_name)
         view = json.loads(resp.text)
         return view
 
@@ -55,8 +261,8 @@ class CouchInterface:
         map_fun = 'function (doc) { var reg = ' + regex + '; ' \
             'if (reg.test(doc.' + field + ')) { emit(doc.' + field + ', doc._id); } }'
         data = {'views': {view_name: {'map': map_fun}}}
-        requests.put(self.url + database + '/' + design_name, data=json.dumps(data))
-        resp = requests.get(self.url + database + '/' + design_name + '/_view/' + view_name)
+        self._put(self.url + database + '/' + design_name, data=json.dumps(data))
+        resp = self._get(self.url + database + '/' + design_name + '/_view/' + view_name)
         view = json.loads(resp.text)
         return view
 
@@ -82,10 +288,10 @@ class CouchInterface:
             map_fun = 'function (doc) { var reg = ' + regexes[i] + '; ' \
                 'if (reg.test(doc.' + fields[i] + ')) { emit(' + '"' + regexes[i][1:-2] + '"' + ', doc._id); } }'
             data['views'][view_name] = {'map': map_fun}
-        requests.put(self.url + database + '/' + design_name, data=json.dumps(data))
+        self._put(self.url + database + '/' + design_name, data=json.dumps(data))
         views = []
         for view_name in views_name:
-            resp = requests.get(self.url + database + '/' + design_name + '/_view/' + view_name)
+            resp = self._get(self.url + database + '/' + design_name + '/_view/' + view_name)
             view = json.loads(resp.text)
             views.append(view)
         return views
@@ -121,8 +327,8 @@ class CouchInterface:
 
         data = {'views': {view_name: {'map': map_fun}}}
 
-        print(requests.put(self.url + database + '/' + design_name, data=json.dumps(data)).json())
-        resp = requests.get(self.url + database + '/' + design_name + '/_view/' + view_name)
+        print(self._put(self.url + database + '/' + design_name, data=json.dumps(data)).json())
+        resp = self._get(self.url + database + '/' + design_name + '/_view/' + view_name)
         view = json.loads(resp.text)
         return view
 
@@ -130,21 +336,17 @@ class CouchInterface:
         """
         a database has a design document and view under the path /db_name/_design/design_doc/_view/view_name
         """
-        db = self.server[db_name]
-        path = design_doc + '/' + view_name
         results = []
-        for item in db.view(path, group=True):
-            results.append({item.key[1] : item.value})
+        for item in self._view_rows(db_name, design_doc, view_name, group=True):
+            results.append({item['key'][1] : item['value']})
 
         return results
 
     def grouped_results_singlekey(self, db_name, design_doc, view_name):
         # key is no longer a list of two elements as before
-        db = self.server[db_name]
-        path = design_doc + '/' + view_name
         results = []
-        for item in db.view(path, group=True):
-            results.append({item.key : item.value})
+        for item in self._view_rows(db_name, design_doc, view_name, group=True):
+            results.append({item['key'] : item['value']})
 
         return results
 
@@ -152,21 +354,26 @@ class CouchInterface:
         """
         a database has a design document and view under the path /db_name/_design/design_doc/_view/view_name
         """
-        db = self.server[db_name]
-        path = design_doc + '/' + view_name
         results = []
-        for item in db.view(path):
-            results.append({item.key[1] : item.value})
+        for item in self._view_rows(db_name, design_doc, view_name):
+            results.append({item['key'][1] : item['value']})
 
         return results
 
+    def non_grouped_results_many(self, views):
+        """
+        Same as non_grouped_results for several views at once, read concurrently with get_views.
+
+        :param views: a list of (db_name, design_doc, view_name)
+        :return: a list of the results of each view
+        """
+        return [[{item['key'][1] : item['value']} for item in rows] for rows in self.get_views(views)]
+
     def non_grouped_results_singlekey(self, db_name, design_doc, view_name):
         # key is no longer a list of two elements as before
-        db = self.server[db_name]
-        path = design_doc + '/' + view_name
         results = []
-        for item in db.view(path):
-            results.append({item.key : item.value})
+        for item in self._view_rows(db_name, design_doc, view_name):
+            results.append({item['key'] : item['value']})
 
         return results
 
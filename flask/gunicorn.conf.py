@@ -1,5 +1,9 @@
 bind = "127.0.0.1:8000"
 workers = 4
+# gthread keeps connections on an event loop and hands requests to threads; a request thread only waits while the
+# asyncio client of its worker reads its views, so each worker serves many requests at once on one connection pool
+worker_class = 'gthread'
+threads = 32
 loglevel = 'debug'
 accesslog = './access_log_flask.log'
 errorlog = './error_log_flask.log'
@@ -0,0 +1,93 @@
+import gzip
+import hashlib
+import json
+import threading
+import time
+
+import brotli
+from flask import Response, request
+
+# encodings a cached response is stored in, in order of preference
+ENCODINGS = ['br', 'gzip']
+
+
+class ResponseCache:
+    """
+    Final responses of the API kept serialized, with their gzip and brotli compressed bodies and a strong ETag for
+    each encoding, so a request is answered without building, serializing or compressing anything. A response is
+    rebuilt only when the update sequence of one of the databases it is built from moved; the sequences are checked
+    at most every check_interval seconds. Requests with a matching If-None-Match get a 304 without a body.
+    """
+    def __init__(self, check_interval=30, max_age=300):
+        """
+        :param check_interval: [optional] seconds a response is served before the update sequences are checked again
+        :param max_age: [optional] seconds clients may use a response before revalidating it with its ETag
+        """
+        self.check_interval = check_interval
+        self.max_age = max_age
+        self.entries = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def _checked(self, entry):
+        return entry is not None and time.monotonic() - entry['checked'] < self.check_interval
+
+    def entry(self, key, update_seqs, build):
+        """
+        :param key: the name of the response
+        :param update_seqs: function returning the update sequences of the databases the response is built from
+        :param build: function returning the data of the response
+        :return: the cached entry of the response, built again if its databases changed
+        """
+        entry = self.entries.get(key)
+        if self._checked(entry):
+            return entry
+        with self.lock:
+            key_lock = self.locks.setdefault(key, threading.Lock())
+        # one thread builds a response, the others wait for it rather than build it as well
+        with key_lock:
+            entry = self.entries.get(key)
+            if self._checked(entry):
+                return entry
+            try:
+                seqs = update_seqs()
+            except Exception as e:
+                if entry is None:
+                    raise
+                # CouchDB is down or failing, the last response is better than none
+                print(f'Failed to check the databases of {key} ({type(e).__name__}), serving the cached response')
+                return entry
+            if entry is not None and entry['seqs'] == seqs:
+                entry['checked'] = time.monotonic()
+                return entry
+            body = (json.dumps(build(), separators=(',', ':')) + '\n').encode()
+            digest = hashlib.sha256(body).hexdigest()[:32]
+            bodies = {'identity': body, 'gzip': gzip.compress(body, 9), 'br': brotli.compress(body, quality=11)}
+            entry = {'seqs': seqs, 'checked': time.monotonic(), 'bodies': bodies,
+                     'etags': {encoding: digest if encoding == 'identity' else digest + '-' + encoding
+                               for encoding in bodies}}
+            self.entries[key] = entry
+            print(f"Built the {key} response: {len(body)} bytes, {len(bodies['gzip'])} gzip, "
+                  f"{len(bodies['br'])} brotli")
+            return entry
+
+    def respond(self, key, update_seqs, build):
+        """
+        Answer the current request from the cache.
+
+        :param key: the name of the response
+        :param update_seqs: function returning the update sequences of the databases the response is built from
+        :param build: function returning the data of the response
+        :return: a Response in the best encoding the client accepts, or 304 if it already has it
+        """
+        entry = self.entry(key, update_seqs, build)
+        encoding = next((encoding for encoding in ENCODINGS if request.accept_encodings[encoding]), 'identity')
+        etag = entry['etags'][encoding]
+        resp = Response(status=304) if request.if_none_match.contains_weak(etag) else \
+            Response(entry['bodies'][encoding], mimetype='application/json')
+        resp.set_etag(etag)
+        resp.headers['Cache-Control'] = f'public, max-age={self.max_age}'
+        resp.headers['Vary'] = 'Accept-Encoding'
+        if encoding != 'identity' and resp.status_code == 200:
+            resp.headers['Content-Encoding'] = encoding
+        return resp
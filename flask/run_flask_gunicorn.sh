@@ -1,2 +1,4 @@
 #!/usr/bin/env bash
+# keep the sentiment aggregates read by the API up to date from the _changes feeds
+nohup python aggregates.py >> aggregates.log 2>&1 &
 gunicorn -D -c gunicorn.conf.py app:app
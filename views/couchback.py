@@ -1,17 +1,87 @@
-from typing import Any, Optional, Union
+from typing import Any, Iterator, Optional, Union
 import couchdb
+import hashlib
 import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+def group_view_queries(queries: list) -> dict:
+    """
+    :param queries: a list of (database, design_name, view_name) or (database, design_name, view_name, params)
+    :return: a dictionary of each (database, design_name, view_name) to the list of (index, params) of its queries
+    """
+    groups = {}
+    for i, query in enumerate(queries):
+        params = query[3] if len(query) > 3 else {}
+        groups.setdefault(tuple(query[:3]), []).append((i, params))
+    return groups
+
+
+def read_view_queries(queries: list, read, max_workers: int = 8) -> list:
+    """
+    Group view queries by view and read the views concurrently, so several queries of one view go out in a single
+    request and the call takes about as long as the slowest view.
+
+    :param queries: a list of (database, design_name, view_name) or (database, design_name, view_name, params)
+    :param read: function taking a (database, design_name, view_name) tuple and the list of params of its queries,
+                 returning one result per query
+    :param max_workers: [optional] views read at the same time
+    :return: a list of the results of each query, in the order of queries
+    """
+    groups = group_view_queries(queries)
+    results = [None] * len(queries)
+
+    def read_group(view, members):
+        for (i, _), result in zip(members, read(view, [params for _, params in members])):
+            results[i] = result
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(groups)))) as executor:
+        for future in [executor.submit(read_group, view, members) for view, members in groups.items()]:
+            future.result()
+    return results
 
 
 class CouchInterface:
-    def __init__(self, address='172.26.131.244', port='5984', username='admin', password='password'):
+    def __init__(self, address='172.26.131.244', port='5984', username='admin', password='password',
+                 pool_size=10, timeout=30, retries=3):
+        """
+        Every request of an interface goes through its own keep-alive sessions, so connections to CouchDB are pooled
+        and reused instead of opened for each call. Create one interface and share it rather than one per request.
+
+        :param pool_size: [optional] connections kept open to the server
+        :param timeout: [optional] seconds before a request to CouchDB is given up
+        :param retries: [optional] times a failed connection, or a 5xx response to a GET, is retried with backoff
+        """
         self.username = username
         self.password = password
         self.address = address
         self.port = port
         self.url = 'http://' + self.username + ':' + self.password + '@' + self.address + ':' + self.port + '/'
-        self.server = couchdb.Server(self.url)
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                              max_retries=Retry(total=retries, backoff_factor=0.5, allowed_methods=('GET', 'HEAD'),
+                                                status_forcelist=(500, 502, 503, 504), raise_on_status=False))
+        self.session.mount('http://', adapter)
+        self.server = couchdb.Server(self.url, session=couchdb.http.Session(
+            timeout=timeout, retry_delays=[0.5 * 2 ** i for i in range(retries)]))
+        # design documents are deployed through it, so their views are built before anyone reads them
+        self.designs = DesignManager(self)
+
+    def _request(self, method: str, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def _get(self, url: str, **kwargs) -> requests.Response:
+        return self._request('GET', url, **kwargs)
+
+    def _put(self, url: str, **kwargs) -> requests.Response:
+        return self._request('PUT', url, **kwargs)
 
     def _create_design(self, database: str, design_name: str) -> None:
         db = self.server[database]
@@ -24,26 +94,18 @@ class CouchInterface:
         design_doc = db[design_id]
         db.delete(design_doc)
 
-    def _create_view(self, database: str, design_name: str, data: str,
+    def _create_view(self, database: str, design_name: str, views: dict,
                      view_name: str, return_mode: bool = True) -> Optional[dict]:
-        design_name = '_design/' + design_name
-        requests.put(self.url + database + '/' + design_name, data=data)
+        # without return_mode the views are built in the background, see DesignManager.deploy
+        self.designs.deploy(database, design_name, views, wait=return_mode)
         if return_mode:
-            resp = requests.get(self.url + database + '/' + design_name + '/_view/' + view_name)
-            view = json.loads(resp.text)
-            return view
+            return self.get_view(database, design_name, view_name)
 
-    def _create_views(self, database: str, design_name: str, data: str,
+    def _create_views(self, database: str, design_name: str, views: dict,
                       views_name: list, return_mode: bool = True) -> Optional[list]:
-        design_name = '_design/' + design_name
-        requests.put(self.url + database + '/' + design_name, data=data)
+        self.designs.deploy(database, design_name, views, wait=return_mode)
         if return_mode:
-            views = []
-            for view_name in views_name:
-                resp = requests.get(self.url + database + '/' + design_name + '/_view/' + view_name)
-                view = json.loads(resp.text)
-                views.append(view)
-            return views
+            return self.get_views([(database, design_name, view_name) for view_name in views_name])
 
     def get_view(self, database: str, design_name: str, view_name: str, group_level: int = None) -> dict:
         """
@@ -61,16 +123,79 @@ class CouchInterface:
             query = '?group_level=' + str(group_level)
         else:
             query = ''
-        resp = requests.get(self.url + database + '/' + design_name + '/_view/' + view_name + query)
+        resp = self._get(self.url + database + '/' + design_name + '/_view/' + view_name + query)
         view = json.loads(resp.text)
         return view
 
+    def get_views(self, queries: list, max_workers: int = 8) -> list:
+        """
+        Similar with get_view, but runs several view queries at once. Queries of the same view are sent together in
+        one POST to its _view/queries endpoint (CouchDB batches queries per view, not per design document), and the
+        views, of one database or several, are read concurrently, so the call takes about as long as the slowest view
+        instead of the sum of them.
+
+        :param queries: a list of (database, design_name, view_name) or (database, design_name, view_name, params),
+                        where params are view query parameters as JSON values, e.g. {'group_level': 1}
+        :param max_workers: [optional] views read at the same time
+        :return: a list of view dictionaries, in the order of queries
+        """
+        def read(view, params_list):
+            database, design_name, view_name = view
+            url = self.url + database + '/_design/' + design_name + '/_view/' + view_name
+            if len(params_list) == 1:
+                params = {name: json.dumps(value) for name, value in params_list[0].items()}
+                return [self._get(url, params=params).json()]
+            page = self._request('POST', url + '/queries', json={'queries': params_list}).json()
+            # an error, e.g. a missing view, is the answer to each of its queries
+            return page['results'] if 'results' in page else [page] * len(params_list)
+
+        return read_view_queries(queries, read, max_workers)
+
+    def iter_view(self, database: str, design_name: str, view_name: str, group_level: int = None,
+                  page_size: int = 1000, **params) -> Iterator[dict]:
+        """
+        Similar with get_view, but the rows are yielded one by one as the view is read in pages of page_size rows,
+        so memory use does not depend on the size of the view and the first rows arrive straight away. Pages are
+        requested with startkey and startkey_docid from the last row, or startkey alone for grouped views.
+
+        :param database: the name of specific database
+        :param design_name: the name of design document
+        :param view_name: the name of view you want
+        :param group_level: can be a number n, which means the n_th key field to group by
+        :param page_size: [optional] number of rows per request
+        :param params: other view query parameters, e.g. reduce=False for the rows of a view with a reduce function,
+                       or endkey; keys are JSON encoded for you
+        :return: an iterator of row dictionaries with key, value and (for map rows) id
+        """
+        url = self.url + database + '/_design/' + design_name + '/_view/' + view_name
+        query = {name: json.dumps(value) if name in ('key', 'startkey', 'endkey') or isinstance(value, bool)
+                 else value for name, value in params.items()}
+        if group_level:
+            query['group_level'] = group_level
+        query['limit'] = page_size
+        while True:
+            resp = self._get(url, params=query)
+            page = resp.json()
+            if 'error' in page:
+                e = RuntimeError(f'Failed to read view {design_name}/{view_name}: {page["error"]}, '
+                                 f'{page.get("reason")}')
+                raise e
+            rows = page['rows']
+            yield from rows
+            if len(rows) < page_size:
+                return
+            # continue after the last row; rows of a grouped view have no id and unique keys
+            query['startkey'] = json.dumps(rows[-1]['key'])
+            if 'id' in rows[-1]:
+                query['startkey_docid'] = rows[-1]['id']
+            query['skip'] = 1
+
     def create_regex_view(self, database: str, field: str, regex: str,
                           design_name: str, view_name: str = 'default') -> dict:
         """
         This method creates a new design document, and creates a view whose curtain field satisfying the regex given.
-        Note: A design_name can only be used once. If you specify an existing design_name for another regex rule, it
-        will not be overwritten. If you do want to overwrite a design document, please delete the older one first.
+        Note: If you specify an existing design_name for another regex rule, the views of that design document are
+        replaced by this one, once it is built (see DesignManager). Creating the same view again does nothing.
 
         :param database: the name of specific database
         :param field: if you want to specify a member of a field, please use '.' to separate them.
@@ -81,9 +206,8 @@ class CouchInterface:
         """
         map_fun = 'function (doc) { var reg = ' + regex + '; ' \
             'if (reg.test(doc.' + field + ')) { emit(doc.' + field + ', doc); } }'
-        data = {'views': {view_name: {'map': map_fun}}}
-        data_str = json.dumps(data)
-        return self._create_view(database, design_name, data_str, view_name)
+        views = {view_name: {'map': map_fun}}
+        return self._create_view(database, design_name, views, view_name)
 
     def create_regex_views(self, database: str, fields: list, regexes: list,
                            design_name: str, views_name: list) -> list:
@@ -99,14 +223,13 @@ class CouchInterface:
         :return: a list of views
         """
         assert len(fields) == len(regexes) == len(views_name)
-        data = {'views': {}}
+        views = {}
         for i, view_name in enumerate(views_name):
             map_fun = 'function (doc) { var reg = ' + regexes[i] + '; ' \
                 'if (reg.test(doc.' + fields[i] + ')) { emit(doc.' + \
                       fields[i] + ', doc); } }'
-            data['views'][view_name] = {'map': map_fun}
-        data_str = json.dumps(data)
-        return self._create_views(database, design_name, data_str, views_name)
+            views[view_name] = {'map': map_fun}
+        return self._create_views(database, design_name, views, views_name)
 
     def create_mapreduce_view(self, database: str, design_name: str, map_fun: str, reduce_fun: str = None,
                               view_name: str = 'default', return_mode: bool = True) -> Optional[dict]:
@@ -123,11 +246,10 @@ class CouchInterface:
         :return: the view created
         """
         if reduce_fun:
-            data = {'views': {view_name: {'map': map_fun, 'reduce': reduce_fun}}}
+            views = {view_name: {'map': map_fun, 'reduce': reduce_fun}}
         else:
-            data = {'views': {view_name: {'map': map_fun}}}
-        data_str = json.dumps(data)
-        return self._create_view(database, design_name, data_str, view_name, return_mode=return_mode)
+            views = {view_name: {'map': map_fun}}
+        return self._create_view(database, design_name, views, view_name, return_mode=return_mode)
 
     def create_mapreduce_views(self, database: str, design_name: str, mapreduce_funcs: list,
                                views_name: list, return_mode: bool = True) -> Optional[list]:
@@ -144,17 +266,16 @@ class CouchInterface:
         :return: a list of view dictionary
         """
         assert len(mapreduce_funcs) == len(views_name)
-        data = {'views': {}}
+        views = {}
         for i, func_pair in enumerate(mapreduce_funcs):
             if len(func_pair) == 1:
-                data['views'][views_name[i]] = {'map': func_pair[0]}
+                views[views_name[i]] = {'map': func_pair[0]}
             elif len(func_pair) == 2:
-                data['views'][views_name[i]] = {'map': func_pair[0], 'reduce': func_pair[1]}
+                views[views_name[i]] = {'map': func_pair[0], 'reduce': func_pair[1]}
             else:
                 e = RuntimeError('The element of mapreduce_funcs should be a list of one or two string of functions.')
                 raise e
-        data_str = json.dumps(data)
-        return self._create_views(database, design_name, data_str, views_name, return_mode=return_mode)
+        return self._create_views(database, design_name, views, views_name, return_mode=return_mode)
 
     def create_regex_view_combined(self, database: str, field: str, regexes: list, design_name: str,
                                    view_name: str = "election_tweets"):
@@ -163,8 +284,6 @@ class CouchInterface:
         single view.
         """
 
-        design_name = '_design/' + design_name
-
         regs_str = "["
         for i, reg in enumerate(regexes):
             regs_str += reg
@@ -187,12 +306,28 @@ class CouchInterface:
                   '}' + \
                   '}'
 
-        data = {'views': {view_name: {'map': map_fun}}}
+        views = {view_name: {'map': map_fun}}
+        return self._create_view(database, design_name, views, view_name)
 
-        print(requests.put(self.url + database + '/' + design_name, data=json.dumps(data)).json())
-        resp = requests.get(self.url + database + '/' + design_name + '/_view/' + view_name)
-        view = json.loads(resp.text)
-        return view
+    def create_tag_view(self, database: str, design_name: str, view_name: str = 'tags_per_sa2',
+                        return_mode: bool = True) -> Optional[dict]:
+        """
+        Create a view of the sentiment of tagged tweets, keyed by [tag, sa2], with a _stats reduce. The harvester tags
+        each document once at ingest (see data_harvest/harvester/tagging.py), so this view only reads doc.tags instead
+        of testing regexes against every tweet like create_regex_view_combined does. The tags come from the full text
+        of extended tweets rather than tweet.text, so a keyword past the truncation still tags the tweet. Query it with
+        group_level=1 for the totals per tag, or group_level=2 for each SA2.
+
+        :param database: the name of specific database
+        :param design_name: You must specify a name of new design document.
+        :param view_name: [optional] default is 'tags_per_sa2'
+        :param return_mode: determine whether to get the view back
+        :return: the view created
+        """
+        map_fun = 'function (doc) { if (doc.tags && doc.sa2 && doc.sentiment) { ' \
+                  'for (var i = 0; i < doc.tags.length; i++) { ' \
+                  'emit([doc.tags[i], doc.sa2], doc.sentiment.compound); } } }'
+        return self.create_mapreduce_view(database, design_name, map_fun, '_stats', view_name, return_mode)
 
     def grouping_results(self, db_name, design_doc, view_name):
         """
@@ -207,6 +342,149 @@ class CouchInterface:
         return results
 
 
+class DesignManager:
+    """
+    Deploys design documents so that nobody reading a view waits for its index to be built. A design document is
+    only written when the hash of its views changed. The new version is first saved as <design_name>-staging, its
+    index is built in the background and watched through _active_tasks, and only then is it copied over the live
+    design document. CouchDB keys view indexes by the content of the views, so the live document picks up the index
+    built for the staging one and its readers keep the old views until the new ones are ready.
+
+    A deployment interrupted with its process is picked up by deploying the same views again.
+    """
+    def __init__(self, couch_itf: CouchInterface, poll_interval: float = 5.0, verbose: bool = True):
+        self.couch = couch_itf
+        self.poll_interval = poll_interval
+        self.verbose = verbose
+        # (database, design_name) -> 'unchanged', 'building', 'ready' or 'failed'
+        self.status = {}
+        self.threads = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def content_hash(views: dict) -> str:
+        return hashlib.sha1(json.dumps(views, sort_keys=True).encode()).hexdigest()
+
+    def _design_url(self, database: str, design_id: str) -> str:
+        return self.couch.url + database + '/' + design_id
+
+    def _get_design(self, database: str, design_id: str) -> Optional[dict]:
+        resp = self.couch._get(self._design_url(database, design_id))
+        if resp.status_code == 404:
+            return None
+        resp.raise_for_status()
+        return resp.json()
+
+    def deploy(self, database: str, design_name: str, views: dict, wait: bool = False) -> str:
+        """
+        Make the live design document hold these views, building their index before they replace the old ones.
+
+        :param database: the name of specific database
+        :param design_name: the name of design document, without '_design/'
+        :param views: the views of the design document, as {view_name: {'map': ..., 'reduce': ...}}
+        :param wait: block until the views are live, instead of building them in the background
+        :return: 'unchanged' if the live views are the same already, else 'building' or, with wait, 'ready'
+        """
+        key = (database, design_name)
+        staging_id = '_design/' + design_name + '-staging'
+        live = self._get_design(database, '_design/' + design_name)
+        staging = self._get_design(database, staging_id)
+        if live is not None and self.content_hash(live.get('views', {})) == self.content_hash(views):
+            # drop other views still staged, so they do not replace these once built
+            if staging is not None:
+                self.couch._request('DELETE', self._design_url(database, staging_id), params={'rev': staging['_rev']})
+            self.status[key] = 'unchanged'
+            return 'unchanged'
+        # a staging document with the same views is already being built, by an earlier or interrupted deployment
+        if staging is None or self.content_hash(staging.get('views', {})) != self.content_hash(views):
+            doc = {'_id': staging_id, 'language': 'javascript', 'views': views}
+            if staging is not None:
+                doc['_rev'] = staging['_rev']
+            self.couch._put(self._design_url(database, staging_id), data=json.dumps(doc)).raise_for_status()
+        with self.lock:
+            self.status[key] = 'building'
+            thread = self.threads.get(key)
+            if thread is None or not thread.is_alive():
+                thread = threading.Thread(target=self._build, args=(database, design_name), daemon=True)
+                self.threads[key] = thread
+                thread.start()
+        if wait:
+            return self.wait(database, design_name)
+        return 'building'
+
+    def wait(self, database: str, design_name: str, timeout: float = None) -> Optional[str]:
+        """
+        :param database: the name of specific database
+        :param design_name: the name of design document
+        :param timeout: [optional] seconds to wait at most
+        :return: the status of the last deployment of the design document
+        """
+        thread = self.threads.get((database, design_name))
+        if thread is not None:
+            thread.join(timeout)
+        return self.status.get((database, design_name))
+
+    def progress(self, database: str, design_name: str) -> list:
+        """
+        :param database: the name of specific database
+        :param design_name: the name of design document
+        :return: the indexer tasks of the design document and its staging one, one per shard
+        """
+        design_ids = ('_design/' + design_name, '_design/' + design_name + '-staging')
+        tasks = self.couch._get(self.couch.url + '_active_tasks').json()
+        # the database of a task is a shard such as shards/00000000-1fffffff/twitter_new.1651234567
+        return [task for task in tasks if task.get('type') == 'indexer' and task.get('design_document') in design_ids
+                and task.get('database', '').split('/')[-1].split('.')[0] == database]
+
+    def _build(self, database: str, design_name: str) -> None:
+        staging_id = '_design/' + design_name + '-staging'
+        key = (database, design_name)
+        try:
+            while True:
+                staging = self._get_design(database, staging_id)
+                if staging is None:
+                    # cancelled, or swapped in by another deployment
+                    if self.status.get(key) == 'building':
+                        self.status[key] = 'ready'
+                    return
+                view_url = self._design_url(database, staging_id) + '/_view/' + next(iter(staging['views']))
+                # update=lazy answers straight away and starts building the index, shared by every view of the design
+                self.couch._get(view_url, params={'limit': 0, 'update': 'lazy'})
+                while True:
+                    tasks = self.progress(database, design_name)
+                    if not tasks:
+                        break
+                    if self.verbose:
+                        progress = sum(task.get('progress', 0) for task in tasks) / len(tasks)
+                        print(f'Building {staging_id} of {database}: {progress:.0f}% ({len(tasks)} shards)')
+                    time.sleep(self.poll_interval)
+                # returns as soon as the index is up to date, so this only waits for an update not yet listed
+                resp = self.couch._get(view_url, params={'limit': 0}, timeout=None)
+                if resp.status_code == 404:
+                    continue
+                resp.raise_for_status()
+                live = self._get_design(database, '_design/' + design_name)
+                destination = '_design/' + design_name + (f'?rev={live["_rev"]}' if live is not None else '')
+                # copy the revision that was built, even if other views were staged meanwhile
+                self.couch._request('COPY', self._design_url(database, staging_id), params={'rev': staging['_rev']},
+                                    headers={'Destination': destination}).raise_for_status()
+                resp = self.couch._request('DELETE', self._design_url(database, staging_id),
+                                           params={'rev': staging['_rev']})
+                # a conflict means other views were staged meanwhile, they are built and swapped in next
+                if resp.status_code != 409:
+                    resp.raise_for_status()
+                    break
+            # drop the index files of the replaced views
+            self.couch._request('POST', self.couch.url + database + '/_view_cleanup',
+                                headers={'Content-Type': 'application/json'})
+            self.status[key] = 'ready'
+            if self.verbose:
+                print(f'Deployed _design/{design_name} of {database}')
+        except Exception as e:
+            self.status[key] = 'failed'
+            print(f'Failed to deploy _design/{design_name} of {database}: {e}')
+
+
 class MapGenerator:
     def __init__(self):
         self.conditions = []
@@ -219,10 +497,11 @@ class MapGenerator:
         generated by this MapGenerator. The operator 'equals' is used to filter the data with specific 'field' equals
         (==) the value provided. The 'satisfies' can be used along with a regular expression. The 'contains' requires
         the specific field contains at least one element in a list 'value'. The 'exists' needs no value, which only
-        checks whether this field exists and does not equal to null.
+        checks whether this field exists and does not equal to null. The 'tagged' requires the array field, e.g.
+        'tags', to hold the tag 'value', which is much cheaper than 'contains' for documents tagged by the harvester.
 
         :param field: the field you want to apply the rule
-        :param operator: the rule operator, can be 'equals', 'satisfies', 'contains', 'exists'
+        :param operator: the rule operator, can be 'equals', 'satisfies', 'contains', 'exists', 'tagged'
         :param value: the corresponding value needed by the operator
         :return: None
         """
@@ -240,6 +519,9 @@ class MapGenerator:
             regex = f'/({"|".join(value)})/i'
             condition = f'{regex}.test(doc.{field})'
             self.conditions.append(condition)
+        elif operator == 'tagged' and value:
+            condition = f'doc.{field} && doc.{field}.indexOf("{value}") >= 0'
+            self.conditions.append(condition)
         elif operator == 'exists':
             condition = f'doc.{field}'
             self.conditions.append(condition)
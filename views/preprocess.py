@@ -3,14 +3,33 @@ from shapely.geometry import Polygon, MultiPolygon
 import pandas as pd
 
 
-def filter_tweet(couch_itf, database, keywords, design_name='filter', views_name=None, create=True):
+def view_frame(rows, columns, to_row, chunk_size=10000):
+    # build a DataFrame from view rows chunk by chunk, so only chunk_size rows are held as Python objects at a time
+    chunks = []
+    data = []
+    for row in rows:
+        data.append(to_row(row))
+        if len(data) == chunk_size:
+            chunks.append(pd.DataFrame(data, columns=columns))
+            data = []
+    if data or not chunks:
+        chunks.append(pd.DataFrame(data, columns=columns))
+    return pd.concat(chunks, ignore_index=True) if len(chunks) > 1 else chunks[0]
+
+
+def filter_tweet(couch_itf, database, keywords, design_name='filter', views_name=None, create=True, tag=None,
+                 page_size=1000, chunk_size=10000):
+    # with a tag, the views select the tweets the harvester tagged with it instead of matching the keywords
     if views_name is None:
         views_name = ['tweets_with_sa2', 'sentiment_per_sa2']
 
     if create:
         mapreduce_list = []
         mg = MapGenerator()
-        mg.add_condition('tweet.text', 'contains', keywords)
+        if tag:
+            mg.add_condition('tags', 'tagged', tag)
+        else:
+            mg.add_condition('tweet.text', 'contains', keywords)
         mg.add_condition('sa2', 'exists')
         mg.set_key('tweet.id_str')
         mg.set_value({'sa2': 'sa2', 'compound': 'sentiment.compound', 'text': 'tweet.text',
@@ -23,19 +42,18 @@ def filter_tweet(couch_itf, database, keywords, design_name='filter', views_name
         mapreduce_list.append((map_function, '_stats'))
         couch_itf.create_mapreduce_views(database, design_name, mapreduce_list,
                                          views_name=views_name, return_mode=False)
-    tweets_with_sa2 = couch_itf.get_view(database, design_name, views_name[0])
-    sentiment_per_sa2 = couch_itf.get_view(database, design_name, views_name[1], group_level=1)
-    data_tweet = []
-    for row in tweets_with_sa2['rows']:
-        ins = [row['key'], row['value']['sa2'], row['value']['compound'], row['value']['text'],
-               row['value']['longitude'], row['value']['latitude']]
-        data_tweet.append(ins)
-    data_sentiment = []
-    for row in sentiment_per_sa2['rows']:
-        ins = [row['key'], row['value']]
-        data_sentiment.append(ins)
-    tweets_with_sa2_df = pd.DataFrame(data_tweet, columns=['id', 'sa2', 'compound', 'text', 'longitude', 'latitude'])
-    sentiment_per_sa2_df = pd.DataFrame(data_sentiment, columns=['sa2', 'stats'])
+        # the views are built in the background, wait for them before reading
+        couch_itf.designs.wait(database, design_name)
+    # the tweet view emits every tweet text, so it is paged and turned into a DataFrame as the rows arrive
+    tweets_with_sa2 = couch_itf.iter_view(database, design_name, views_name[0], page_size=page_size)
+    sentiment_per_sa2 = couch_itf.iter_view(database, design_name, views_name[1], group_level=1,
+                                            page_size=page_size)
+    tweets_with_sa2_df = view_frame(tweets_with_sa2, ['id', 'sa2', 'compound', 'text', 'longitude', 'latitude'],
+                                    lambda row: [row['key'], row['value']['sa2'], row['value']['compound'],
+                                                 row['value']['text'], row['value']['longitude'],
+                                                 row['value']['latitude']], chunk_size)
+    sentiment_per_sa2_df = view_frame(sentiment_per_sa2, ['sa2', 'stats'], lambda row: [row['key'], row['value']],
+                                      chunk_size)
     return tweets_with_sa2_df, sentiment_per_sa2_df
 
 
@@ -47,6 +65,7 @@ def get_australia_geo(couch_itf, database='abs_austgeo_sa2', design_name='filter
         mg.set_value({'SA2_NAME16': 'SA2_NAME16', 'geometry': 'coordinates'})
         map_function = mg.generate()
         couch_itf.create_mapreduce_view(database, design_name, map_function, return_mode=False)
+        couch_itf.designs.wait(database, design_name)
     geo_view = couch_itf.get_view(database, design_name, view_name)
 
     data = []
@@ -78,6 +97,7 @@ def get_lang_diversity(couch_itf, database='aurin_lsahbsc_sa2', design_name='fil
         mg.set_value(['os_visitors_p', 'lang_spoken_home_ns_p', 'spks_other_lang_tot_p', 'spks_eng_on_p', 'tot_p'])
         map_function = mg.generate()
         couch_itf.create_mapreduce_view(database, design_name, map_function, return_mode=False)
+        couch_itf.designs.wait(database, design_name)
     lang_view = couch_itf.get_view(database, design_name, view_name)
     data_lang = []
     for row in lang_view['rows']:
@@ -94,6 +114,7 @@ def get_social_economy(couch_itf, database='aurin_seifa_sa2', design_name='filte
         mg.set_value('irsad_score')
         map_function = mg.generate()
         couch_itf.create_mapreduce_view(database, design_name, map_function, return_mode=False)
+        couch_itf.designs.wait(database, design_name)
     se_view = couch_itf.get_view(database, design_name, view_name)
     data_se = []
     for row in se_view['rows']: